@@ -0,0 +1,405 @@
+import time
+# Mốc đo thời gian khởi động (import + nạp model + warmup) -> /api/v1/health 'startup'
+_PROCESS_START = time.perf_counter()
+import os
+import json
+import base64
+import shutil
+import asyncio
+import tempfile
+from typing import List, Optional
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+from predictor import (Predictor, MicroBatcher, LESION_STAT_KEYS, decode_image, encode_mask_png,
+                       write_mask_stack_tiff)
+from volume import open_volume, summarize
+from prediction_cache import PredictionCache, image_key
+from storage import LocalObjectStorage, safe_name
+from jobs import JobStore, JobRunner, TERMINAL_STATUSES, new_job_id
+from lesion import encode_mask, decode_mask
+from ensemble import TTAEnsemble
+import config
+import instrument
+
+IMPORT_SECONDS = time.perf_counter() - _PROCESS_START
+
+# Cấu hình qua biến môi trường (Docker / K8s)
+WEIGHTS_PATH = os.environ.get('OCT_WEIGHTS')
+# eager (.pth) / torchscript (.pt) / onnx (.onnx) - artefact tạo bởi src/export.py
+BACKEND = os.environ.get('OCT_BACKEND', 'eager')
+ENCODER_NAME = os.environ.get('OCT_ENCODER', 'efficientnet-b0')
+DEVICE = os.environ.get('OCT_DEVICE')  # None -> tự chọn cuda/cpu
+MAX_BATCH_SIZE = int(os.environ.get('OCT_MAX_BATCH', '16'))
+MAX_WAIT_MS = float(os.environ.get('OCT_MAX_WAIT_MS', '5'))
+# Số lát mỗi batch khi suy luận cả volume
+VOLUME_BATCH_SIZE = int(os.environ.get('OCT_VOLUME_BATCH', '16'))
+# Suy luận sliding-window ở độ phân giải gốc (tile = IMG_SIZE) thay vì resize cả ảnh
+TILED = os.environ.get('OCT_TILED') == '1'
+TILE_OVERLAP = float(os.environ.get('OCT_TILE_OVERLAP', '0.25'))
+TILE_BATCH_SIZE = int(os.environ.get('OCT_TILE_BATCH', '16'))
+# Cache kết quả: số entry trong RAM, thư mục cache trên đĩa (bỏ trống = tắt tầng đĩa)
+CACHE_SIZE = int(os.environ.get('OCT_CACHE_SIZE', '512'))
+CACHE_DIR = os.environ.get('OCT_CACHE_DIR')
+# Chỉ dùng khi dev/test: cho phép chạy không có checkpoint (trọng số ngẫu nhiên)
+ALLOW_RANDOM_WEIGHTS = os.environ.get('OCT_ALLOW_RANDOM_WEIGHTS') == '1'
+# Đo latency từng giai đoạn (predict/preprocess, predict/forward, model/encoder...) -> /api/v1/system/latency
+INSTRUMENT = os.environ.get('OCT_INSTRUMENT') == '1'
+# Job phân tích bất đồng bộ: SQLite (thay PostgreSQL), thư mục lưu ảnh / mask (thay MinIO)
+JOB_DB = os.environ.get('OCT_JOB_DB', os.path.join(config.DATA_DIR, 'jobs', 'jobs.db'))
+STORAGE_DIR = os.environ.get('OCT_STORAGE_DIR', os.path.join(config.DATA_DIR, 'storage'))
+JOB_WORKERS = int(os.environ.get('OCT_JOB_WORKERS', '1'))
+JOB_BATCH_SIZE = int(os.environ.get('OCT_JOB_BATCH', '16'))
+JOB_POLL_SECONDS = float(os.environ.get('OCT_JOB_POLL_SECONDS', '0.5'))  # Chu kỳ kiểm tra tiến độ của SSE
+# TTA / ensemble (src/ensemble.py): biến đổi TTA "hflip,bright,dark"; model thêm "encoder:đường dẫn,..."
+# (cùng OCT_BACKEND); temperature từng model "1.4,1.2" (python ensemble.py --fit-temperature)
+TTA = [t for t in os.environ.get('OCT_TTA', '').split(',') if t]
+ENSEMBLE = [tuple(m.split(':', 1)) for m in os.environ.get('OCT_ENSEMBLE', '').split(',') if m]
+TEMPERATURES = [float(t) for t in os.environ.get('OCT_TEMPERATURE', '').split(',') if t] or None
+# Ngân sách thời gian từ lúc import tới khi nhận request (replica mới phải sẵn sàng nhanh khi scale-out)
+STARTUP_BUDGET_SECONDS = float(os.environ.get('OCT_STARTUP_BUDGET', '10'))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    if WEIGHTS_PATH is None and not ALLOW_RANDOM_WEIGHTS:
+        raise RuntimeError("Chưa đặt OCT_WEIGHTS (đường dẫn checkpoint .pth)")
+    instrument.configure(enabled=INSTRUMENT)
+
+    predictor = Predictor(WEIGHTS_PATH, ENCODER_NAME, DEVICE, backend=BACKEND,
+                          tiled=TILED, tile_overlap=TILE_OVERLAP, tile_batch_size=TILE_BATCH_SIZE,
+                          tta=TTA, ensemble=ENSEMBLE, temperatures=TEMPERATURES)
+    start = time.perf_counter()
+    predictor.warmup()
+    warmup_seconds = time.perf_counter() - start
+    # Warmup không tính vào histogram latency
+    instrument.reset()
+    batcher = MicroBatcher(predictor.predict_requests, MAX_BATCH_SIZE, MAX_WAIT_MS)
+    await batcher.start()
+
+    app.state.predictor = predictor
+    app.state.batcher = batcher
+    app.state.cache = PredictionCache(predictor.fingerprint, CACHE_SIZE, CACHE_DIR)
+    app.state.storage = LocalObjectStorage(STORAGE_DIR)
+    app.state.jobs = JobStore(JOB_DB)
+    app.state.runner = JobRunner(app.state.jobs, app.state.storage, predictor, JOB_WORKERS, JOB_BATCH_SIZE,
+                                 VOLUME_BATCH_SIZE)
+    app.state.runner.start()
+    app.state.startup = _startup_report(predictor, warmup_seconds)
+    yield
+    await run_in_threadpool(app.state.runner.stop)
+    app.state.jobs.close()
+    await batcher.stop()
+
+
+def _startup_report(predictor, warmup_seconds):
+    ready_seconds = time.perf_counter() - _PROCESS_START
+    report = {
+        'import_seconds': IMPORT_SECONDS,
+        'model_load_seconds': predictor.load_seconds,
+        'warmup_seconds': warmup_seconds,
+        'ready_seconds': ready_seconds,
+        'budget_seconds': STARTUP_BUDGET_SECONDS,
+        'within_budget': ready_seconds <= STARTUP_BUDGET_SECONDS,
+    }
+    print(f"--> Sẵn sàng sau {ready_seconds:.2f} s (import {IMPORT_SECONDS:.2f} s, nạp model "
+          f"{predictor.load_seconds:.2f} s, warmup {warmup_seconds:.2f} s)")
+    if not report['within_budget']:
+        print(f"CẢNH BÁO: Khởi động vượt ngân sách {STARTUP_BUDGET_SECONDS:.1f} s (OCT_STARTUP_BUDGET)")
+    return report
+
+
+app = FastAPI(title="RetinaNet.AI", version="1.0.0", lifespan=lifespan)
+
+
+@app.get("/api/v1/health")
+async def health():
+    predictor = app.state.predictor
+    model, _, fingerprint = predictor.snapshot()
+    return {
+        'status': 'ok',
+        'device': str(predictor.device),
+        'backend': predictor.backend,
+        'encoder': predictor.encoder_name,
+        'tiled': predictor.tiled,
+        'ensemble': {'members': model.num_members, 'transforms': model.transforms,
+                     'temperatures': model.temperatures, 'models': len(model.runners)}
+        if isinstance(model, TTAEnsemble) else None,
+        'weights': predictor.weights_path,
+        'model_load_seconds': predictor.load_seconds,
+        'startup': app.state.startup,
+        'model_fingerprint': fingerprint,
+        'batcher': app.state.batcher.stats(),
+        'cache': app.state.cache.stats(),
+        'jobs': app.state.runner.stats(),
+    }
+
+
+@app.get("/api/v1/system/cache")
+async def cache_stats():
+    return app.state.cache.stats()
+
+
+@app.get("/api/v1/system/latency")
+async def latency_stats(reset: bool = False):
+    """Histogram latency theo span (cần OCT_INSTRUMENT=1); reset=true -> bắt đầu cửa sổ đo mới"""
+    spans = instrument.summary()
+    if reset:
+        instrument.reset()
+    return {'enabled': instrument.enabled(), 'buckets_ms': list(instrument.BUCKETS_MS), 'spans': spans}
+
+
+@app.post("/api/v1/exam/analyze")
+async def analyze(file: UploadFile = File(...), mode: str = 'full', mask_format: str = 'png'):
+    """
+    Gửi ảnh OCT vào AI Model: trả về mask phân đoạn, xác suất bệnh, độ tin cậy, thống kê tổn thương
+    (diện tích, bounding box, độ dày theo cột, mức độ).
+    mode='classify': chỉ chẩn đoán (triage nhanh, không chạy decoder, không có mask)
+    mask_format='rle': mask dạng lesion.encode_mask (mask_rle_base64) thay cho PNG
+    uncertainty: độ bất đồng giữa các thành viên khi bật OCT_TTA / OCT_ENSEMBLE (None nếu suy luận 1 lần)
+    """
+    if mode not in ('full', 'classify'):
+        raise HTTPException(status_code=400, detail="mode phải là 'full' hoặc 'classify'")
+    if mask_format not in ('png', 'rle'):
+        raise HTTPException(status_code=400, detail="mask_format phải là 'png' hoặc 'rle'")
+    start = time.perf_counter()
+    data = await file.read()
+    try:
+        image = await run_in_threadpool(decode_image, data)
+    except Exception:
+        raise HTTPException(status_code=400, detail="File tải lên không phải ảnh hợp lệ")
+
+    predictor, cache = app.state.predictor, app.state.cache
+    # Checkpoint đổi trên đĩa -> nạp lại model, cache theo fingerprint cũ tự mất hiệu lực
+    if await run_in_threadpool(predictor.reload_if_changed):
+        cache.set_fingerprint(predictor.fingerprint)
+
+    # Bác sĩ mở lại cùng một ảnh (viewer / compare) -> trả từ cache, không chạy lại model
+    key = await run_in_threadpool(image_key, image)
+    result = await run_in_threadpool(cache.get, key)
+    cached = result is not None
+    if not cached:
+        # Request full và classify dùng chung một batch; decoder chỉ chạy cho ảnh cần mask
+        result = await app.state.batcher.submit((image, mode == 'full'))
+        # Kết quả của model cũ (reload xảy ra giữa chừng) bị cache.put bỏ qua (so fingerprint dưới khóa).
+        # Kết quả chỉ phân loại không có mask -> không cache (cache phục vụ cả request full)
+        if result['mask'] is not None:
+            await run_in_threadpool(cache.put, key, result, result['model_fingerprint'])
+
+    response = {
+        'diagnosis': result['diagnosis'],
+        'confidence_score': result['confidence'],
+        'probabilities': result['probabilities'],
+        'original_size': list(image.shape),
+        'model_fingerprint': result['model_fingerprint'],
+        'uncertainty': result['uncertainty'],
+        'mode': mode,
+        'cached': cached,
+    }
+    if mode == 'full':
+        encoder = encode_mask_png if mask_format == 'png' else encode_mask
+        mask_data = await run_in_threadpool(encoder, result['mask'])
+        response.update({k: result[k] for k in LESION_STAT_KEYS})
+        response['mask_size'] = list(result['mask'].shape)
+        response[f'mask_{mask_format}_base64'] = base64.b64encode(mask_data).decode('ascii')
+    response['latency_ms'] = (time.perf_counter() - start) * 1000
+    instrument.record(f"request/analyze_{mode}" + ("_cached" if cached else ""), response['latency_ms'])
+    return response
+
+
+def _analyze_volume_files(predictor, storage, files, include_masks):
+    """
+    Chạy trong threadpool: chép file upload (stream, không đọc cả file vào RAM) ra thư mục tạm
+    -> đọc lười theo lát -> suy luận. files: list (tên file, file object của UploadFile)
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="oct_volume_")
+    try:
+        names = []
+        for name, fileobj in files:
+            name = safe_name(name)
+            if name in names:
+                # Lát được sắp theo tên file -> trùng tên là mất lát
+                raise ValueError(f"Trùng tên file: {name}")
+            names.append(name)
+            with open(os.path.join(tmp_dir, name), 'wb') as f:
+                shutil.copyfileobj(fileobj, f, 1 << 20)
+        # 1 file .mat / TIFF nhiều trang -> mở file đó; nhiều file TIFF -> cả thư mục là 1 chuỗi
+        path = os.path.join(tmp_dir, names[0]) if len(names) == 1 else tmp_dir
+        volume = open_volume(path)
+        # Mask stack ghi ra memmap trong thư mục tạm: RAM không tăng theo số lát
+        result = predictor.predict_volume(volume, VOLUME_BATCH_SIZE, os.path.join(tmp_dir, 'masks.npy'))
+        response = summarize(result)
+        if include_masks:
+            # TIFF ghi từng trang từ memmap ra file rồi chuyển vào storage -> tải qua URL, không base64 trong JSON
+            tiff_path = os.path.join(tmp_dir, 'masks.tif')
+            write_mask_stack_tiff(result['masks'], tiff_path)
+            response['mask_stack_url'] = storage.put_file('masks', f"volumes/{new_job_id()}/masks.tif", tiff_path)
+        del result, volume
+        return response
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+@app.post("/api/v1/exam/analyze-volume")
+async def analyze_volume(files: List[UploadFile] = File(...), include_masks: bool = False):
+    """
+    Gửi cả volume: 1 file .mat (Chiu, key 'images'), 1 file TIFF nhiều trang, hoặc nhiều file TIFF
+    (mỗi file 1 lát, sắp theo tên). Trả về chẩn đoán mức bệnh nhân, xác suất + diện tích tổn thương
+    từng lát, tổng voxel tổn thương; include_masks=true -> kèm mask_stack_url (TIFF nhiều trang trong storage).
+    """
+    start = time.perf_counter()
+    uploads = [(file.filename or f"slice_{i:04d}.tif", file.file) for i, file in enumerate(files)]
+
+    predictor = app.state.predictor
+    if await run_in_threadpool(predictor.reload_if_changed):
+        app.state.cache.set_fingerprint(predictor.fingerprint)
+    try:
+        response = await run_in_threadpool(_analyze_volume_files, predictor, app.state.storage, uploads,
+                                           include_masks)
+    except (ValueError, KeyError, OSError) as e:
+        raise HTTPException(status_code=400, detail=f"Volume không hợp lệ: {e}")
+    response['latency_ms'] = (time.perf_counter() - start) * 1000
+    instrument.record('request/analyze_volume', response['latency_ms'])
+    return response
+
+
+# --- Job bất đồng bộ: upload trả về job id ngay, worker phân tích nền ---
+
+async def _store_uploads(files, job_id, keep_names=False):
+    """
+    Ghi file upload vào bucket 'scans', thư mục job_id -> list (tên, URL, key).
+    keep_names: volume nhiều file TIFF được sắp lát theo tên file -> giữ tên; còn lại thêm số thứ tự upload.
+    """
+    storage, stored = app.state.storage, []
+    for i, file in enumerate(files):
+        name = safe_name(file.filename or f"scan_{i:05d}.png")
+        key = f"{job_id}/{name}" if keep_names else f"{job_id}/{i:05d}_{name}"
+        if any(key == k for _, _, k in stored):
+            storage.delete_prefix('scans', job_id)
+            raise HTTPException(status_code=400, detail=f"Trùng tên file (sau khi chuẩn hóa): {name}")
+        # Chép thẳng file tạm của UploadFile sang storage theo khối -> volume lớn không nằm trọn trong RAM
+        url, size = await run_in_threadpool(storage.put_fileobj, 'scans', key, file.file)
+        if not size:
+            storage.delete_prefix('scans', job_id)
+            raise HTTPException(status_code=400, detail=f"File rỗng: {file.filename}")
+        stored.append((file.filename or name, url, key))
+    return stored
+
+
+@app.post("/api/v1/exam/upload", status_code=202)
+async def upload(files: List[UploadFile] = File(...), mode: str = 'full', patient_id: Optional[str] = None):
+    """
+    Upload nhiều ảnh OCT (VD: cả ngày khám): ảnh được lưu vào storage, trả về job id ngay.
+    Mỗi ảnh là một medical_record PROCESSING -> COMPLETED khi worker phân tích xong (theo batch).
+    """
+    if mode not in ('full', 'classify'):
+        raise HTTPException(status_code=400, detail="mode phải là 'full' hoặc 'classify'")
+    job_id = new_job_id()
+    stored = await _store_uploads(files, job_id)
+    await run_in_threadpool(app.state.jobs.create_job, 'images', mode, stored, patient_id, job_id)
+    app.state.runner.submit(job_id)
+    return _job_links(job_id, len(stored))
+
+
+@app.post("/api/v1/exam/upload-volume", status_code=202)
+async def upload_volume(files: List[UploadFile] = File(...), mode: str = 'full', patient_id: Optional[str] = None):
+    """Như /exam/analyze-volume nhưng bất đồng bộ: trả về job id, kết quả (tóm tắt + mask stack) ở /jobs/{id}"""
+    if mode not in ('full', 'classify'):
+        raise HTTPException(status_code=400, detail="mode phải là 'full' hoặc 'classify'")
+    job_id = new_job_id()
+    await _store_uploads(files, job_id, keep_names=True)
+    await run_in_threadpool(app.state.jobs.create_job, 'volume', mode, [], patient_id, job_id)
+    app.state.runner.submit(job_id)
+    return _job_links(job_id, None)
+
+
+def _job_links(job_id, total):
+    return {
+        'job_id': job_id,
+        'status': 'QUEUED',
+        'total': total,
+        'status_url': f"/api/v1/jobs/{job_id}",
+        'events_url': f"/api/v1/jobs/{job_id}/events",
+    }
+
+
+@app.get("/api/v1/jobs")
+async def list_jobs(status: Optional[str] = None, limit: int = 50):
+    return await run_in_threadpool(app.state.jobs.list_jobs, status, min(max(limit, 1), 500))
+
+
+@app.get("/api/v1/jobs/{job_id}")
+async def get_job(job_id: str, include_records: bool = True):
+    """Trạng thái + tiến độ job; include_records -> kết quả từng ảnh (URL mask, chẩn đoán...)"""
+    job = await run_in_threadpool(app.state.jobs.get_job, job_id, include_records)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job")
+    return job
+
+
+@app.get("/api/v1/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """
+    Server-Sent Events: 'progress' mỗi khi done / failed / status đổi, 'done' (kèm trạng thái cuối) rồi đóng.
+    Đọc trạng thái từ JobStore mỗi OCT_JOB_POLL_SECONDS (worker chạy ở thread / process khác).
+    """
+    store = app.state.jobs
+    if await run_in_threadpool(store.get_job, job_id) is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job")
+
+    async def stream():
+        last = None
+        while True:
+            job = await run_in_threadpool(store.get_job, job_id)
+            state = (job['status'], job['total'], job['done'], job['failed'])
+            if state != last:
+                last = state
+                payload = {k: job[k] for k in ('id', 'status', 'total', 'done', 'failed', 'progress')}
+                yield f"event: progress\ndata: {json.dumps(payload)}\n\n"
+            if job['status'] in TERMINAL_STATUSES:
+                yield f"event: done\ndata: {json.dumps({'id': job_id, 'status': job['status'], 'error': job['error']})}\n\n"
+                return
+            await asyncio.sleep(JOB_POLL_SECONDS)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={'Cache-Control': 'no-cache'})
+
+
+@app.get("/api/v1/records/{record_id}/mask")
+async def get_record_mask(record_id: str, format: str = 'png'):
+    """Mask của một medical_record (mask_image_url): PNG dựng từ bản mã hóa, format='rle' -> bytes gốc"""
+    if format not in ('png', 'rle'):
+        raise HTTPException(status_code=400, detail="format phải là 'png' hoặc 'rle'")
+    data = await run_in_threadpool(app.state.jobs.get_mask, record_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy mask")
+    if format == 'rle':
+        return Response(content=data, media_type='application/octet-stream')
+    png = await run_in_threadpool(lambda: encode_mask_png(decode_mask(data)))
+    return Response(content=png, media_type='image/png')
+
+
+@app.get("/api/v1/patients/{patient_id}/lesion-stats")
+async def patient_lesion_stats(patient_id: str):
+    """Biểu đồ tiến triển: diện tích / độ dày / mức độ tổn thương theo ngày khám (bảng cộng dồn)"""
+    visits = await run_in_threadpool(app.state.jobs.patient_stats, patient_id)
+    return {'patient_id': patient_id, 'visits': visits}
+
+
+@app.get("/api/v1/storage/{bucket}/{key:path}")
+async def get_object(bucket: str, key: str):
+    """Tải ảnh gốc / mask đã lưu (URL trong medical_records)"""
+    storage = app.state.storage
+    try:
+        path = storage.open_path(bucket, key)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Key không hợp lệ")
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Không tìm thấy file")
+    return FileResponse(path)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get('PORT', '8000')))
@@ -0,0 +1,415 @@
+import os
+import json
+import time
+import uuid
+import queue
+import sqlite3
+import tempfile
+import threading
+import numpy as np
+
+from predictor import decode_image, write_mask_stack_tiff
+from volume import open_volume, summarize
+from lesion import encode_mask, SEVERITY_LEVELS
+
+# Phân tích bất đồng bộ theo job (upload cả ngày khám / cả volume, không giữ kết nối HTTP):
+#   POST /exam/upload -> ảnh lưu vào storage, tạo job QUEUED + mỗi ảnh 1 dòng medical_records PROCESSING
+#   -> worker lấy job, chạy predictor.predict_batch theo batch, ghi mask + kết quả -> COMPLETED
+#   -> client hỏi GET /jobs/{id} hoặc nghe SSE /jobs/{id}/events.
+# Trạng thái job nằm trong SQLite (thay cho PostgreSQL): server khởi động lại thì job dở dang
+# (QUEUED / PROCESSING) được đưa lại vào hàng đợi, chỉ các ảnh chưa xong được chạy tiếp.
+# Mask lưu ngay trong medical_records (lesion.encode_mask, vài chục byte / ảnh), PNG chỉ được dựng khi xem
+# (MASK_URL). Thống kê tổn thương theo bệnh nhân + ngày khám được cộng dồn vào patient_lesion_stats cùng
+# transaction ghi kết quả -> biểu đồ tiến triển đọc thẳng bảng này, không mở lại mask.
+
+QUEUED, PROCESSING, COMPLETED, FAILED = 'QUEUED', 'PROCESSING', 'COMPLETED', 'FAILED'
+TERMINAL_STATUSES = (COMPLETED, FAILED)
+MASK_URL = "/api/v1/records/{}/mask"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,              -- 'images' (nhiều ảnh độc lập) / 'volume' (1 volume nhiều lát)
+    mode TEXT NOT NULL,              -- 'full' / 'classify'
+    patient_id TEXT,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL,          -- số ảnh (images) / số lát (volume, biết sau khi mở)
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    error TEXT,
+    result TEXT                      -- JSON (volume: tóm tắt mức bệnh nhân + URL mask stack)
+);
+CREATE TABLE IF NOT EXISTS medical_records (
+    id TEXT PRIMARY KEY,
+    job_id TEXT NOT NULL REFERENCES jobs(id),
+    idx INTEGER NOT NULL,
+    patient_id TEXT,
+    file_name TEXT,
+    original_image_url TEXT,
+    original_key TEXT,
+    mask_image_url TEXT,
+    diagnosis TEXT,
+    confidence_score REAL,
+    probabilities TEXT,              -- JSON
+    lesion_area_px INTEGER,
+    model_fingerprint TEXT,
+    status TEXT NOT NULL,            -- PROCESSING -> COMPLETED / FAILED
+    error TEXT,
+    created_at REAL NOT NULL,
+    severity TEXT,                   -- 'None' / 'Medium' / 'High' (lesion.SEVERITY_LEVELS)
+    lesion_bbox TEXT,                -- JSON [y0, x0, y1, x1]
+    lesion_thickness_max_px INTEGER,
+    lesion_thickness_mean_px REAL,
+    mask_rle BLOB                    -- lesion.encode_mask
+);
+CREATE TABLE IF NOT EXISTS patient_lesion_stats (
+    patient_id TEXT NOT NULL,
+    visit_date TEXT NOT NULL,        -- YYYY-MM-DD, ngày tạo job
+    scans INTEGER NOT NULL,          -- số ảnh / lát đã có mask
+    lesion_scans INTEGER NOT NULL,   -- số ảnh / lát có tổn thương
+    total_area_px INTEGER NOT NULL,
+    max_area_px INTEGER NOT NULL,
+    max_thickness_px INTEGER NOT NULL,
+    worst_severity INTEGER NOT NULL, -- chỉ số trong SEVERITY_LEVELS
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (patient_id, visit_date)
+);
+CREATE INDEX IF NOT EXISTS idx_records_job ON medical_records(job_id, idx);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at);
+"""
+# Cột thêm sau phiên bản đầu của medical_records: DB cũ được ALTER TABLE lúc mở
+_RECORD_COLUMNS = [('severity', 'TEXT'), ('lesion_bbox', 'TEXT'), ('lesion_thickness_max_px', 'INTEGER'),
+                   ('lesion_thickness_mean_px', 'REAL'), ('mask_rle', 'BLOB')]
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+class JobStore:
+    """Bảng jobs + medical_records trong SQLite; 1 kết nối dùng chung, khóa theo thao tác (an toàn đa luồng)"""
+    def __init__(self, path):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+            columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(medical_records)")}
+            for name, sql_type in _RECORD_COLUMNS:
+                if name not in columns:
+                    self._conn.execute(f"ALTER TABLE medical_records ADD COLUMN {name} {sql_type}")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def create_job(self, kind, mode, files, patient_id=None, job_id=None):
+        """files: list (tên file, URL, key trong storage) -> id job mới (QUEUED)"""
+        job_id = job_id or new_job_id()
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (id, kind, mode, patient_id, status, total, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, mode, patient_id, QUEUED, len(files) if kind == 'images' else 0, now))
+            if kind == 'images':
+                self._conn.executemany(
+                    "INSERT INTO medical_records (id, job_id, idx, patient_id, file_name, original_image_url, "
+                    "original_key, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(uuid.uuid4().hex, job_id, i, patient_id, name, url, key, PROCESSING, now)
+                     for i, (name, url, key) in enumerate(files)])
+        return job_id
+
+    @staticmethod
+    def _job_dict(row):
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        job['progress'] = job['done'] / job['total'] if job['total'] else 0.0
+        return job
+
+    @staticmethod
+    def _record_dict(row):
+        record = dict(row)
+        record.pop('original_key')
+        record.pop('mask_rle')
+        for field in ('probabilities', 'lesion_bbox'):
+            record[field] = json.loads(record[field]) if record[field] else None
+        return record
+
+    def get_job(self, job_id, include_records=False):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            records = self._conn.execute("SELECT * FROM medical_records WHERE job_id = ? ORDER BY idx",
+                                         (job_id,)).fetchall() if row is not None and include_records else None
+        if row is None:
+            return None
+        job = self._job_dict(row)
+        if records is not None:
+            job['records'] = [self._record_dict(r) for r in records]
+        return job
+
+    def list_jobs(self, status=None, limit=50):
+        query, params = "SELECT * FROM jobs", []
+        if status is not None:
+            query, params = query + " WHERE status = ?", [status]
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY created_at DESC LIMIT ?", params + [limit]).fetchall()
+        return [self._job_dict(r) for r in rows]
+
+    def pending_records(self, job_id):
+        """Ảnh chưa phân tích xong của job (id, idx, key storage) theo thứ tự upload"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, idx, original_key FROM medical_records WHERE job_id = ? AND status = ? ORDER BY idx",
+                (job_id, PROCESSING)).fetchall()
+        return [dict(r) for r in rows]
+
+    def unfinished_jobs(self):
+        """Job QUEUED / PROCESSING (VD: server bị tắt giữa chừng) theo thứ tự tạo"""
+        with self._lock:
+            rows = self._conn.execute("SELECT id FROM jobs WHERE status IN (?, ?) ORDER BY created_at",
+                                      (QUEUED, PROCESSING)).fetchall()
+        return [r['id'] for r in rows]
+
+    def start_job(self, job_id, total=None):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET status = ?, started_at = COALESCE(started_at, ?), "
+                               "total = COALESCE(?, total) WHERE id = ?", (PROCESSING, time.time(), total, job_id))
+
+    def update_records(self, job_id, updates):
+        """Ghi kết quả một batch ảnh + cộng tiến độ job + thống kê bệnh nhân trong MỘT transaction"""
+        completed = sum(1 for u in updates if u['status'] == COMPLETED)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE medical_records SET status = :status, mask_image_url = :mask_image_url, "
+                "diagnosis = :diagnosis, confidence_score = :confidence_score, probabilities = :probabilities, "
+                "lesion_area_px = :lesion_area_px, model_fingerprint = :model_fingerprint, error = :error, "
+                "severity = :severity, lesion_bbox = :lesion_bbox, "
+                "lesion_thickness_max_px = :lesion_thickness_max_px, "
+                "lesion_thickness_mean_px = :lesion_thickness_mean_px, mask_rle = :mask_rle "
+                "WHERE id = :id", updates)
+            self._conn.execute("UPDATE jobs SET done = done + ?, failed = failed + ? WHERE id = ?",
+                               (len(updates), len(updates) - completed, job_id))
+            self._add_patient_stats(job_id, [
+                (u['lesion_area_px'], u['lesion_thickness_max_px'], SEVERITY_LEVELS.index(u['severity']))
+                for u in updates if u['status'] == COMPLETED and u['lesion_area_px'] is not None])
+
+    def _add_patient_stats(self, job_id, scans):
+        """scans: list (diện tích, độ dày lớn nhất, chỉ số severity) -> cộng vào ngày khám của job"""
+        # Gọi bên trong transaction đang mở (đã giữ self._lock)
+        if not scans:
+            return
+        job = self._conn.execute("SELECT patient_id, created_at FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None or job['patient_id'] is None:
+            return
+        areas, thickness, severity = zip(*scans)
+        self._conn.execute(
+            "INSERT INTO patient_lesion_stats (patient_id, visit_date, scans, lesion_scans, total_area_px, "
+            "max_area_px, max_thickness_px, worst_severity, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (patient_id, visit_date) DO UPDATE SET scans = scans + excluded.scans, "
+            "lesion_scans = lesion_scans + excluded.lesion_scans, "
+            "total_area_px = total_area_px + excluded.total_area_px, "
+            "max_area_px = MAX(max_area_px, excluded.max_area_px), "
+            "max_thickness_px = MAX(max_thickness_px, excluded.max_thickness_px), "
+            "worst_severity = MAX(worst_severity, excluded.worst_severity), updated_at = excluded.updated_at",
+            (job['patient_id'], time.strftime('%Y-%m-%d', time.localtime(job['created_at'])), len(scans),
+             sum(1 for a in areas if a > 0), int(sum(areas)), int(max(areas)), int(max(thickness)),
+             int(max(severity)), time.time()))
+
+    def get_mask(self, record_id):
+        """Mask đã mã hóa (lesion.encode_mask) của một record, None nếu không có"""
+        with self._lock:
+            row = self._conn.execute("SELECT mask_rle FROM medical_records WHERE id = ?", (record_id,)).fetchone()
+        return row['mask_rle'] if row is not None else None
+
+    def patient_stats(self, patient_id):
+        """Tiến triển tổn thương theo ngày khám (đọc từ bảng cộng dồn, tăng dần theo ngày)"""
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM patient_lesion_stats WHERE patient_id = ? ORDER BY visit_date",
+                                      (patient_id,)).fetchall()
+        visits = []
+        for row in rows:
+            visit = dict(row)
+            visit.pop('patient_id')
+            visit['mean_area_px'] = visit['total_area_px'] / visit['scans']
+            visit['severity'] = SEVERITY_LEVELS[visit.pop('worst_severity')]
+            visits.append(visit)
+        return visits
+
+    def set_progress(self, job_id, done):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET done = ? WHERE id = ?", (done, job_id))
+
+    def finish_job(self, job_id, status, error=None, result=None, patient_scans=None):
+        """
+        patient_scans: thống kê từng lát của job volume (như _add_patient_stats), cộng vào patient_lesion_stats
+        cùng transaction đánh dấu COMPLETED -> job bị chạy lại (lỗi / server tắt trước đó) không cộng 2 lần.
+        FAILED: ảnh còn PROCESSING cũng thành FAILED (job FAILED không được chạy lại) -> done / failed đủ total
+        """
+        with self._lock, self._conn:
+            if status == FAILED:
+                orphaned = self._conn.execute(
+                    "UPDATE medical_records SET status = ?, error = ? WHERE job_id = ? AND status = ?",
+                    (FAILED, error, job_id, PROCESSING)).rowcount
+                self._conn.execute("UPDATE jobs SET done = done + ?, failed = failed + ? WHERE id = ?",
+                                   (orphaned, orphaned, job_id))
+            self._conn.execute("UPDATE jobs SET status = ?, finished_at = ?, error = ?, result = ? WHERE id = ?",
+                               (status, time.time(), error, json.dumps(result) if result is not None else None,
+                                job_id))
+            if patient_scans:
+                self._add_patient_stats(job_id, patient_scans)
+
+
+class JobRunner:
+    """
+    num_workers thread lấy job từ hàng đợi và chạy suy luận theo batch_size ảnh một lần forward.
+    Ảnh đọc từ storage (bucket 'scans'), mask ghi vào medical_records (volume: bucket 'masks'). stop(): worker dừng sau batch đang
+    chạy (volume: sau batch lát đang chạy), job dở dang giữ PROCESSING và được chạy tiếp ở lần khởi động sau
+    (start() -> unfinished_jobs). Lỗi suy luận của một batch chỉ làm FAILED các ảnh trong batch đó.
+    """
+    def __init__(self, store, storage, predictor, num_workers=1, batch_size=16, volume_batch_size=16):
+        self.store = store
+        self.storage = storage
+        self.predictor = predictor
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.volume_batch_size = volume_batch_size
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for job_id in self.store.unfinished_jobs():
+            self._queue.put(job_id)
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, job_id):
+        self._queue.put(job_id)
+
+    def stats(self):
+        return {'workers': self.num_workers, 'queued': self._queue.qsize(), 'batch_size': self.batch_size}
+
+    def _worker(self):
+        for job_id in iter(self._queue.get, None):
+            job = self.store.get_job(job_id)
+            if job is None or job['status'] in TERMINAL_STATUSES:
+                continue
+            try:
+                if job['kind'] == 'volume':
+                    self._run_volume(job)
+                else:
+                    self._run_images(job)
+            except Exception as e:
+                self.store.finish_job(job_id, FAILED, error=f"{type(e).__name__}: {e}")
+
+    def _run_images(self, job):
+        job_id, segment = job['id'], job['mode'] == 'full'
+        self.store.start_job(job_id)
+        pending = self.store.pending_records(job_id)
+        for start in range(0, len(pending), self.batch_size):
+            if self._stop.is_set():
+                return
+            chunk = pending[start:start + self.batch_size]
+            updates, images, decoded = [], [], []
+            for record in chunk:
+                try:
+                    images.append(decode_image(self.storage.get('scans', record['original_key'])))
+                    decoded.append(record)
+                except Exception as e:
+                    # Ảnh hỏng không làm hỏng cả job
+                    updates.append(_record_update(record['id'], FAILED, error=f"Không đọc được ảnh: {e}"))
+            if images:
+                try:
+                    results = self.predictor.predict_batch(images, [segment] * len(images))
+                except Exception as e:
+                    # Lỗi suy luận (hết bộ nhớ, ảnh quá lớn khi tiled...) chỉ làm hỏng các ảnh của batch này
+                    results = None
+                    updates += [_record_update(record['id'], FAILED, error=f"Lỗi suy luận: {type(e).__name__}: {e}")
+                                for record in decoded]
+                for record, result in zip(decoded, results or []):
+                    lesion = {}
+                    if result['mask'] is not None:
+                        lesion = {k: result[k] for k in ('lesion_area_px', 'lesion_thickness_max_px',
+                                                         'lesion_thickness_mean_px', 'severity')}
+                        lesion.update(mask_image_url=MASK_URL.format(record['id']),
+                                      lesion_bbox=json.dumps(result['lesion_bbox']),
+                                      mask_rle=encode_mask(result['mask']))
+                    updates.append(_record_update(
+                        record['id'], COMPLETED, diagnosis=result['diagnosis'], confidence_score=result['confidence'],
+                        probabilities=json.dumps(result['probabilities']),
+                        model_fingerprint=result['model_fingerprint'], **lesion))
+            self.store.update_records(job_id, updates)
+        self.store.finish_job(job_id, COMPLETED)
+
+    def _run_volume(self, job):
+        job_id = job['id']
+        if self._stop.is_set():
+            return
+        # Nhiều file TIFF -> cả thư mục là 1 chuỗi lát; 1 file .mat / TIFF nhiều trang -> chính file đó
+        folder = self.storage.open_path('scans', job_id)
+        names = sorted(os.listdir(folder))
+        volume = open_volume(os.path.join(folder, names[0]) if len(names) == 1 else folder)
+        self.store.start_job(job_id, total=len(volume))
+        with tempfile.TemporaryDirectory(prefix="oct_job_") as tmp_dir:
+            try:
+                result = self.predictor.predict_volume(volume, self.volume_batch_size,
+                                                       os.path.join(tmp_dir, 'masks.npy'),
+                                                       progress=lambda done, total: self._volume_progress(job_id, done))
+            except _Stopped:
+                # stop() giữa volume: bỏ phần đã chạy, job giữ PROCESSING -> chạy lại từ đầu ở lần khởi động sau
+                return
+            summary, patient_scans = summarize(result), None
+            if job['mode'] == 'full':
+                tiff_path = os.path.join(tmp_dir, 'masks.tif')
+                write_mask_stack_tiff(result['masks'], tiff_path)
+                summary['mask_stack_url'] = self.storage.put_file('masks', f"{job_id}/masks.tif", tiff_path)
+                patient_scans = list(zip(result['slice_lesion_area_px'].tolist(),
+                                         result['slice_thickness_max_px'].tolist(),
+                                         result['slice_severity'].tolist()))
+            del result, volume
+        self.store.finish_job(job_id, COMPLETED, result=_to_json(summary), patient_scans=patient_scans)
+
+    def _volume_progress(self, job_id, done):
+        self.store.set_progress(job_id, done)
+        if self._stop.is_set():
+            raise _Stopped()
+
+
+class _Stopped(Exception):
+    """JobRunner.stop() được gọi khi đang chạy volume -> dừng sau batch lát hiện tại"""
+
+
+def _record_update(record_id, status, **fields):
+    update = {'id': record_id, 'status': status, 'mask_image_url': None, 'diagnosis': None,
+              'confidence_score': None, 'probabilities': None, 'lesion_area_px': None,
+              'model_fingerprint': None, 'error': None, 'severity': None, 'lesion_bbox': None,
+              'lesion_thickness_max_px': None, 'lesion_thickness_mean_px': None, 'mask_rle': None}
+    update.update(fields)
+    return update
+
+
+def _to_json(obj):
+    """Kiểu numpy trong tóm tắt volume -> kiểu Python (json.dumps)"""
+    if isinstance(obj, dict):
+        return {k: _to_json(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_to_json(v) for v in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
@@ -0,0 +1,152 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image, PngImagePlugin
+
+
+def image_key(image):
+    """Hash nội dung điểm ảnh đã giải mã (không phụ thuộc định dạng file/metadata)"""
+    h = hashlib.sha256()
+    h.update(str(image.shape).encode())
+    h.update(np.ascontiguousarray(image).tobytes())
+    return h.hexdigest()
+
+
+def file_fingerprint(path, extra=None):
+    """Dấu vân tay của checkpoint: hash nội dung file + tham số suy luận (encoder, ngưỡng...)"""
+    h = hashlib.sha256(json.dumps(extra or {}, sort_keys=True).encode())
+    if path is None:
+        h.update(b'random-weights')
+        h.update(os.urandom(16))  # Trọng số ngẫu nhiên: mỗi lần khởi động là một model khác
+    else:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+class PredictionCache:
+    """
+    Cache kết quả dự đoán theo (hash điểm ảnh, fingerprint trọng số model), 2 tầng:
+      - Bộ nhớ: LRU giới hạn max_entries
+      - Đĩa (tùy chọn): mỗi kết quả là 1 file PNG nén, metadata (xác suất, chẩn đoán...)
+        nằm trong chunk tEXt của chính file đó. Thư mục con theo fingerprint.
+    Đổi checkpoint -> gọi set_fingerprint(): tầng bộ nhớ bị xóa, thư mục đĩa cũ bị dọn.
+    """
+    def __init__(self, fingerprint, max_entries=512, disk_dir=None):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0,
+                         'evictions': 0, 'invalidations': 0, 'disk_writes': 0}
+        self.fingerprint = None
+        self.set_fingerprint(fingerprint)
+
+    def _disk_path(self, key, fingerprint=None):
+        return os.path.join(self.disk_dir, fingerprint or self.fingerprint, f"{key}.png")
+
+    def set_fingerprint(self, fingerprint):
+        with self._lock:
+            if fingerprint == self.fingerprint:
+                return
+            if self.fingerprint is not None:
+                self.counters['invalidations'] += 1
+            self.fingerprint = fingerprint
+            self._memory.clear()
+
+        if self.disk_dir is not None:
+            os.makedirs(os.path.join(self.disk_dir, fingerprint), exist_ok=True)
+            # Kết quả của checkpoint cũ không bao giờ dùng lại được -> dọn luôn
+            for name in os.listdir(self.disk_dir):
+                if name != fingerprint:
+                    shutil.rmtree(os.path.join(self.disk_dir, name), ignore_errors=True)
+
+    def get(self, key):
+        with self._lock:
+            result = self._memory.get(key)
+            if result is not None:
+                self._memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return result
+            fingerprint = self.fingerprint
+
+        result = self._read_disk(key, fingerprint)
+        with self._lock:
+            if result is None:
+                self.counters['misses'] += 1
+                return None
+            self.counters['disk_hits'] += 1
+        self._put_memory(key, result, fingerprint)
+        return result
+
+    def put(self, key, result, fingerprint=None):
+        """
+        fingerprint: fingerprint của model đã sinh ra result. Khác fingerprint hiện tại (checkpoint được nạp
+        lại trong lúc request đang chạy) -> bỏ kết quả, không ghi kết quả cũ vào cache của model mới.
+        """
+        fingerprint = fingerprint or self.fingerprint
+        if not self._put_memory(key, result, fingerprint):
+            return
+        if self.disk_dir is not None:
+            self._write_disk(key, result, fingerprint)
+
+    def _put_memory(self, key, result, fingerprint=None):
+        with self._lock:
+            if fingerprint is not None and fingerprint != self.fingerprint:
+                return False
+            self._memory[key] = result
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+                self.counters['evictions'] += 1
+        return True
+
+    def _read_disk(self, key, fingerprint=None):
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key, fingerprint)
+        if not os.path.exists(path):
+            return None
+        try:
+            with Image.open(path) as img:
+                meta = json.loads(img.text['prediction'])
+                meta['mask'] = np.asarray(img.convert('L'))
+            return meta
+        except Exception:
+            # File hỏng (VD: đĩa đầy) -> coi như miss
+            return None
+
+    def _write_disk(self, key, result, fingerprint):
+        meta = {k: v for k, v in result.items() if k != 'mask'}
+        info = PngImagePlugin.PngInfo()
+        info.add_text('prediction', json.dumps(meta))
+        path = self._disk_path(key, fingerprint)
+        tmp_path = f"{path}.tmp{threading.get_ident()}"
+        try:
+            Image.fromarray(result['mask']).save(tmp_path, format='PNG', pnginfo=info, optimize=True)
+            os.replace(tmp_path, path)
+        except OSError:
+            # Thư mục fingerprint vừa bị set_fingerprint dọn / đĩa đầy -> chỉ mất bản cache đĩa
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self._lock:
+            self.counters['disk_writes'] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters['memory_hits'] + self.counters['disk_hits'] + self.counters['misses']
+            hits = self.counters['memory_hits'] + self.counters['disk_hits']
+            return {
+                **self.counters,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+                'max_entries': self.max_entries,
+                'disk_dir': self.disk_dir,
+                'fingerprint': self.fingerprint,
+            }
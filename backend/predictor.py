@@ -0,0 +1,339 @@
+import os
+import io
+import sys
+import math
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from PIL import Image, TiffImagePlugin
+
+# Backend dùng chung code model với thư mục src/ (config, model...)
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+import config
+from runtime import create_runner
+from tiling import TiledPredictor
+from volume import VolumeInference
+from prediction_cache import file_fingerprint
+from instrument import span
+from lesion import lesion_stats, stats_to_records
+from ensemble import TTAEnsemble
+
+CLASS_NAMES = ['AMD', 'DME', 'NORMAL']
+RESULT_VERSION = 2
+# Khóa thống kê tổn thương trong kết quả predict_batch (None khi chỉ phân loại)
+LESION_STAT_KEYS = ('lesion_area_px', 'lesion_bbox', 'lesion_thickness_max_px', 'lesion_thickness_mean_px',
+                      'thickness_profile_px', 'severity')
+
+
+def decode_image(data):
+    """Bytes ảnh (PNG/JPEG/TIFF...) -> mảng uint8 xám [H, W]"""
+    return np.asarray(Image.open(io.BytesIO(data)).convert('L'))
+
+
+def encode_mask_png(mask):
+    buffer = io.BytesIO()
+    Image.fromarray(mask).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def write_mask_stack_tiff(masks, path):
+    """
+    Mask stack uint8 [D, H, W] (memmap) -> file TIFF nhiều trang (nén deflate, mask nhị phân nén rất tốt).
+    Ghi từng trang thẳng ra file: RAM chỉ giữ 1 lát, không phụ thuộc số lát của volume.
+    """
+    with TiffImagePlugin.AppendingTiffWriter(path, new=True) as tiff:
+        for mask in masks:
+            Image.fromarray(np.ascontiguousarray(mask)).save(tiff, format='TIFF', compression='tiff_deflate')
+            tiff.newFrame()
+
+
+class Predictor:
+    """
+    Giữ MultiTaskUNet trong bộ nhớ và chạy suy luận theo batch.
+    Nạp model MỘT lần lúc khởi động + warm-up để request đầu tiên không bị chậm.
+    """
+    def __init__(self, weights_path=None, encoder_name="efficientnet-b0", device=None,
+                 img_size=config.IMG_SIZE, threshold=0.5, backend='eager',
+                 tiled=False, tile_overlap=0.25, tile_batch_size=16, tta=(), ensemble=(), temperatures=None):
+        """
+        Args:
+            weights_path: checkpoint .pth (backend 'eager') hoặc artefact export.py
+                          (.pt cho 'torchscript', .onnx cho 'onnx')
+            tiled: True -> suy luận sliding-window ở độ phân giải gốc (tile = img_size, ghép Gaussian)
+                   thay vì resize cả ảnh về img_size; mask + lesion_area_px theo pixel gốc
+            tta: biến đổi TTA (ensemble.TTA_TRANSFORMS, VD: ('hflip', 'bright')); ensemble: list (encoder,
+                 đường dẫn) các model thêm, cùng backend. Có 1 trong 2 -> ensemble.TTAEnsemble: 1 lần forward
+                 batch xếp chồng / model, kết quả kèm độ bất định. temperatures: 1 giá trị / model (fit trên val)
+        """
+        self.device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+        self.backend = backend
+        self.weights_path = weights_path
+        self.encoder_name = encoder_name
+        self.img_size = tuple(img_size)
+        self.threshold = threshold
+        self.tiled = tiled
+        self.tile_overlap = tile_overlap
+        self.tile_batch_size = tile_batch_size
+        self.tta = tuple(tta)
+        self.ensemble = [tuple(member) for member in ensemble]
+        self.temperatures = temperatures
+
+        self._reload_lock = threading.Lock()
+        start = time.perf_counter()
+        self._state, self._signature = self._load()
+        self.load_seconds = time.perf_counter() - start
+
+    def _weights_signature(self):
+        if self.weights_path is None:
+            return None
+        stat = os.stat(self.weights_path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _load(self):
+        """Dựng model/ensemble/tiler/fingerprint vào biến cục bộ; việc công bố do caller làm trong một lần gán."""
+        signature = self._weights_signature()
+        model = create_runner(self.backend, self.weights_path, self.encoder_name, self.device)
+        if self.tta or self.ensemble or self.temperatures:
+            runners = [model] + [create_runner(self.backend, path, encoder, self.device)
+                                 for encoder, path in self.ensemble]
+            model = TTAEnsemble(runners, self.tta, self.temperatures, self.threshold)
+        tiler = TiledPredictor(model, self.img_size, self.tile_overlap, self.tile_batch_size,
+                               device=self.device) if self.tiled else None
+        # Fingerprint = nội dung checkpoint + tham số suy luận -> khóa cache kết quả
+        fingerprint = file_fingerprint(self.weights_path, {
+            'backend': self.backend, 'encoder': self.encoder_name,
+            'img_size': self.img_size, 'threshold': self.threshold,
+            'tiled': self.tiled, 'tile_overlap': self.tile_overlap if self.tiled else None,
+            'tta': self.tta, 'temperatures': self.temperatures,
+            'ensemble': [(encoder, file_fingerprint(path)) for encoder, path in self.ensemble],
+            # Tăng khi đổi các khóa trong kết quả predict_batch -> cache đĩa của phiên bản cũ tự mất hiệu lực
+            'result_version': RESULT_VERSION,
+        })
+        return (model, tiler, fingerprint), signature
+
+    def snapshot(self):
+        """(model, tiler, fingerprint) của cùng một lần nạp -> đọc một lần, không lẫn model mới với fingerprint cũ"""
+        return self._state
+
+    @property
+    def model(self):
+        return self._state[0]
+
+    @property
+    def tiler(self):
+        return self._state[1]
+
+    @property
+    def fingerprint(self):
+        return self._state[2]
+
+    def reload_if_changed(self):
+        """Checkpoint trên đĩa đã đổi (mtime/size) -> nạp lại model. Trả về True nếu có nạp lại."""
+        if self.weights_path is None:
+            return False
+        try:
+            if self._weights_signature() == self._signature:
+                return False
+        except OSError:
+            # Checkpoint tạm thời không có (đang copy / deploy) -> coi như chưa đổi, giữ model hiện tại
+            return False
+        with self._reload_lock:
+            try:
+                if self._weights_signature() == self._signature:
+                    return False
+                state, signature = self._load()
+                # Warmup model mới trước khi công bố -> request không phải chờ cấp phát/chọn kernel
+                self.warmup(model=state[0])
+            except Exception as e:
+                # Checkpoint đang ghi dở / hỏng -> giữ model cũ, lần sau thử lại
+                print(f"CẢNH BÁO: Không nạp lại được {self.weights_path}: {e}")
+                return False
+            self._state, self._signature = state, signature
+            return True
+
+    @torch.inference_mode()
+    def warmup(self, batch_sizes=(1, 4), model=None):
+        # Chạy thử vài kích thước batch để cấp phát bộ nhớ + chọn kernel trước khi nhận request
+        model = model if model is not None else self.model
+        width, height = self.img_size
+        for batch_size in batch_sizes:
+            model(torch.zeros(batch_size, 1, height, width, device=self.device))
+
+    def preprocess(self, image):
+        """uint8 [H, W] (kích thước bất kỳ) -> float32 [1, H', W'] theo IMG_SIZE như lúc chuẩn bị dữ liệu"""
+        img = Image.fromarray(image)
+        if img.size != self.img_size:
+            img = img.resize(self.img_size)
+        return torch.from_numpy(np.asarray(img, dtype=np.float32) / 255.0).unsqueeze(0)
+
+    @torch.inference_mode()
+    def predict_batch(self, images, segment=None):
+        """
+        Args:
+            images: list mảng uint8 [H, W]
+            segment: list bool theo từng ảnh (None = tất cả). Ảnh False chỉ được phân loại (triage):
+                     decoder chỉ chạy trên các ảnh cần mask (backend eager)
+        Returns:
+            list dict: mask (uint8 0/255 [H', W'], hoặc [H, W] gốc khi tiled; None nếu chỉ phân loại),
+                       probabilities, diagnosis, confidence, model_fingerprint (checkpoint đã sinh ra kết quả),
+                       thống kê tổn thương của lesion.lesion_stats (None nếu chỉ phân loại): lesion_area_px,
+                       lesion_bbox, lesion_thickness_max_px, lesion_thickness_mean_px, thickness_profile_px, severity,
+                       uncertainty (TTAEnsemble, không tiled: cls_disagreement, mask_disagreement; còn lại None)
+        """
+        # Giữ tham chiếu model + fingerprint của batch này (reload có thể đổi giữa chừng)
+        model, tiler, fingerprint = self._state
+        logit_threshold = math.log(self.threshold / (1 - self.threshold))
+        segment = [True] * len(images) if segment is None else list(segment)
+        masks = lesion = uncertainty = None
+        if tiler is not None:
+            # Ảnh giữ nguyên kích thước, tile của cả batch được gom chung khi forward
+            with span('predict/preprocess'):
+                scans = [torch.from_numpy(np.asarray(img, dtype=np.float32) / 255.0).unsqueeze(0) for img in images]
+            with span('predict/forward'):
+                seg_logits, cls_logits = tiler(scans)
+            with span('predict/postprocess'):
+                masks = [(s[0] > logit_threshold) for s in seg_logits]
+                # Mỗi ảnh một kích thước -> thống kê từng ảnh
+                lesion = [stats_to_records(lesion_stats(m[None]))[0] for m in masks]
+                masks = [(m.to(torch.uint8) * 255).cpu().numpy() for m in masks]
+        else:
+            with span('predict/preprocess'):
+                batch = torch.stack([self.preprocess(img) for img in images]).to(self.device)
+                flags = all(segment) or (any(segment) and torch.tensor(segment, device=self.device))
+            with span('predict/forward'):
+                if isinstance(model, TTAEnsemble):
+                    seg_logits, cls_logits, uncertainty = model.predict(batch, segment=flags)
+                else:
+                    seg_logits, cls_logits = model(batch, segment=flags)
+            if seg_logits is not None:
+                # Hậu xử lý trên device, chỉ chuyển kết quả cuối về CPU
+                with span('predict/postprocess'):
+                    masks = seg_logits[:, 0] > logit_threshold
+                    lesion = stats_to_records(lesion_stats(masks))
+                    masks = (masks.to(torch.uint8) * 255).cpu().numpy()
+
+        with span('predict/postprocess'):
+            probs = torch.softmax(cls_logits.float(), dim=1)
+            confidence, pred = probs.max(dim=1)
+            probs, confidence, pred = (t.cpu().tolist() for t in (probs, confidence, pred))
+            if uncertainty is not None:
+                uncertainty = {k: v.cpu().tolist() if v is not None else None for k, v in uncertainty.items()}
+
+        results = []
+        for i in range(len(images)):
+            result = {
+                'mask': masks[i] if segment[i] else None,
+                'probabilities': dict(zip(CLASS_NAMES, probs[i])),
+                'diagnosis': CLASS_NAMES[pred[i]],
+                'confidence': confidence[i],
+                'model_fingerprint': fingerprint,
+                'uncertainty': None if uncertainty is None else {
+                    'cls_disagreement': uncertainty['cls_disagreement'][i],
+                    'mask_disagreement': uncertainty['mask_disagreement'][i]
+                    if segment[i] and uncertainty['mask_disagreement'] is not None else None},
+            }
+            result.update(lesion[i] if segment[i] else dict.fromkeys(LESION_STAT_KEYS))
+            results.append(result)
+        return results
+
+    def predict_requests(self, requests):
+        """Cho MicroBatcher: list (ảnh, cần mask?) -> một forward chung, cờ segment theo từng request"""
+        images, segment = zip(*requests)
+        return self.predict_batch(list(images), list(segment))
+
+    def predict_volume(self, volume, batch_size=16, masks_out=None, voxel_size_mm=None, progress=None):
+        """Cả volume (volume.open_volume) -> mask stack + xác suất từng lát + chẩn đoán mức bệnh nhân"""
+        model, _, fingerprint = self._state
+        inference = VolumeInference(model, self.img_size, batch_size, self.threshold, self.device)
+        result = inference(volume, masks_out, voxel_size_mm, progress)
+        result['model_fingerprint'] = fingerprint
+        return result
+
+
+class MicroBatcher:
+    """
+    Gom các request đồng thời thành một batch: đợi tối đa max_wait_ms hoặc đủ max_batch_size ảnh,
+    chạy MỘT lần forward rồi trả kết quả về từng request.
+    Forward chạy trên 1 thread riêng nên event loop vẫn nhận request mới trong lúc model đang chạy.
+    """
+    def __init__(self, predict_fn, max_batch_size=16, max_wait_ms=5.0):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="predictor")
+        self.num_batches = 0
+        self.num_items = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=True)
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # Lấy ngay những request đã chờ sẵn, sau đó mới đợi thêm tới deadline
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            items = [item for item, _ in batch]
+            try:
+                results = await loop.run_in_executor(self._executor, self.predict_fn, items)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.num_batches += 1
+            self.num_items += len(items)
+            for (_, future), result in zip(batch, results):
+                # Client ngắt kết nối -> future đã bị hủy, bỏ qua
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        return {
+            'batches': self.num_batches,
+            'items': self.num_items,
+            'avg_batch_size': self.num_items / self.num_batches if self.num_batches else 0.0,
+            'queue_size': self.queue.qsize() if self.queue is not None else 0,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+        }
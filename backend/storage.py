@@ -0,0 +1,75 @@
+import os
+import re
+import shutil
+
+# Lưu file ảnh upload / mask kết quả. Bản cục bộ thay cho MinIO / S3 (project_spec: storage):
+# object = (bucket, key) -> file root/bucket/key; URL dạng /api/v1/storage/<bucket>/<key> do app.py phục vụ.
+# Đổi sang MinIO chỉ cần một lớp cùng giao diện put / put_file / put_fileobj / get / open_path / delete_prefix.
+
+_SAFE_NAME = re.compile(r'[^A-Za-z0-9._-]+')
+
+
+def safe_name(name):
+    """Tên file từ client -> chỉ giữ ký tự an toàn, bỏ thư mục (chống ../ path traversal)"""
+    name = _SAFE_NAME.sub('_', os.path.basename(name or '')).strip('._')
+    return name or 'file'
+
+
+class LocalObjectStorage:
+    def __init__(self, root, url_prefix="/api/v1/storage"):
+        self.root = os.path.abspath(root)
+        self.url_prefix = url_prefix.rstrip('/')
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, bucket, key):
+        path = os.path.abspath(os.path.join(self.root, bucket, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Key không hợp lệ: {bucket}/{key}")
+        return path
+
+    def put(self, bucket, key, data):
+        """Ghi bytes (nguyên tử: file tạm rồi rename) -> URL của object"""
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return self.url(bucket, key)
+
+    def put_file(self, bucket, key, src_path):
+        """Chuyển file có sẵn (VD: mask stack ghi ra thư mục tạm) vào storage, không đọc vào RAM -> URL"""
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        shutil.move(src_path, tmp_path)
+        os.replace(tmp_path, path)
+        return self.url(bucket, key)
+
+    def put_fileobj(self, bucket, key, fileobj):
+        """Chép file-like (VD: UploadFile.file) vào storage theo từng khối, không đọc cả file vào RAM -> (URL, số byte)"""
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(fileobj, f)
+            size = f.tell()
+        os.replace(tmp_path, path)
+        return self.url(bucket, key), size
+
+    def get(self, bucket, key):
+        with open(self._path(bucket, key), 'rb') as f:
+            return f.read()
+
+    def open_path(self, bucket, key):
+        """Đường dẫn trên đĩa (đọc lười volume bằng volume.open_volume); MinIO -> tải về file tạm"""
+        return self._path(bucket, key)
+
+    def exists(self, bucket, key):
+        return os.path.exists(self._path(bucket, key))
+
+    def url(self, bucket, key):
+        return f"{self.url_prefix}/{bucket}/{key}"
+
+    def delete_prefix(self, bucket, prefix):
+        shutil.rmtree(self._path(bucket, prefix), ignore_errors=True)
@@ -0,0 +1,110 @@
+import math
+import torch
+import torch.nn.functional as F
+
+# Tăng cường dữ liệu theo BATCH (sau collate, ngay trên device của batch), thay cho transform từng mẫu
+# trong worker DataLoader: chi phí không đổi theo số worker, chạy được cả CPU lẫn GPU.
+# Tham số ngẫu nhiên được rút riêng cho từng ảnh trong batch; biến đổi hình học áp dụng CÙNG một
+# tham số cho ảnh và mask. Các bước không được chọn vẫn chạy với tham số đồng nhất (không rẽ nhánh).
+
+
+class BatchAugment:
+    """
+    Áp dụng lên (images float [B, 1, H, W] trong [0, 1], masks float 0/1 [B, C, H, W]):
+      1. Lật ngang (B-scan lật trái/phải vẫn hợp lệ về giải phẫu); lật dọc mặc định tắt
+      2. Affine nhỏ: xoay, co giãn, tịnh tiến (ảnh: bilinear, mask: nearest -> vẫn 0/1)
+      3. Cường độ: độ sáng, tương phản, gamma
+      4. Nhiễu speckle (nhiễu nhân - đặc trưng của ảnh OCT)
+    seed: cố định -> cùng chuỗi batch đầu vào cho ra cùng kết quả (Generator riêng theo device)
+    """
+    def __init__(self, hflip_p=0.5, vflip_p=0.0, affine_p=0.5, max_rotate_deg=5.0, scale_range=(0.95, 1.05),
+                 max_translate=0.05, intensity_p=0.8, brightness=0.1, contrast=0.2, gamma=0.2,
+                 speckle_p=0.5, speckle_sigma=0.1, seed=None):
+        self.hflip_p = hflip_p
+        self.vflip_p = vflip_p
+        self.affine_p = affine_p
+        self.max_rotate = math.radians(max_rotate_deg)
+        self.scale_range = scale_range
+        self.max_translate = max_translate
+        self.intensity_p = intensity_p
+        self.brightness = brightness
+        self.contrast = contrast
+        self.gamma = gamma
+        self.speckle_p = speckle_p
+        self.speckle_sigma = speckle_sigma
+        self.manual_seed(seed)
+
+    def manual_seed(self, seed):
+        self.seed = seed
+        self._generators = {}
+
+    def _generator(self, device):
+        if self.seed is None:
+            return None  # Dùng RNG toàn cục của torch
+        key = str(device)
+        if key not in self._generators:
+            self._generators[key] = torch.Generator(device=device).manual_seed(self.seed)
+        return self._generators[key]
+
+    def state_dict(self):
+        """Trạng thái RNG (resume chính xác từ checkpoint); seed=None dùng RNG toàn cục -> đã lưu riêng"""
+        return {'seed': self.seed, 'generators': {k: g.get_state() for k, g in self._generators.items()}}
+
+    def load_state_dict(self, state):
+        self.manual_seed(state['seed'])
+        for key, generator_state in state['generators'].items():
+            self._generator(torch.device(key)).set_state(generator_state)
+
+    @torch.no_grad()
+    def __call__(self, images, masks):
+        batch_size, _, height, width = images.shape
+        device = images.device
+        generator = self._generator(device)
+
+        def uniform(low, high):
+            return low + (high - low) * torch.rand(batch_size, device=device, generator=generator)
+
+        def chosen(p):
+            return torch.rand(batch_size, device=device, generator=generator) < p
+
+        # 1. Lật
+        for p, dim in ((self.hflip_p, -1), (self.vflip_p, -2)):
+            if p > 0:
+                flip = chosen(p).view(-1, 1, 1, 1)
+                images = torch.where(flip, images.flip(dim), images)
+                masks = torch.where(flip, masks.flip(dim), masks)
+
+        # 2. Affine: ma trận theta trên tọa độ chuẩn hóa [-1, 1] (affine_grid), bù tỉ lệ khung
+        #    để ảnh không vuông vẫn xoay đúng góc. Mẫu không được chọn -> theta đơn vị (giữ nguyên).
+        if self.affine_p > 0:
+            apply = chosen(self.affine_p).float()
+            angle = uniform(-self.max_rotate, self.max_rotate) * apply
+            scale = 1 + (uniform(*self.scale_range) - 1) * apply
+            shift_x = uniform(-self.max_translate, self.max_translate) * 2 * apply
+            shift_y = uniform(-self.max_translate, self.max_translate) * 2 * apply
+            cos, sin = torch.cos(angle) / scale, torch.sin(angle) / scale
+            theta = torch.stack([
+                torch.stack([cos, -sin * height / width, shift_x], dim=1),
+                torch.stack([sin * width / height, cos, shift_y], dim=1),
+            ], dim=1)
+            grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+            images = F.grid_sample(images, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+            masks = F.grid_sample(masks, grid.to(masks.dtype), mode='nearest', padding_mode='zeros',
+                                  align_corners=False)
+
+        # 3. Cường độ (chỉ ảnh): tương phản quanh độ sáng trung bình của từng ảnh, rồi gamma
+        if self.intensity_p > 0:
+            apply = chosen(self.intensity_p).float()
+            brightness = (uniform(-self.brightness, self.brightness) * apply).view(-1, 1, 1, 1)
+            contrast = (1 + uniform(-self.contrast, self.contrast) * apply).view(-1, 1, 1, 1)
+            gamma = (1 + uniform(-self.gamma, self.gamma) * apply).view(-1, 1, 1, 1)
+            mean = images.mean(dim=(1, 2, 3), keepdim=True)
+            images = ((images - mean) * contrast + mean + brightness).clamp(0, 1).pow(gamma)
+
+        # 4. Speckle: I * (1 + sigma * N(0, 1)), sigma rút ngẫu nhiên theo ảnh
+        if self.speckle_p > 0:
+            sigma = (uniform(0, self.speckle_sigma) * chosen(self.speckle_p).float()).view(-1, 1, 1, 1)
+            noise = torch.randn(images.shape, device=device, generator=generator, dtype=images.dtype)
+            images = (images * (1 + sigma * noise)).clamp(0, 1)
+
+        return images, masks
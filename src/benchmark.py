@@ -0,0 +1,729 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+import config
+from runtime import create_runner
+from tiling import TiledPredictor, resize_predict
+from utils import reset_peak_memory, peak_memory_mb
+from augment import BatchAugment
+from model import MultiTaskUNet
+from loss import MultiTaskLoss, masked_dice_bce
+
+# Benchmark hiệu năng (chạy được trên CPU). Mỗi lệnh con là một nhóm benchmark:
+#   python benchmark.py backends --checkpoint ../weights/last.pth --batch-sizes 1 8
+#   python benchmark.py --output ../reports/suite_new.json suite
+#   python benchmark.py compare ../reports/suite_old.json ../reports/suite_new.json
+REPORTS_DIR = os.path.join(config.BASE_DIR, 'reports')
+
+
+def _sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def time_fn(fn, warmup=3, iters=20, device="cpu"):
+    """Chạy fn() warmup lần (bỏ), rồi đo iters lần -> thống kê latency (ms)"""
+    for _ in range(warmup):
+        fn()
+    _sync(device)
+    times = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        fn()
+        _sync(device)
+        times.append((time.perf_counter() - start) * 1000)
+    times = np.asarray(times)
+    return {
+        'mean_ms': float(times.mean()),
+        'p50_ms': float(np.percentile(times, 50)),
+        'p95_ms': float(np.percentile(times, 95)),
+        'min_ms': float(times.min()),
+    }
+
+
+def print_table(rows, columns):
+    widths = [max(len(c), *(len(f"{r[c]:.2f}" if isinstance(r[c], float) else str(r[c])) for r in rows)) + 2
+              for c in columns]
+    print("".join(c.rjust(w) for c, w in zip(columns, widths)))
+    for r in rows:
+        print("".join((f"{r[c]:.2f}" if isinstance(r[c], float) else str(r[c])).rjust(w)
+                      for c, w in zip(columns, widths)))
+
+
+def save_results(results, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"--> Đã ghi kết quả: {path}")
+
+
+# --- BACKENDS: eager vs TorchScript vs ONNX Runtime ---
+
+def bench_backends(args):
+    stem = os.path.splitext(os.path.basename(args.checkpoint))[0]
+    artefacts = {
+        'eager': args.checkpoint if os.path.exists(args.checkpoint) else None,
+        'torchscript': os.path.join(args.export_dir, f"{stem}_{args.encoder}.pt"),
+        'onnx': os.path.join(args.export_dir, f"{stem}_{args.encoder}.onnx"),
+    }
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    width, height = config.IMG_SIZE
+    rows = []
+    for backend in args.backends:
+        path = artefacts[backend]
+        if backend != 'eager' and not os.path.exists(path):
+            print(f"Bỏ qua {backend}: chưa có {path} (chạy export.py trước)")
+            continue
+        runner = create_runner(backend, path, args.encoder, args.device)
+        for batch_size in args.batch_sizes:
+            batch = torch.rand(batch_size, 1, height, width)
+            stats = time_fn(lambda: runner(batch), args.warmup, args.iters, args.device)
+            rows.append({
+                'backend': backend,
+                'batch_size': batch_size,
+                **stats,
+                'throughput_img_s': batch_size * 1000 / stats['mean_ms'],
+            })
+
+    print_table(rows, ['backend', 'batch_size', 'mean_ms', 'p50_ms', 'p95_ms', 'throughput_img_s'])
+    return {'benchmark': 'backends', 'device': args.device, 'threads': torch.get_num_threads(), 'results': rows}
+
+
+# --- TILING: sliding-window ở độ phân giải gốc vs resize về IMG_SIZE ---
+
+def bench_tiling(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    checkpoint = args.checkpoint if os.path.exists(args.checkpoint) else None
+    runner = create_runner('eager', checkpoint, args.encoder, args.device)
+    device = torch.device(args.device)
+    height, width = args.scan_size
+    scans = [torch.rand(1, height, width, device=device) for _ in range(args.num_scans)]
+
+    rows = []
+    reset_peak_memory(device)
+    stats = time_fn(lambda: resize_predict(runner, scans), args.warmup, args.iters, args.device)
+    rows.append({
+        'mode': 'resize', 'overlap': '-', 'tile_batch': '-', 'tiles_per_scan': 1, **stats,
+        'scans_s': args.num_scans * 1000 / stats['mean_ms'],
+        'tiles_s': args.num_scans * 1000 / stats['mean_ms'],
+        'peak_mb': peak_memory_mb(device),
+    })
+
+    for overlap in args.overlaps:
+        for tile_batch_size in args.tile_batch_sizes:
+            tiler = TiledPredictor(runner, config.IMG_SIZE, overlap, tile_batch_size, device=args.device)
+            tiles_per_scan = tiler.count_tiles(height, width)
+            reset_peak_memory(device)
+            stats = time_fn(lambda: tiler(scans), args.warmup, args.iters, args.device)
+            rows.append({
+                'mode': 'tiled', 'overlap': overlap, 'tile_batch': tile_batch_size,
+                'tiles_per_scan': tiles_per_scan, **stats,
+                'scans_s': args.num_scans * 1000 / stats['mean_ms'],
+                'tiles_s': args.num_scans * tiles_per_scan * 1000 / stats['mean_ms'],
+                'peak_mb': peak_memory_mb(device),
+            })
+
+    print(f"{args.num_scans} scan {height}x{width}, tile {config.IMG_SIZE[1]}x{config.IMG_SIZE[0]}")
+    print_table(rows, ['mode', 'overlap', 'tile_batch', 'tiles_per_scan', 'mean_ms', 'scans_s', 'tiles_s', 'peak_mb'])
+    return {'benchmark': 'tiling', 'device': args.device, 'threads': torch.get_num_threads(),
+            'scan_size': [height, width], 'num_scans': args.num_scans, 'results': rows}
+
+
+# --- AUGMENT: chi phí tăng cường theo batch ---
+
+def bench_augment(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    width, height = config.IMG_SIZE
+    augment = BatchAugment(seed=0)
+    rows = []
+    for batch_size in args.batch_sizes:
+        images = torch.rand(batch_size, 1, height, width, device=args.device)
+        masks = (torch.rand(batch_size, 1, height, width, device=args.device) > 0.5).float()
+        stats = time_fn(lambda: augment(images, masks), args.warmup, args.iters, args.device)
+        rows.append({'batch_size': batch_size, **stats,
+                     'us_per_image': stats['mean_ms'] * 1000 / batch_size,
+                     'throughput_img_s': batch_size * 1000 / stats['mean_ms']})
+
+    print_table(rows, ['batch_size', 'mean_ms', 'p95_ms', 'us_per_image', 'throughput_img_s'])
+    return {'benchmark': 'augment', 'device': args.device, 'threads': torch.get_num_threads(), 'results': rows}
+
+
+# --- ROUTING: forward đầy đủ vs chỉ chạy nhánh cần thiết theo từng ảnh ---
+
+def bench_routing(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    model = MultiTaskUNet(encoder_name=args.encoder, encoder_weights=None).to(device)
+    criterion = MultiTaskLoss().to(device)
+    width, height = config.IMG_SIZE
+    batch_size = args.batch_size
+    images = torch.rand(batch_size, 1, height, width, device=device)
+    masks = (torch.rand(batch_size, 1, height, width, device=device) > 0.5).float()
+
+    def train_step(labels, routed):
+        segment, classify = (labels == -1, labels != -1) if routed else (True, True)
+        model.zero_grad(set_to_none=True)
+        seg_pred, cls_pred = model(images, segment=segment, classify=classify)
+        loss, _, _ = criterion(seg_pred, masks, cls_pred, labels)
+        loss.backward()
+
+    rows = []
+    model.train()
+    for fraction in args.chiu_fractions:
+        # n_chiu ảnh đầu có mask (nhãn -1), còn lại là ảnh Srinivasan chỉ có nhãn bệnh
+        n_chiu = int(round(batch_size * fraction))
+        labels = torch.randint(0, 3, (batch_size,), device=device)
+        labels[:n_chiu] = -1
+        for mode in ('full', 'sample'):
+            stats = time_fn(lambda: train_step(labels, mode == 'sample'), args.warmup, args.iters, args.device)
+            rows.append({'phase': 'train', 'mode': mode, 'chiu_fraction': fraction, **stats,
+                         'throughput_img_s': batch_size * 1000 / stats['mean_ms']})
+
+    # Serving: triage chỉ phân loại (segment=False) vs forward đầy đủ
+    model.eval()
+    with torch.inference_mode():
+        for mode, segment in (('full', True), ('classify', False)):
+            stats = time_fn(lambda: model(images, segment=segment), args.warmup, args.iters, args.device)
+            rows.append({'phase': 'infer', 'mode': mode, 'chiu_fraction': '-', **stats,
+                         'throughput_img_s': batch_size * 1000 / stats['mean_ms']})
+
+    print_table(rows, ['phase', 'mode', 'chiu_fraction', 'mean_ms', 'p95_ms', 'throughput_img_s'])
+    return {'benchmark': 'routing', 'device': args.device, 'threads': torch.get_num_threads(),
+            'encoder': args.encoder, 'batch_size': batch_size, 'results': rows}
+
+
+# --- LOSS: Dice+BCE gộp (loss.py) vs BCE cũ trên cả batch vs Dice+BCE để autograd tự ghi ---
+
+def _legacy_seg_loss(seg_pred, seg_target, labels):
+    """Loss segmentation trước đây: BCE trên MỌI ảnh rồi nhân mask is_chiu"""
+    is_chiu = (labels == -1).float()
+    bce = F.binary_cross_entropy_with_logits(seg_pred, seg_target, reduction='none').mean(dim=(1, 2, 3))
+    return (bce * is_chiu).sum() / (is_chiu.sum() + 1e-6)
+
+
+def _unfused_seg_loss(seg_pred, seg_target, labels):
+    """Cùng công thức Dice + BCE với masked_dice_bce nhưng từng phép do autograd ghi lại"""
+    index = torch.nonzero(labels == -1).flatten()
+    x, t = seg_pred.index_select(0, index), seg_target.index_select(0, index)
+    p = torch.sigmoid(x)
+    bce = F.binary_cross_entropy_with_logits(x, t, reduction='none').flatten(1).mean(1)
+    dice = (2 * (p * t).flatten(1).sum(1) + 1) / (p.flatten(1).sum(1) + t.flatten(1).sum(1) + 1)
+    return (bce + 1 - dice).mean()
+
+
+def saved_tensors_mb(fn):
+    """Tổng dung lượng tensor autograd giữ lại cho backward khi chạy fn() (MB)"""
+    total = 0
+
+    def pack(tensor):
+        nonlocal total
+        total += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return total / 2 ** 20
+
+
+def bench_loss(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    width, height = config.IMG_SIZE
+    batch_size = args.batch_size
+    variants = {
+        'legacy_bce': _legacy_seg_loss,
+        'unfused_dice_bce': _unfused_seg_loss,
+        'fused_dice_bce': lambda x, t, labels: masked_dice_bce(x, t, labels == -1),
+    }
+    seg_target = (torch.rand(batch_size, 1, height, width, device=device) > 0.8).float()
+    rows = []
+    for fraction in args.chiu_fractions:
+        n_chiu = max(1, int(round(batch_size * fraction)))
+        labels = torch.randint(0, 3, (batch_size,), device=device)
+        labels[:n_chiu] = -1
+        for name, fn in variants.items():
+            seg_pred = torch.randn(batch_size, 1, height, width, device=device, requires_grad=True)
+
+            def step():
+                seg_pred.grad = None
+                fn(seg_pred, seg_target, labels).backward()
+
+            stats = time_fn(step, args.warmup, args.iters, args.device)
+            saved_mb = saved_tensors_mb(lambda: fn(seg_pred, seg_target, labels))
+            rows.append({'loss': name, 'chiu_fraction': fraction, **stats, 'saved_mb': saved_mb})
+
+    # Toàn bộ MultiTaskLoss (seg + cls, 2 cách đặt trọng số) - chi phí thêm của log_vars
+    labels = torch.randint(0, 3, (batch_size,), device=device)
+    labels[:max(1, batch_size // 4)] = -1
+    cls_pred = torch.randn(batch_size, 3, device=device, requires_grad=True)
+    for weighting in ('fixed', 'uncertainty'):
+        criterion = MultiTaskLoss(uncertainty=weighting == 'uncertainty').to(device)
+        seg_pred = torch.randn(batch_size, 1, height, width, device=device, requires_grad=True)
+        stats = time_fn(lambda: criterion(seg_pred, seg_target, cls_pred, labels)[0].backward(),
+                        args.warmup, args.iters, args.device)
+        saved_mb = saved_tensors_mb(lambda: criterion(seg_pred, seg_target, cls_pred, labels))
+        rows.append({'loss': f'multitask_{weighting}', 'chiu_fraction': 0.25, **stats, 'saved_mb': saved_mb})
+
+    print_table(rows, ['loss', 'chiu_fraction', 'mean_ms', 'p95_ms', 'saved_mb'])
+    return {'benchmark': 'loss', 'device': args.device, 'threads': torch.get_num_threads(),
+            'batch_size': batch_size, 'img_size': [height, width], 'results': rows}
+
+
+# --- SUITE: toàn bộ pipeline + metadata môi trường, so sánh giữa các commit (compare) ---
+
+def environment_info(device):
+    """Metadata để biết 2 lần chạy có so sánh được với nhau không (máy, thư viện, commit)"""
+    import sys
+    import platform
+    import subprocess
+    info = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'hostname': platform.node(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'python': sys.version.split()[0],
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'torch_threads': torch.get_num_threads(),
+        'device': str(device),
+        'cuda': torch.version.cuda if torch.cuda.is_available() else None,
+        'gpu': torch.cuda.get_device_name(device) if device.type == 'cuda' else None,
+        'img_size': list(config.IMG_SIZE),
+    }
+    try:
+        import segmentation_models_pytorch as smp
+        info['segmentation_models_pytorch'] = smp.__version__
+    except ImportError:
+        pass
+    try:
+        def git(*cmd):
+            return subprocess.run(['git', *cmd], cwd=config.BASE_DIR, capture_output=True, text=True,
+                                  timeout=10).stdout.strip()
+        info['git_commit'] = git('rev-parse', 'HEAD') or None
+        info['git_dirty'] = bool(git('status', '--porcelain', '--untracked-files=no')) if info['git_commit'] else None
+    except (OSError, subprocess.SubprocessError):
+        info['git_commit'] = None
+    return info
+
+
+def _suite_decode(args, device):
+    """OCTDataset: __getitem__ (memmap packed / PNG) + collate + decode_batch, trên dữ liệu thật nếu có"""
+    from torch.utils.data import default_collate
+    from dataset import OCTDataset, decode_batch
+    png = OCTDataset(subset=args.subset, packed=False)
+    datasets = {'png': png}
+    if os.path.exists(os.path.join(png.packed_dir, 'meta.json')):
+        datasets['packed'] = OCTDataset(subset=args.subset, packed=True)
+    rows = []
+    for name, dataset in datasets.items():
+        if len(dataset) == 0:
+            print(f"   Bỏ qua decode {name}: chưa có dữ liệu {args.subset}")
+            continue
+        indices = [i % len(dataset) for i in range(args.decode_samples)]
+
+        def load():
+            for start in range(0, len(indices), args.decode_batch_size):
+                images, masks, _ = default_collate([dataset[i] for i in indices[start:start + args.decode_batch_size]])
+                decode_batch(images.to(device), masks.to(device))
+
+        stats = time_fn(load, 1, max(1, args.iters // 4), args.device)
+        rows.append({'id': f'decode/{name}', 'stage': 'decode', 'name': name, **stats,
+                     'samples_s': len(indices) * 1000 / stats['mean_ms']})
+    return rows
+
+
+def _suite_rasterize(args, device):
+    """create_mask_from_layers (1 lát) và create_masks_from_volume (cả volume) trên ranh giới tổng hợp"""
+    from prepare_data import create_mask_from_layers, create_masks_from_volume
+    height, width = args.raster_shape
+    rng = np.random.default_rng(0)
+    # 8 đường ranh giới trơn, tăng dần theo chiều sâu (giống manualLayers1), vài cột NaN
+    base = np.linspace(0.3 * height, 0.7 * height, 8)[:, None, None]
+    wave = 10 * np.sin(np.linspace(0, 4 * np.pi, width))[None, :, None]
+    layers = (base + wave + rng.normal(0, 1, (8, width, args.raster_depth))).astype(np.float32)
+    layers[:, :20] = np.nan
+    rows = []
+    stats = time_fn(lambda: create_mask_from_layers(layers[:, :, 0], (height, width)), args.warmup, args.iters,
+                    args.device)
+    rows.append({'id': 'rasterize/slice', 'stage': 'rasterize', 'name': 'slice', **stats,
+                 'slices_s': 1000 / stats['mean_ms']})
+    stats = time_fn(lambda: create_masks_from_volume(layers, (height, width)), args.warmup, args.iters, args.device)
+    rows.append({'id': 'rasterize/volume', 'stage': 'rasterize', 'name': f'volume_{args.raster_depth}', **stats,
+                 'slices_s': args.raster_depth * 1000 / stats['mean_ms']})
+    return rows
+
+
+def _suite_model(args, device):
+    """MultiTaskUNet: forward (eval) và forward + backward (train) theo encoder x batch size"""
+    width, height = config.IMG_SIZE
+    rows = []
+    for encoder in args.encoders:
+        torch.manual_seed(0)
+        model = MultiTaskUNet(encoder_name=encoder, encoder_weights=None).to(device)
+        for batch_size in args.batch_sizes:
+            images = torch.rand(batch_size, 1, height, width, device=device)
+
+            def forward():
+                with torch.inference_mode():
+                    model(images)
+
+            def forward_backward():
+                model.zero_grad(set_to_none=True)
+                seg_pred, cls_pred = model(images)
+                (seg_pred.float().mean() + cls_pred.float().mean()).backward()
+
+            for mode, fn, train in (('forward', forward, False), ('forward_backward', forward_backward, True)):
+                model.train(train)
+                stats = time_fn(fn, args.warmup, args.iters, args.device)
+                rows.append({'id': f'model/{encoder}/bs{batch_size}/{mode}', 'stage': 'model',
+                             'name': f'{encoder} bs{batch_size} {mode}', **stats,
+                             'throughput_img_s': batch_size * 1000 / stats['mean_ms']})
+        del model
+    return rows
+
+
+def _suite_loss(args, device):
+    """MultiTaskLoss forward + backward (25% ảnh Chiu), trọng số cố định và học được"""
+    width, height = config.IMG_SIZE
+    batch_size = max(args.batch_sizes)
+    generator = torch.Generator().manual_seed(0)
+    seg_target = (torch.rand(batch_size, 1, height, width, generator=generator) > 0.8).float().to(device)
+    seg_pred = torch.randn(batch_size, 1, height, width, generator=generator).to(device).requires_grad_()
+    cls_pred = torch.randn(batch_size, 3, generator=generator).to(device).requires_grad_()
+    labels = torch.randint(0, 3, (batch_size,), generator=generator).to(device)
+    labels[:max(1, batch_size // 4)] = -1
+    rows = []
+    for weighting in ('fixed', 'uncertainty'):
+        criterion = MultiTaskLoss(uncertainty=weighting == 'uncertainty').to(device)
+        stats = time_fn(lambda: criterion(seg_pred, seg_target, cls_pred, labels)[0].backward(),
+                        args.warmup, args.iters, args.device)
+        rows.append({'id': f'loss/{weighting}/bs{batch_size}', 'stage': 'loss', 'name': f'{weighting} bs{batch_size}',
+                     **stats, 'throughput_img_s': batch_size * 1000 / stats['mean_ms']})
+    return rows
+
+
+def _suite_metrics(args, device):
+    """Metric theo batch (không sync host) so với hàm cũ dùng .item()"""
+    from metrics import compute_dice_score, dice_iou_per_sample, MetricAccumulator
+    width, height = config.IMG_SIZE
+    batch_size = max(args.batch_sizes)
+    generator = torch.Generator().manual_seed(0)
+    seg_pred = torch.randn(batch_size, 1, height, width, generator=generator).to(device)
+    masks = (torch.rand(batch_size, 1, height, width, generator=generator) > 0.8).float().to(device)
+    cls_pred = torch.randn(batch_size, 3, generator=generator).to(device)
+    labels = torch.randint(-1, 3, (batch_size,), generator=generator).to(device)
+    meter = MetricAccumulator(device)
+    variants = {
+        'dice_score_item': lambda: [compute_dice_score(seg_pred[i], masks[i]) for i in range(batch_size)],
+        'dice_iou_per_sample': lambda: dice_iou_per_sample(seg_pred, masks),
+        'accumulator_update': lambda: meter.update(seg_pred, masks, cls_pred, labels),
+    }
+    rows = []
+    for name, fn in variants.items():
+        stats = time_fn(fn, args.warmup, args.iters, args.device)
+        rows.append({'id': f'metrics/{name}/bs{batch_size}', 'stage': 'metrics', 'name': name, **stats,
+                     'throughput_img_s': batch_size * 1000 / stats['mean_ms']})
+    return rows
+
+
+def _suite_predictor(args, device):
+    """End-to-end backend: bytes PNG -> decode -> Predictor (tiền xử lý + forward + hậu xử lý) -> PNG mask"""
+    import io
+    import sys
+    from PIL import Image
+    sys.path.insert(0, os.path.join(config.BASE_DIR, 'backend'))
+    from predictor import Predictor, decode_image, encode_mask_png
+    checkpoint = args.checkpoint if os.path.exists(args.checkpoint) else None
+    predictor = Predictor(checkpoint, args.encoders[0], device)
+    height, width = args.raster_shape
+    rng = np.random.default_rng(0)
+    buffer = io.BytesIO()
+    Image.fromarray(rng.integers(0, 256, (height, width), dtype=np.uint8)).save(buffer, format='PNG')
+    data = buffer.getvalue()
+
+    def single():
+        result = predictor.predict_batch([decode_image(data)])[0]
+        encode_mask_png(result['mask'])
+
+    def triage():
+        predictor.predict_batch([decode_image(data)], segment=[False])
+
+    rows = []
+    for name, fn in (('full', single), ('classify', triage)):
+        stats = time_fn(fn, args.warmup, args.iters, args.device)
+        rows.append({'id': f'predictor/{name}', 'stage': 'predictor', 'name': f'{name} {height}x{width}', **stats,
+                     'throughput_img_s': 1000 / stats['mean_ms']})
+    return rows
+
+
+def _suite_instrument(args, device):
+    """Chi phí span (instrument.py): 1000 span rỗng và forward của model khi tắt / bật đo"""
+    import instrument
+    width, height = config.IMG_SIZE
+    batch_size = min(args.batch_sizes)
+    torch.manual_seed(0)
+    model = MultiTaskUNet(encoder_name=args.encoders[0], encoder_weights=None).to(device).eval()
+    images = torch.rand(batch_size, 1, height, width, device=device)
+
+    def empty_spans():
+        for _ in range(1000):
+            with instrument.span('bench'):
+                pass
+
+    def forward():
+        with torch.inference_mode():
+            model(images)
+
+    rows = []
+    for enabled in (False, True):
+        instrument.configure(enabled=enabled)
+        state = 'on' if enabled else 'off'
+        for name, fn in (('span_x1000', empty_spans), (f'forward_bs{batch_size}', forward)):
+            stats = time_fn(fn, args.warmup, args.iters, args.device)
+            rows.append({'id': f'instrument/{name}/{state}', 'stage': 'instrument', 'name': f'{name} {state}',
+                         **stats})
+    instrument.configure(enabled=False)
+    return rows
+
+
+def _suite_lesion(args, device):
+    """lesion.py: thống kê tổn thương cả batch trên device, mã hóa / giải mã mask gọn so với PNG"""
+    import io
+    from PIL import Image
+    from lesion import lesion_stats, stats_to_records, encode_mask, decode_mask
+    width, height = config.IMG_SIZE
+    batch_size = max(args.batch_sizes)
+    # Vài vùng dịch hình elip (giống mask tổn thương thật: thưa, liền khối)
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[:height, :width]
+    masks = np.zeros((batch_size, height, width), dtype=bool)
+    for mask in masks:
+        for _ in range(3):
+            cy, cx, ry, rx = rng.uniform(0.3, 0.7) * height, rng.uniform(0.1, 0.9) * width, \
+                rng.uniform(3, 15), rng.uniform(10, 40)
+            mask |= ((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2 <= 1
+    mask_u8 = masks[0].astype(np.uint8) * 255
+    device_masks = torch.from_numpy(masks).to(device)
+    encoded = encode_mask(mask_u8)
+    buffer = io.BytesIO()
+    Image.fromarray(mask_u8).save(buffer, format='PNG')
+    png = buffer.getvalue()
+
+    def png_encode():
+        Image.fromarray(mask_u8).save(io.BytesIO(), format='PNG')
+
+    rows = []
+    stats = time_fn(lambda: stats_to_records(lesion_stats(device_masks)), args.warmup, args.iters, args.device)
+    rows.append({'id': f'lesion/stats_bs{batch_size}', 'stage': 'lesion', 'name': f'stats_bs{batch_size}', **stats})
+    for name, fn, size in (('encode_rle', lambda: encode_mask(mask_u8), len(encoded)),
+                           ('decode_rle', lambda: decode_mask(encoded), len(encoded)),
+                           ('encode_png', png_encode, len(png)),
+                           ('decode_png', lambda: np.asarray(Image.open(io.BytesIO(png))), len(png))):
+        stats = time_fn(fn, args.warmup, args.iters, 'cpu')
+        rows.append({'id': f'lesion/{name}', 'stage': 'lesion', 'name': name, **stats, 'bytes': size})
+    return rows
+
+
+def _suite_startup(args, device):
+    """
+    Khởi động lạnh: import từng entry point trong một interpreter MỚI (subprocess, không dùng cache module)
+    và load_model từ file trọng số (dựng trên 'meta' + gắn tensor mmap). Mỗi lần đo vài giây -> ít lần lặp.
+    """
+    import sys
+    import tempfile
+    import subprocess
+    from model import load_model
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    backend_dir = os.path.join(config.BASE_DIR, 'backend')
+    entries = {
+        'python': 'pass',
+        'config': 'import config',
+        'runtime': 'import runtime',
+        'smp': 'import segmentation_models_pytorch',
+        'predictor': f'import sys; sys.path.insert(0, {backend_dir!r}); import predictor',
+    }
+    iters = max(1, args.iters // 10)
+    rows = []
+    for name, code in entries.items():
+        stats = time_fn(lambda: subprocess.run([sys.executable, '-c', code], cwd=src_dir, check=True),
+                        1, iters, 'cpu')
+        rows.append({'id': f'startup/import_{name}', 'stage': 'startup', 'name': f'import {name}', **stats})
+
+    encoder = args.encoders[0]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'weights.pth')
+        torch.save(MultiTaskUNet(encoder_name=encoder, encoder_weights=None).state_dict(), path)
+        stats = time_fn(lambda: load_model(path, encoder, device), 1, iters, args.device)
+        rows.append({'id': f'startup/load_model_{encoder}', 'stage': 'startup', 'name': f'load_model {encoder}',
+                     **stats})
+    return rows
+
+
+SUITE_STAGES = {
+    'decode': _suite_decode,
+    'rasterize': _suite_rasterize,
+    'model': _suite_model,
+    'loss': _suite_loss,
+    'metrics': _suite_metrics,
+    'predictor': _suite_predictor,
+    'instrument': _suite_instrument,
+    'lesion': _suite_lesion,
+    'startup': _suite_startup,
+}
+
+
+def bench_suite(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    results = {'benchmark': 'suite', 'environment': environment_info(device),
+               'config': {k: v for k, v in vars(args).items() if k != 'func'}, 'results': []}
+    for stage in args.stages:
+        print(f"--> {stage}")
+        rows = SUITE_STAGES[stage](args, device)
+        results['results'].extend(rows)
+        if rows:
+            print_table(rows, ['name', 'mean_ms', 'p50_ms', 'p95_ms'])
+    return results
+
+
+def bench_compare(args):
+    """
+    So sánh p50_ms (trung vị, ít nhiễu hơn mean) theo 'id' giữa 2 file JSON của suite.
+    Chậm hơn quá --threshold -> hồi quy, exit code 1 (dùng được trong CI).
+    id có ở baseline nhưng mất ở lần chạy hiện tại (stage bị bỏ / bị lỗi) cũng là lỗi (MISSING),
+    trừ khi --allow-missing; id mới chỉ có ở lần chạy hiện tại được liệt kê (new).
+    """
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.current, encoding='utf-8') as f:
+        current = json.load(f)
+    for key in ('torch', 'cpu_count', 'torch_threads', 'device'):
+        old, new = baseline['environment'].get(key), current['environment'].get(key)
+        if old != new:
+            print(f"CẢNH BÁO: môi trường khác nhau ({key}: {old} -> {new}), so sánh có thể không công bằng")
+
+    old_rows = {r['id']: r for r in baseline['results']}
+    current_ids = {r['id'] for r in current['results']}
+    rows, regressions, new_ids = [], [], []
+    for row in current['results']:
+        old = old_rows.get(row['id'])
+        if old is None:
+            new_ids.append(row['id'])
+            rows.append({'id': row['id'], 'baseline_ms': None, 'current_ms': row['p50_ms'], 'ratio': None,
+                         'status': 'new'})
+            continue
+        ratio = row['p50_ms'] / old['p50_ms'] if old['p50_ms'] > 0 else float('inf')
+        status = 'REGRESSION' if ratio > 1 + args.threshold else ('faster' if ratio < 1 - args.threshold else 'ok')
+        rows.append({'id': row['id'], 'baseline_ms': old['p50_ms'], 'current_ms': row['p50_ms'],
+                     'ratio': ratio, 'status': status})
+        if status == 'REGRESSION':
+            regressions.append(row['id'])
+    missing = [r['id'] for r in baseline['results'] if r['id'] not in current_ids]
+    rows += [{'id': id_, 'baseline_ms': old_rows[id_]['p50_ms'], 'current_ms': None, 'ratio': None,
+              'status': 'MISSING'} for id_ in missing]
+
+    print(f"--> {baseline['environment'].get('git_commit')} -> {current['environment'].get('git_commit')}")
+    if rows:
+        print_table(rows, ['id', 'baseline_ms', 'current_ms', 'ratio', 'status'])
+    print(f"--> {len(regressions)} hồi quy (ngưỡng +{args.threshold:.0%}), {len(missing)} id bị mất"
+          f"{' (bỏ qua: --allow-missing)' if missing and args.allow_missing else ''}, {len(new_ids)} id mới")
+    return {'benchmark': 'compare', 'baseline': args.baseline, 'current': args.current,
+            'threshold': args.threshold, 'regressions': regressions, 'missing': missing, 'new': new_ids,
+            'failed': bool(regressions) or (bool(missing) and not args.allow_missing), 'results': rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark hiệu năng OCT Multi-Task")
+    parser.add_argument('--device', default="cpu")
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--output', default=None, help="File JSON kết quả (mặc định: reports/bench_<lệnh>.json)")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('backends', help="So sánh eager / TorchScript / ONNX Runtime")
+    p.add_argument('--checkpoint', default=os.path.join(config.WEIGHTS_DIR, "last.pth"))
+    p.add_argument('--encoder', default="efficientnet-b0")
+    p.add_argument('--export-dir', default=os.path.join(config.WEIGHTS_DIR, 'export'))
+    p.add_argument('--backends', nargs='+', default=['eager', 'torchscript', 'onnx'])
+    p.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8])
+    p.add_argument('--threads', type=int, default=None, help="torch.set_num_threads")
+    p.set_defaults(func=bench_backends)
+
+    p = sub.add_parser('tiling', help="Sliding-window ở độ phân giải gốc vs resize về IMG_SIZE")
+    p.add_argument('--checkpoint', default=os.path.join(config.WEIGHTS_DIR, "last.pth"),
+                   help="Không có file -> trọng số ngẫu nhiên (chỉ đo tốc độ)")
+    p.add_argument('--encoder', default="efficientnet-b0")
+    p.add_argument('--scan-size', type=int, nargs=2, default=[496, 768], metavar=('H', 'W'),
+                   help="Kích thước B-scan gốc (mặc định: Chiu 496x768)")
+    p.add_argument('--num-scans', type=int, default=4)
+    p.add_argument('--overlaps', type=float, nargs='+', default=[0.25, 0.5])
+    p.add_argument('--tile-batch-sizes', type=int, nargs='+', default=[8, 32])
+    p.add_argument('--threads', type=int, default=None, help="torch.set_num_threads")
+    p.set_defaults(func=bench_tiling)
+
+    p = sub.add_parser('augment', help="Chi phí BatchAugment theo kích thước batch")
+    p.add_argument('--batch-sizes', type=int, nargs='+', default=[8, 32])
+    p.add_argument('--threads', type=int, default=None, help="torch.set_num_threads")
+    p.set_defaults(func=bench_augment)
+
+    p = sub.add_parser('routing', help="Forward/backward đầy đủ vs định tuyến theo tác vụ từng ảnh")
+    p.add_argument('--encoder', default="efficientnet-b0")
+    p.add_argument('--batch-size', type=int, default=config.BATCH_SIZE)
+    p.add_argument('--chiu-fractions', type=float, nargs='+', default=[0.0, 0.25, 0.5, 1.0])
+    p.add_argument('--threads', type=int, default=None, help="torch.set_num_threads")
+    p.set_defaults(func=bench_routing)
+
+    p = sub.add_parser('loss', help="Loss segmentation: Dice+BCE gộp vs BCE cũ vs Dice+BCE autograd")
+    p.add_argument('--batch-size', type=int, default=32)
+    p.add_argument('--chiu-fractions', type=float, nargs='+', default=[0.25, 0.5, 1.0])
+    p.add_argument('--threads', type=int, default=None, help="torch.set_num_threads")
+    p.set_defaults(func=bench_loss)
+
+    p = sub.add_parser('suite', help="Toàn bộ pipeline (decode, rasterize, model, loss, metrics, predictor) "
+                                     "+ metadata môi trường")
+    p.add_argument('--stages', nargs='+', default=list(SUITE_STAGES), choices=list(SUITE_STAGES))
+    p.add_argument('--encoders', nargs='+', default=['efficientnet-b0', 'efficientnet-b3'])
+    p.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8])
+    p.add_argument('--subset', default='train', help="Tập dữ liệu cho stage decode")
+    p.add_argument('--decode-samples', type=int, default=64)
+    p.add_argument('--decode-batch-size', type=int, default=config.BATCH_SIZE)
+    p.add_argument('--raster-shape', type=int, nargs=2, default=[496, 768], metavar=('H', 'W'),
+                   help="Kích thước B-scan cho rasterize / predictor (mặc định: Chiu 496x768)")
+    p.add_argument('--raster-depth', type=int, default=61, help="Số lát của volume rasterize")
+    p.add_argument('--checkpoint', default=os.path.join(config.WEIGHTS_DIR, "last.pth"),
+                   help="Cho stage predictor; không có file -> trọng số ngẫu nhiên")
+    p.add_argument('--threads', type=int, default=None, help="torch.set_num_threads")
+    p.set_defaults(func=bench_suite)
+
+    p = sub.add_parser('compare', help="So sánh 2 file kết quả suite (VD: trước / sau một commit)")
+    p.add_argument('baseline')
+    p.add_argument('current')
+    p.add_argument('--threshold', type=float, default=0.10, help="Chậm hơn bao nhiêu thì coi là hồi quy")
+    p.add_argument('--allow-missing', action='store_true',
+                   help="id của baseline không có trong lần chạy hiện tại không làm lệnh thất bại")
+    p.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    results = args.func(args)
+    if args.command == 'compare':
+        if args.output:
+            save_results(results, args.output)
+        raise SystemExit(1 if results['failed'] else 0)
+    save_results(results, args.output or os.path.join(REPORTS_DIR, f"bench_{args.command}.json"))
+
+
+if __name__ == "__main__":
+    main()
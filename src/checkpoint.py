@@ -0,0 +1,311 @@
+import os
+import json
+import random
+import shutil
+import argparse
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import config
+from utils import save_torch_atomic, write_text_atomic
+
+# Quản lý checkpoint huấn luyện:
+#   - Checkpoint ĐẦY ĐỦ (.ckpt): model, optimizer, scheduler, GradScaler, loss (log_vars), augmentation,
+#     trạng thái RNG (python/numpy/torch/cuda), epoch, lịch sử metric -> resume chính xác sau khi bị preempt
+#   - Giữ top-k checkpoint theo metric validation (index.json), tự xóa checkpoint rơi khỏi top-k
+#   - Bản xuất CHỈ TRỌNG SỐ (weights/last.pth, weights/best.pth): nạp nhanh qua mmap cho predictor
+# Ghi file chạy trên 1 thread nền (đúng thứ tự gọi), mỗi file ghi ra file tạm rồi rename (nguyên tử).
+# Trạng thái được chụp sang CPU ngay khi gọi save() nên vòng train tiếp tục cập nhật trọng số được ngay.
+# Xem / xuất:
+#   python checkpoint.py --list
+#   python checkpoint.py --export ../weights/checkpoints/epoch_012.ckpt ../weights/epoch12.pth
+CHECKPOINT_DIR = os.path.join(config.WEIGHTS_DIR, 'checkpoints')
+LAST_CHECKPOINT = 'last.ckpt'
+INDEX_FILE = 'index.json'
+
+
+def _to_cpu(obj):
+    """Sao chép (không chia sẻ bộ nhớ) mọi tensor trong dict/list lồng nhau sang CPU"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    """Chỉ gồm tensor + kiểu Python thuần (không ndarray) -> checkpoint nạp được với weights_only=True"""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'python': random.getstate(), 'numpy': [name, keys.tolist(), pos, has_gauss, cached_gaussian],
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(tuple(state['python']))
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, np.asarray(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def rank_state(augment=None):
+    """Trạng thái ngẫu nhiên RIÊNG của process này (RNG toàn cục + Generator của augmentation)"""
+    return {'rng': rng_state(), 'augment': augment.state_dict() if augment is not None else None}
+
+
+def _reseed_rank(seed, rank, epoch, augment=None):
+    """Không có trạng thái RNG của rank này trong checkpoint -> seed lại tất định theo (seed, rank, epoch)"""
+    sequence = np.random.SeedSequence(None if seed is None else [seed, rank, epoch])
+    global_seed, augment_seed = (int(x) for x in sequence.generate_state(2))
+    random.seed(global_seed)
+    np.random.seed(global_seed)
+    torch.manual_seed(global_seed)
+    if augment is not None and augment.seed is not None:
+        augment.manual_seed(augment_seed)
+
+
+def _load(path, map_location="cpu", trusted=False):
+    """
+    torch.load an toàn (weights_only=True: chỉ tensor + kiểu Python thuần, không chạy code trong pickle).
+    mmap=True: tensor ánh xạ thẳng từ file, không đọc cả file vào RAM trước khi load_state_dict
+    (torch >= 2.1, file định dạng zip mặc định của torch.save); không được thì đọc thường.
+    trusted=True: checkpoint do chính máy này ghi (resume, CLI) -> cho phép nạp pickle đầy đủ khi bản an toàn
+    không nạp được (checkpoint cũ lưu trạng thái RNG numpy dạng ndarray). KHÔNG dùng cho file từ bên ngoài.
+    """
+    try:
+        try:
+            return torch.load(path, map_location=map_location, mmap=True, weights_only=True)
+        except (TypeError, RuntimeError):
+            return torch.load(path, map_location=map_location, weights_only=True)
+    except pickle.UnpicklingError:
+        if not trusted:
+            raise
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+
+def load_weights(path, map_location="cpu", trusted=False):
+    """
+    File trọng số -> state_dict của model. Nhận cả bản xuất chỉ trọng số (.pth) lẫn checkpoint đầy đủ (.ckpt).
+    Luôn nạp ở chế độ weights_only (model.load_model / backend nạp file từ OCT_WEIGHTS), trừ khi trusted.
+    """
+    state = _load(path, map_location, trusted)
+    if isinstance(state, dict) and isinstance(state.get('model'), dict):
+        return state['model']
+    return state
+
+
+class CheckpointManager:
+    """
+    Args:
+        directory: thư mục checkpoint đầy đủ (last.ckpt, epoch_XXX.ckpt, index.json)
+        export_dir: nơi ghi bản chỉ trọng số last.pth / best.pth (None -> không xuất)
+        top_k: số checkpoint tốt nhất được giữ (0 -> chỉ giữ last.ckpt)
+        metric: khóa trong dict metrics truyền vào save(), mode: 'max' / 'min'
+        async_save: False -> ghi ngay trong save() (debug / máy ít RAM)
+    """
+    def __init__(self, directory=CHECKPOINT_DIR, export_dir=config.WEIGHTS_DIR, top_k=3, metric='val_score',
+                 mode='max', async_save=True):
+        if mode not in ('max', 'min'):
+            raise ValueError(f"mode phải là 'max' hoặc 'min', nhận được {mode}")
+        self.directory = directory
+        self.export_dir = export_dir
+        self.top_k = top_k
+        self.metric = metric
+        self.mode = mode
+        os.makedirs(directory, exist_ok=True)
+        if export_dir is not None:
+            os.makedirs(export_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint") if async_save else None
+        self._pending = []
+        self.index = self._read_index()
+
+    # --- Chỉ mục top-k ---
+
+    def _read_index(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        if not os.path.exists(path):
+            return {'metric': self.metric, 'mode': self.mode, 'top_k': [], 'last': None}
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def _rank_key(self, entry):
+        return -entry['value'] if self.mode == 'max' else entry['value']
+
+    @property
+    def best(self):
+        """Entry tốt nhất ({epoch, value, path}) hoặc None"""
+        return self.index['top_k'][0] if self.index['top_k'] else None
+
+    def latest(self):
+        """Đường dẫn checkpoint đầy đủ mới nhất (để resume) hoặc None"""
+        path = os.path.join(self.directory, LAST_CHECKPOINT)
+        return path if os.path.exists(path) else None
+
+    # --- Ghi ---
+
+    def capture(self, epoch, model, optimizer, criterion=None, scheduler=None, scaler=None, augment=None,
+                history=None, rank_states=None):
+        """
+        Chụp toàn bộ trạng thái huấn luyện sang CPU (đồng bộ, trước optimizer.step() kế tiếp).
+        rank_states: DDP -> list rank_state() của mọi process theo rank (distributed.all_gather_object):
+            mỗi process có chuỗi ngẫu nhiên riêng (dropout, augmentation), rank 0 thôi là không đủ để resume
+        """
+        state = {
+            'epoch': epoch,
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'criterion': criterion.state_dict() if criterion is not None else None,
+            'scheduler': scheduler.state_dict() if scheduler is not None else None,
+            'scaler': scaler.state_dict() if scaler is not None else None,
+            'augment': augment.state_dict() if augment is not None else None,
+            'rng': rng_state(),
+            'rank_states': rank_states,
+            'history': list(history or []),
+        }
+        return _to_cpu(state)
+
+    def save(self, state, metrics=None):
+        """
+        Ghi checkpoint của state['epoch'] (từ capture()). metrics chứa self.metric -> xét vào top-k.
+        Returns:
+            True nếu epoch này là tốt nhất từ trước tới giờ
+        """
+        self._raise_failed()
+        epoch = state['epoch']
+        value = (metrics or {}).get(self.metric)
+        last_path = os.path.join(self.directory, LAST_CHECKPOINT)
+
+        # Quyết định top-k ngay (thread chính), việc ghi / xóa file để thread nền làm theo thứ tự
+        keep_path, evicted, is_best = None, [], False
+        if value is not None and self.top_k > 0:
+            entry = {'epoch': epoch, 'value': float(value),
+                     'path': os.path.join(self.directory, f"epoch_{epoch:03d}.ckpt")}
+            # Resume từ checkpoint cũ hơn -> epoch này được chạy lại, bỏ entry cũ của nó
+            previous = [e for e in self.index['top_k'] if e['epoch'] != epoch]
+            ranked = sorted(previous + [entry], key=self._rank_key)
+            self.index['top_k'], evicted = ranked[:self.top_k], ranked[self.top_k:]
+            if any(e is entry for e in self.index['top_k']):
+                keep_path = entry['path']
+                is_best = self.index['top_k'][0] is entry
+            evicted = [e['path'] for e in evicted if e is not entry]
+        self.index['last'] = {'epoch': epoch, 'value': None if value is None else float(value), 'path': last_path}
+        index_text = json.dumps(self.index, indent=2)
+
+        def write():
+            save_torch_atomic(state, last_path)
+            if keep_path is not None:
+                _link_or_copy(last_path, keep_path)
+            if self.export_dir is not None:
+                save_torch_atomic(state['model'], os.path.join(self.export_dir, 'last.pth'))
+                if is_best:
+                    save_torch_atomic(state['model'], os.path.join(self.export_dir, 'best.pth'))
+            write_text_atomic(os.path.join(self.directory, INDEX_FILE), index_text)
+            for path in evicted:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        if self._executor is None:
+            write()
+        else:
+            self._pending = [f for f in self._pending if not f.done() or f.exception() is not None]
+            self._pending.append(self._executor.submit(write))
+        return is_best
+
+    def _raise_failed(self):
+        for future in self._pending:
+            if future.done() and future.exception() is not None:
+                raise RuntimeError("Ghi checkpoint thất bại") from future.exception()
+
+    def wait(self):
+        """Chờ mọi lần ghi đang chạy xong (gọi trước khi thoát process); lỗi ghi được ném ra ở đây"""
+        for future in self._pending:
+            future.result()
+        self._pending = []
+
+    def close(self):
+        self.wait()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    # --- Resume ---
+
+    def restore(self, path, model, optimizer=None, criterion=None, scheduler=None, scaler=None, augment=None,
+                rank=0, world_size=1, seed=None):
+        """
+        Nạp checkpoint đầy đủ vào các đối tượng đã tạo sẵn (cùng cấu hình như lúc lưu) + khôi phục RNG.
+        Nạp lên CPU: trạng thái RNG phải là tensor CPU; model / optimizer tự chuyển về device của tham số.
+        DDP: mỗi rank lấy lại trạng thái ngẫu nhiên của chính nó (rank_states). Checkpoint không có
+        (bản cũ / số process khác lúc lưu) -> rank > 0 được seed lại tất định theo (seed, rank, epoch).
+        Returns:
+            (epoch kế tiếp cần chạy, history)
+        """
+        state = _load(path, trusted=True)
+        model.load_state_dict(state['model'])
+        for obj, key in ((optimizer, 'optimizer'), (criterion, 'criterion'), (scheduler, 'scheduler'),
+                         (scaler, 'scaler'), (augment, 'augment')):
+            if obj is not None and state.get(key) is not None:
+                obj.load_state_dict(state[key])
+        rank_states = state.get('rank_states')
+        if rank_states is not None and len(rank_states) == world_size:
+            own = rank_states[rank]
+            set_rng_state(own['rng'])
+            if augment is not None and own['augment'] is not None:
+                augment.load_state_dict(own['augment'])
+        elif rank == 0:
+            set_rng_state(state['rng'])
+        else:
+            _reseed_rank(seed, rank, state['epoch'] + 1, augment)
+        return state['epoch'] + 1, state.get('history', [])
+
+
+def _link_or_copy(src, dst):
+    """Hard link (không tốn thêm dung lượng / IO); FS không hỗ trợ thì sao chép"""
+    tmp_path = f"{dst}.tmp{os.getpid()}"
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def export_weights(checkpoint_path, output_path, trusted=False):
+    """Checkpoint đầy đủ -> file chỉ trọng số (nạp được bằng load_weights / model.load_model)"""
+    save_torch_atomic(_to_cpu(load_weights(checkpoint_path, trusted=trusted)), output_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Xem / xuất checkpoint huấn luyện")
+    parser.add_argument('--dir', default=CHECKPOINT_DIR)
+    parser.add_argument('--list', action='store_true', help="In top-k và checkpoint mới nhất")
+    parser.add_argument('--export', nargs=2, metavar=('CKPT', 'OUTPUT'),
+                        help="Xuất checkpoint đầy đủ thành file chỉ trọng số")
+    parser.add_argument('--trusted', action='store_true',
+                        help="Cho phép nạp pickle đầy đủ (checkpoint cũ do chính bạn tạo, không dùng cho file lạ)")
+    args = parser.parse_args()
+
+    if args.export:
+        export_weights(*args.export, trusted=args.trusted)
+        print(f"--> Đã xuất trọng số: {args.export[1]}")
+    if args.list or not args.export:
+        path = os.path.join(args.dir, INDEX_FILE)
+        if not os.path.exists(path):
+            print(f"--> Chưa có checkpoint trong {args.dir}")
+            return
+        with open(path, encoding='utf-8') as f:
+            index = json.load(f)
+        print(f"--> Top-{len(index['top_k'])} theo {index['metric']} ({index['mode']}):")
+        for rank, entry in enumerate(index['top_k'], 1):
+            print(f"   {rank}. epoch {entry['epoch']:<4} {entry['value']:.4f}  {entry['path']}")
+        if index['last'] is not None:
+            print(f"--> Mới nhất: epoch {index['last']['epoch']} ({index['last']['path']})")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,13 +9,65 @@ RAW_DATA_DIR = os.path.join(DATA_DIR, 'raw')
 PROCESSED_DATA_DIR = os.path.join(DATA_DIR, 'processed')
 WEIGHTS_DIR = os.path.join(BASE_DIR, 'weights')
 
-# Tạo thư mục nếu chưa có
-os.makedirs(PROCESSED_DATA_DIR, exist_ok=True)
-os.makedirs(WEIGHTS_DIR, exist_ok=True)
+# Không tạo thư mục lúc import (import config phải nhanh, không ghi đĩa - VD: predictor trên ổ chỉ đọc):
+# script nào ghi file thì tự os.makedirs thư mục của file đó
 
 # Hyperparameters chung
 IMG_SIZE = (256, 256)
 BATCH_SIZE = 8  # Chỉnh xuống 4 nếu VRAM yếu
 LEARNING_RATE = 1e-4
 NUM_EPOCHS = 50
-DEVICE = "cuda" # Tự động chuyển cpu nếu không có cuda thì xử lý trong train.py sau
\ No newline at end of file
+DEVICE = "cuda" # Tự động chuyển cpu nếu không có cuda thì xử lý trong train.py sau
+# Trọng số pretrained của encoder khi train từ đầu: "imagenet" (tải về lần đầu) / None (máy offline).
+# Nạp từ checkpoint (resume, load_model) thì không bao giờ tải.
+ENCODER_WEIGHTS = "imagenet"
+
+# Dữ liệu đóng gói (pack_data.py): đọc memmap uint8 thay vì giải mã PNG mỗi epoch
+USE_PACKED_DATA = True
+
+# Chế độ huấn luyện (train.py ghi đè được bằng tham số dòng lệnh)
+AMP_DTYPE = "fp32"      # "fp32" / "bf16" / "fp16" (fp16 dùng kèm GradScaler)
+CHANNELS_LAST = False   # Bộ nhớ NHWC cho MultiTaskUNet (nhanh hơn với Tensor Core / oneDNN)
+GRAD_ACCUM_STEPS = 1    # Batch hiệu dụng = BATCH_SIZE * GRAD_ACCUM_STEPS
+LOG_EVERY = 20         # Số step giữa 2 lần đồng bộ metric về CPU (thanh tqdm)
+AUGMENT = True          # Tăng cường dữ liệu theo batch trên device (augment.py)
+AUGMENT_SEED = None     # Số nguyên -> chuỗi augmentation lặp lại được
+
+# Lấy mẫu batch (sampler.py): trộn Chiu (có mask) / Srinivasan (chỉ nhãn bệnh) theo tỉ lệ cố định
+BALANCED_SAMPLER = True  # False -> shuffle ngẫu nhiên như cũ
+CHIU_FRACTION = 0.25     # Tỉ lệ ảnh Chiu mỗi batch (hoặc tỉ lệ batch Chiu nếu MIX_WITHIN_BATCH = False)
+MIX_WITHIN_BATCH = True  # False -> mỗi batch chỉ một nguồn, batch thuần Srinivasan bỏ qua decoder
+TASK_ROUTING = "sample"   # "off" / "batch" (bỏ decoder khi batch không có ảnh Chiu) / "sample" (theo từng ảnh)
+
+# Loss (loss.py)
+LOSS_WEIGHTING = "uncertainty"  # "fixed" (0.5 seg + 0.5 cls) / "uncertainty" (trọng số tác vụ học được)
+SEG_BCE_WEIGHT = 1.0            # Loss segmentation = BCE_WEIGHT * BCE + DICE_WEIGHT * (1 - Dice)
+SEG_DICE_WEIGHT = 1.0
+
+# Checkpoint (checkpoint.py): weights/checkpoints/*.ckpt (đầy đủ) + weights/last.pth, best.pth (chỉ trọng số)
+CHECKPOINT_TOP_K = 3           # Số checkpoint tốt nhất theo metric validation được giữ lại
+CHECKPOINT_METRIC = "val_score"  # "val_score" (trung bình Dice + Acc) / "val_dice" / "val_acc"
+ASYNC_CHECKPOINT = True        # Ghi checkpoint trên thread nền
+LR_SCHEDULER = "none"          # "none" / "cosine" (CosineAnnealingLR theo epoch)
+SEED = None                    # Số nguyên -> khởi tạo model / thứ tự dữ liệu lặp lại được
+
+# Đo hiệu năng (instrument.py): span theo từng đoạn nóng, tổng kết mỗi epoch ghi vào METRICS_FILE
+INSTRUMENT = False             # True -> đo span (data_wait, h2d, forward, loss, backward...) khi train
+PROFILE_SYNC_CUDA = False      # Đồng bộ CUDA cuối mỗi span (đúng thời gian GPU, chậm hơn)
+METRICS_FILE = os.path.join(BASE_DIR, 'reports', 'train_metrics.jsonl')  # Mỗi epoch 1 dòng JSON
+PROFILE_DIR = os.path.join(BASE_DIR, 'reports', 'profile')               # Chrome trace của --profile-steps
+
+# Huấn luyện phân tán (distributed.py): torchrun --standalone --nproc_per_node N train.py
+DIST_BACKEND = "gloo"  # "gloo" (CPU) / "nccl" (GPU)
+SYNC_BN = False        # BatchNorm đồng bộ giữa các process (batch mỗi process nhỏ)
+
+# DataLoader (data_pipeline.py): train.py / evaluate.py ghi đè được bằng --num-workers
+NUM_WORKERS = 2            # Số process đọc dữ liệu; "auto" -> đo thử và chọn số nhanh nhất trên máy này
+PIN_MEMORY = True          # Chỉ có tác dụng khi chạy CUDA (copy non_blocking host->device)
+PERSISTENT_WORKERS = True  # Giữ worker giữa các epoch (không spawn lại, memmap đã mở được giữ nguyên)
+PREFETCH_FACTOR = 2        # Số batch mỗi worker chuẩn bị trước
+PREFETCH_TO_DEVICE = True  # Đưa batch kế tiếp lên device trong lúc model chạy batch hiện tại
+
+# Thống kê tổn thương (lesion.py): mức độ theo tỉ lệ diện tích tổn thương / diện tích ảnh
+# < 0.2% -> 'None', < 2% -> 'Medium', còn lại -> 'High' (ngưỡng heuristic, chỉnh theo dữ liệu lâm sàng)
+SEVERITY_THRESHOLDS = (0.002, 0.02)
@@ -0,0 +1,220 @@
+import os
+import time
+import queue
+import argparse
+import threading
+import torch
+from torch.utils.data import DataLoader
+import config
+from instrument import span
+
+# Lớp dữ liệu dùng chung cho train/evaluate:
+#   - build_loader: DataLoader theo các nút cấu hình trong config (workers, pin_memory, prefetch...)
+#   - DevicePrefetcher: chồng lấp copy host->device với compute (CUDA stream phụ / thread nền trên CPU)
+#   - autotune_workers: đo mẫu/giây theo số worker trên máy hiện tại và chọn số tốt nhất
+# Đo thử:
+#   python data_pipeline.py --subset train --batch-size 8
+
+
+def parse_workers(value):
+    """'auto' -> tự dò bằng autotune_workers, còn lại là số nguyên >= 0"""
+    if str(value).lower() == 'auto':
+        return 'auto'
+    workers = int(value)
+    if workers < 0:
+        raise argparse.ArgumentTypeError(f"Số worker phải >= 0: {value}")
+    return workers
+
+
+def build_loader(dataset, batch_size, shuffle, device, num_workers=None, pin_memory=None,
+                 persistent_workers=None, prefetch_factor=None, drop_last=False, generator=None,
+                 batch_sampler=None, sampler=None):
+    """
+    DataLoader với giá trị mặc định lấy từ config. Tự bỏ các tham số không hợp lệ:
+    persistent_workers / prefetch_factor chỉ có nghĩa khi num_workers > 0, pin_memory chỉ khi CUDA.
+    batch_sampler (VD: sampler.BalancedBatchSampler) -> bỏ qua batch_size / shuffle / drop_last.
+    sampler (VD: DistributedSampler) -> thay cho shuffle.
+    """
+    device = torch.device(device)
+    num_workers = config.NUM_WORKERS if num_workers is None else num_workers
+    if num_workers == 'auto':
+        num_workers = autotune_workers(dataset, batch_size, device)['best']
+    pin_memory = config.PIN_MEMORY if pin_memory is None else pin_memory
+    kwargs = {}
+    if num_workers > 0:
+        kwargs['persistent_workers'] = config.PERSISTENT_WORKERS if persistent_workers is None else persistent_workers
+        kwargs['prefetch_factor'] = config.PREFETCH_FACTOR if prefetch_factor is None else prefetch_factor
+    if batch_sampler is not None:
+        kwargs['batch_sampler'] = batch_sampler
+    else:
+        kwargs.update(batch_size=batch_size, shuffle=shuffle and sampler is None, drop_last=drop_last,
+                      generator=generator, sampler=sampler)
+    return DataLoader(dataset, num_workers=num_workers, pin_memory=pin_memory and device.type == 'cuda',
+                      **kwargs)
+
+
+def _to_device(batch, device, non_blocking):
+    return [t.to(device, non_blocking=non_blocking) if torch.is_tensor(t) else t for t in batch]
+
+
+class DevicePrefetcher:
+    """
+    Bọc DataLoader: batch k+1 được đưa lên device trong lúc model chạy batch k.
+      - CUDA: copy non_blocking trên một stream phụ (cần pin_memory), stream chính chờ trước khi dùng
+      - CPU: thread nền lấy sẵn queue_size batch (đọc dữ liệu / collate chạy song song với forward)
+    Thời gian copy lên device được ghi vào span prefetch/h2d (instrument), không lẫn vào data_wait / h2d.
+    Giữ len() của loader để train_one_epoch dùng như DataLoader.
+    """
+    def __init__(self, loader, device, queue_size=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.queue_size = queue_size
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._iter_cuda()
+        return self._iter_thread()
+
+    def _iter_cuda(self):
+        stream = torch.cuda.Stream(self.device)
+        iterator = iter(self.loader)
+
+        def load_next():
+            batch = next(iterator, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream), span('prefetch/h2d'):
+                return _to_device(batch, self.device, non_blocking=True)
+
+        next_batch = load_next()
+        while next_batch is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            batch = next_batch
+            for t in batch:
+                # Tensor cấp phát trên stream phụ nhưng dùng trên stream chính -> báo cho allocator
+                if torch.is_tensor(t):
+                    t.record_stream(current)
+            next_batch = load_next()
+            yield batch
+
+    def _iter_thread(self):
+        end = object()
+        batches = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def worker():
+            try:
+                for batch in self.loader:
+                    if self.device.type != 'cpu':
+                        with span('prefetch/h2d'):
+                            batch = _to_device(batch, self.device, non_blocking=False)
+                    if not put(batch):
+                        return
+                put(end)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is end:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Vòng lặp bị break giữa chừng -> dừng thread nền
+            stop.set()
+            thread.join()
+
+
+def autotune_workers(dataset, batch_size, device="cpu", candidates=None, num_batches=20, warmup_batches=3,
+                     verbose=True):
+    """
+    Đo mẫu/giây của DataLoader (chỉ đọc dữ liệu, không chạy model) với từng số worker.
+    Bỏ qua warmup_batches đầu (khởi động process worker). Số worker ít hơn được ưu tiên nếu
+    chậm hơn không quá 5% (ít RAM + CPU dành cho main process).
+    Dataset rỗng / DataLoader không sinh batch nào -> ValueError (thay vì lặp mãi).
+    Returns:
+        dict: best (số worker), results (list {num_workers, samples_s})
+    """
+    if len(dataset) == 0:
+        raise ValueError("Dataset rỗng, không dò được số worker")
+    device = torch.device(device)
+    if candidates is None:
+        max_workers = os.cpu_count() or 1
+        candidates = sorted({0, *[n for n in (1, 2, 4, 6, 8, 12, 16) if n <= max_workers]})
+
+    results = []
+    for num_workers in candidates:
+        # persistent_workers: hết 1 epoch (dataset nhỏ) thì lặp lại mà không spawn lại worker
+        loader = build_loader(dataset, batch_size, True, device, num_workers=num_workers,
+                              persistent_workers=num_workers > 0)
+
+        def batches():
+            while True:
+                empty = True
+                for batch in loader:
+                    empty = False
+                    yield batch
+                if empty:  # VD: drop_last với dataset nhỏ hơn 1 batch -> không bao giờ có batch
+                    raise ValueError(f"DataLoader không sinh batch nào ({len(dataset)} mẫu, batch {batch_size})")
+
+        iterator = batches()
+        for _ in range(warmup_batches):
+            next(iterator)
+        num_samples, start = 0, time.perf_counter()
+        for _ in range(num_batches):
+            num_samples += len(next(iterator)[0])
+        elapsed = time.perf_counter() - start
+        iterator.close()
+        del iterator, loader  # Tắt các process worker trước khi thử cấu hình tiếp theo
+        samples_s = num_samples / elapsed if elapsed > 0 else 0.0
+        results.append({'num_workers': num_workers, 'samples_s': samples_s})
+        if verbose:
+            print(f"   num_workers={num_workers:<3} {samples_s:9.1f} mẫu/s")
+
+    fastest = max(r['samples_s'] for r in results)
+    best = min(r['num_workers'] for r in results if r['samples_s'] >= 0.95 * fastest)
+    if verbose:
+        print(f"--> Chọn num_workers={best}")
+    return {'best': best, 'results': results}
+
+
+def main():
+    from dataset import OCTDataset
+
+    parser = argparse.ArgumentParser(description="Dò số worker DataLoader tốt nhất trên máy hiện tại")
+    parser.add_argument('--subset', default='train', choices=['train', 'val', 'test'])
+    parser.add_argument('--batch-size', type=int, default=config.BATCH_SIZE)
+    parser.add_argument('--workers', type=int, nargs='+', default=None, help="Các số worker cần thử")
+    parser.add_argument('--num-batches', type=int, default=20)
+    args = parser.parse_args()
+
+    device = torch.device(config.DEVICE if torch.cuda.is_available() else "cpu")
+    dataset = OCTDataset(subset=args.subset)
+    print(f"--> {len(dataset)} ảnh {args.subset}, batch {args.batch_size}, {os.cpu_count()} CPU")
+    autotune_workers(dataset, args.batch_size, device, args.workers, args.num_batches)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,98 @@
 import os
+import json
 import torch
 import numpy as np
 from torch.utils.data import Dataset
 from PIL import Image
 import config
+from pack_data import PACKED_DIR, parse_sample_name
 
 class OCTDataset(Dataset):
-    def __init__(self, subset='train', transform=None):
+    def __init__(self, subset='train', transform=None, packed=None):
+        """
+        Args:
+            subset: 'train' / 'val' / 'test'
+            packed: True -> đọc shard .npy đã đóng gói (pack_data.py) qua memmap,
+                    None -> theo config.USE_PACKED_DATA, tự về PNG nếu chưa đóng gói
+        """
         self.img_dir = os.path.join(config.PROCESSED_DATA_DIR, 'images', subset)
         self.mask_dir = os.path.join(config.PROCESSED_DATA_DIR, 'masks', subset)
+        self.packed_dir = os.path.join(PACKED_DIR, subset)
         self.transform = transform
         
         # Mapping nhãn từ tên file
         self.class_map = {'AMD': 0, 'DME': 1, 'NORMAL': 2}
         
-        if os.path.exists(self.img_dir):
-            self.images = sorted([f for f in os.listdir(self.img_dir) if f.endswith('.png')])
+        if packed is None:
+            packed = config.USE_PACKED_DATA and os.path.exists(os.path.join(self.packed_dir, 'meta.json'))
+        self.packed = packed
+
+        if self.packed:
+            self._init_packed()
         else:
-            self.images = []
+            if os.path.exists(self.img_dir):
+                self.images = sorted([f for f in os.listdir(self.img_dir) if f.endswith('.png')])
+            else:
+                self.images = []
+            # Chỉ mục nguồn/nhãn tính MỘT lần từ tên file (giống labels.npy / sources.npy của bản packed)
+            parsed = [parse_sample_name(name) for name in self.images]
+            self.sources = np.array([p[0] for p in parsed], dtype=np.uint8)
+            self.labels = np.array([p[1] for p in parsed], dtype=np.int64)
+
+    def _init_packed(self):
+        with open(os.path.join(self.packed_dir, 'meta.json'), encoding='utf-8') as f:
+            self.meta = json.load(f)
+
+        # Chỉ mục nhãn nhỏ -> đọc hẳn vào RAM
+        self.labels = np.load(os.path.join(self.packed_dir, 'labels.npy'))
+        self.sources = np.load(os.path.join(self.packed_dir, 'sources.npy'))
+        self.shard_offsets = np.cumsum([0] + [s['count'] for s in self.meta['shards']])
+        with open(os.path.join(self.packed_dir, 'names.txt'), encoding='utf-8') as f:
+            self.images = f.read().split('\n')
+
+        # Memmap mở lười (lazy) trong từng process, KHÔNG mở ở đây:
+        # nếu mở sẵn, DataLoader (spawn) sẽ pickle cả mảng sang từng worker
+        self._shards = None
+
+    def _open_shards(self):
+        # mmap_mode='c' (copy-on-write): view ghi được nên torch.from_numpy không cảnh báo,
+        # nhưng không bao giờ ghi ngược xuống file. Page cache được chia sẻ giữa các worker.
+        self._shards = [
+            (np.load(os.path.join(self.packed_dir, s['images']), mmap_mode='c'),
+             np.load(os.path.join(self.packed_dir, s['masks']), mmap_mode='c'))
+            for s in self.meta['shards']
+        ]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
 
     def __len__(self):
         return len(self.images)
 
+    def _get_packed(self, idx):
+        if self._shards is None:
+            self._open_shards()
+
+        shard_idx = np.searchsorted(self.shard_offsets, idx, side='right') - 1
+        offset = idx - self.shard_offsets[shard_idx]
+        images, masks = self._shards[shard_idx]
+
+        # Zero-copy: tensor trỏ thẳng vào vùng memmap, giữ nguyên uint8.
+        # Việc đổi sang float để dành cho decode_batch() sau khi đã gom batch/đưa lên device.
+        image = torch.from_numpy(images[offset]).unsqueeze(0)
+        mask = torch.from_numpy(masks[offset]).unsqueeze(0)
+        label = int(self.labels[idx])
+
+        if self.transform is not None:
+            image, mask = self.transform(image, mask)
+        return image, mask, label
+
     def __getitem__(self, idx):
+        if self.packed:
+            return self._get_packed(idx)
+
         img_name = self.images[idx]
         img_path = os.path.join(self.img_dir, img_name)
         mask_path = os.path.join(self.mask_dir, img_name)
@@ -38,19 +108,17 @@ class OCTDataset(Dataset):
         image = torch.from_numpy(image).float().unsqueeze(0)
         mask = torch.from_numpy(mask).float().unsqueeze(0)
         
-        # 2. XỬ LÝ NHÃN (LABEL PARSING)
-        # Mặc định là -1 (Ignore) cho bộ Chiu
-        label = -1 
+        # 2. NHÃN: lấy từ chỉ mục dựng sẵn lúc khởi tạo (-1 = Chiu, bỏ qua khi tính loss phân loại)
+        # Ảnh Srinivasan có mask giả (đen xì) -> Loss Function bỏ qua nhờ label != -1
+        label = int(self.labels[idx])
         
-        if "Srinivasan" in img_name:
-            # File tên dạng: Srinivasan_AMD_AMD1_01.png
-            for class_name, class_idx in self.class_map.items():
-                if f"_{class_name}_" in img_name:
-                    label = class_idx
-                    break
-            
-            # Nếu là ảnh Srinivasan, Mask là giả (đen xì) -> Đánh dấu để Loss Function biết mà bỏ qua
-            # Ta dùng một cờ (flag) hoặc quy ước đặc biệt. 
-            # Ở đây ta tạm chấp nhận mask đen.
-        
-        return image, mask, label
\ No newline at end of file
+        return image, mask, label
+
+
+def decode_batch(images, masks):
+    """Đổi batch uint8 (chế độ packed) sang float. Batch đã là float (PNG) thì giữ nguyên."""
+    if images.dtype == torch.uint8:
+        images = images.float().div_(255.0)
+    if masks.dtype == torch.uint8:
+        masks = masks.float()
+    return images, masks
@@ -0,0 +1,121 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import tempfile
+import torch
+import torch.optim as optim
+import config
+import distributed
+from dataset import OCTDataset
+from model import MultiTaskUNet
+from loss import MultiTaskLoss
+from sampler import BalancedBatchSampler
+from data_pipeline import build_loader, DevicePrefetcher
+from train import train_one_epoch
+from benchmark import environment_info, print_table, save_results, REPORTS_DIR
+
+# Đo hiệu suất mở rộng của DDP trên MỘT máy CPU: chạy cùng một số step huấn luyện với 1, 2, 4... process
+# (torchrun, gloo), batch mỗi process cố định (weak scaling), số thread mỗi process = số nhân / số process.
+#   python ddp_scaling.py --procs 1 2 4 --batch-size 8 --steps 20
+#   python ddp_scaling.py --procs 1 2 4 --sync-bn
+# Kết quả: ảnh/s, speedup so với 1 process, efficiency = speedup / số process -> reports/ddp_scaling.json
+
+
+def run_worker(args):
+    """Chạy trong mỗi process của torchrun: warmup rồi đo args.steps step của train_one_epoch"""
+    rank, world_size = distributed.init_distributed('gloo', args.threads_per_proc)
+    distributed.silence_non_main(rank == 0)
+    device = torch.device('cpu')
+    torch.manual_seed(0)
+
+    dataset = OCTDataset(subset=args.subset)
+    sampler = BalancedBatchSampler(dataset.sources, dataset.labels, args.batch_size, config.CHIU_FRACTION,
+                                   num_batches=args.warmup * world_size, num_replicas=world_size, rank=rank)
+    loader = DevicePrefetcher(build_loader(dataset, args.batch_size, True, device, args.num_workers,
+                                           batch_sampler=sampler), device)
+
+    model = MultiTaskUNet(encoder_name=args.encoder, encoder_weights=None)
+    if args.sync_bn:
+        model = distributed.convert_sync_batchnorm(model, device)
+    criterion = MultiTaskLoss(uncertainty=True)
+    optimizer = optim.AdamW(list(model.parameters()) + list(criterion.parameters()), lr=config.LEARNING_RATE)
+    if world_size > 1:
+        model = distributed.wrap_ddp(model, device, args.sync_bn)
+
+    def epoch(num_steps, index):
+        sampler.num_batches = num_steps * world_size
+        sampler.set_epoch(index)
+        distributed.barrier()
+        start = time.perf_counter()
+        _, _, _, timing = train_one_epoch(model, loader, criterion, optimizer, device, log_every=10 ** 9,
+                                          task_routing=args.task_routing)
+        distributed.barrier()
+        return time.perf_counter() - start, timing
+
+    epoch(args.warmup, 0)
+    seconds, timing = epoch(args.steps, 1)
+    if rank == 0:
+        images = args.steps * args.batch_size * world_size
+        with open(args.result, 'w', encoding='utf-8') as f:
+            json.dump({'procs': world_size, 'threads_per_proc': torch.get_num_threads(), 'seconds': seconds,
+                       'images': images, 'img_s': images / seconds, 'step_p50_ms': timing['p50_ms']}, f)
+    distributed.cleanup()
+
+
+def run_scaling(args):
+    """Mỗi số process -> một lần torchrun; so sánh ảnh/s với lần chạy 1 process"""
+    rows = []
+    for procs in args.procs:
+        threads = max(1, (os.cpu_count() or 1) // procs) if args.threads_per_proc == 'auto' \
+            else int(args.threads_per_proc)
+        print(f"--> {procs} process x {threads} thread")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result_path = os.path.join(tmp_dir, 'result.json')
+            command = [sys.executable, '-m', 'torch.distributed.run', '--standalone', f'--nproc_per_node={procs}',
+                       os.path.abspath(__file__), '--worker', '--result', result_path,
+                       '--subset', args.subset, '--encoder', args.encoder, '--batch-size', str(args.batch_size),
+                       '--steps', str(args.steps), '--warmup', str(args.warmup),
+                       '--num-workers', str(args.num_workers), '--threads-per-proc', str(threads),
+                       '--task-routing', args.task_routing] + (['--sync-bn'] if args.sync_bn else [])
+            env = dict(os.environ, OMP_NUM_THREADS=str(threads))
+            subprocess.run(command, env=env, check=True)
+            with open(result_path, encoding='utf-8') as f:
+                rows.append(json.load(f))
+
+    base = next((r for r in rows if r['procs'] == 1), rows[0])
+    for r in rows:
+        r['speedup'] = r['img_s'] / base['img_s']
+        r['efficiency'] = r['speedup'] * base['procs'] / r['procs']
+    print_table(rows, ['procs', 'threads_per_proc', 'step_p50_ms', 'img_s', 'speedup', 'efficiency'])
+    return {'benchmark': 'ddp_scaling', 'environment': environment_info(torch.device('cpu')),
+            'config': {k: v for k, v in vars(args).items() if k not in ('worker', 'result')}, 'results': rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo hiệu suất mở rộng DDP (gloo) theo số process trên một máy")
+    parser.add_argument('--procs', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--subset', default='train', choices=['train', 'val', 'test'])
+    parser.add_argument('--encoder', default='efficientnet-b0')
+    parser.add_argument('--batch-size', type=int, default=config.BATCH_SIZE, help="Batch MỖI process")
+    parser.add_argument('--steps', type=int, default=20, help="Số step đo (mỗi process)")
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--num-workers', type=int, default=0)
+    parser.add_argument('--threads-per-proc', default='auto')
+    parser.add_argument('--task-routing', default=config.TASK_ROUTING, choices=['off', 'batch', 'sample'])
+    parser.add_argument('--sync-bn', action='store_true')
+    parser.add_argument('--output', default=os.path.join(REPORTS_DIR, 'ddp_scaling.json'))
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--result', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+    else:
+        save_results(run_scaling(args), args.output)
+
+
+if __name__ == "__main__":
+    main()
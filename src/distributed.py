@@ -0,0 +1,235 @@
+import os
+import inspect
+import builtins
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+# Huấn luyện phân tán nhiều process (DistributedDataParallel) trên máy CPU nhiều nhân, backend gloo.
+# Chạy bằng torchrun (đặt sẵn RANK / WORLD_SIZE / LOCAL_RANK / MASTER_ADDR...):
+#   torchrun --standalone --nproc_per_node 4 train.py --sync-bn
+#   torchrun --nnodes 2 --node_rank 0 --master_addr 10.0.0.1 --nproc_per_node 8 train.py   # nhiều máy
+# Chạy thẳng python train.py -> WORLD_SIZE không có -> 1 process như cũ, các hàm dưới đây không làm gì.
+# Đo hiệu suất mở rộng 1/2/4 process: python ddp_scaling.py --procs 1 2 4
+
+
+def init_distributed(backend="gloo", threads_per_proc="auto"):
+    """
+    Khởi tạo process group nếu được chạy bởi torchrun (WORLD_SIZE > 1).
+    threads_per_proc: số thread intra-op của mỗi process. 'auto' = số nhân / số process trên máy
+        (torchrun mặc định đặt OMP_NUM_THREADS=1 -> mỗi process chỉ dùng 1 nhân nếu không đặt lại).
+    Returns:
+        (rank, world_size)
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', '1'))
+    if world_size <= 1:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    if threads_per_proc == 'auto':
+        threads_per_proc = max(1, (os.cpu_count() or 1) // local_world_size)
+    if int(threads_per_proc) > 0:
+        torch.set_num_threads(int(threads_per_proc))
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def silence_non_main(is_main):
+    """Chỉ rank 0 in log (print(..., force=True) để in từ mọi rank)"""
+    builtin_print = builtins.print
+
+    def print(*args, **kwargs):
+        force = kwargs.pop('force', False)
+        if is_main or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+
+def all_reduce_sum(tensor):
+    """Cộng tensor (in-place) của mọi process; 1 process -> giữ nguyên"""
+    if is_distributed():
+        dist.all_reduce(tensor)
+    return tensor
+
+
+def all_gather_object(obj):
+    """Object Python (pickle được) của mọi process -> list theo rank; 1 process -> [obj]"""
+    if not is_distributed():
+        return [obj]
+    gathered = [None] * dist.get_world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
+
+
+def average_gradients(parameters):
+    """
+    Lấy trung bình gradient của các tham số NGOÀI DDP (VD: log_vars của MultiTaskLoss) giữa các process,
+    gom thành một lần all_reduce. Gọi sau backward, trước optimizer.step().
+    """
+    if not is_distributed():
+        return
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if not grads:
+        return
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def wrap_ddp(model, device, sync_bn=False):
+    """
+    DistributedDataParallel cho MultiTaskUNet. find_unused_parameters: task routing / batch thiếu một nguồn
+    -> decoder hoặc classification_head không nhận gradient ở step đó (đổi theo từng step và từng process).
+    sync_bn: thống kê BN đã giống nhau giữa các process -> bỏ broadcast buffer ở mỗi forward.
+    """
+    device = torch.device(device)
+    kwargs = {'find_unused_parameters': True}
+    if sync_bn:
+        # torch mới đổi tên broadcast_buffers -> forward_sync_buffers
+        parameters = inspect.signature(nn.parallel.DistributedDataParallel.__init__).parameters
+        kwargs['forward_sync_buffers' if 'forward_sync_buffers' in parameters else 'broadcast_buffers'] = False
+    return nn.parallel.DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None,
+                                               **kwargs)
+
+
+# --- SyncBatchNorm cho CPU ---
+# nn.SyncBatchNorm của PyTorch chỉ chạy trên GPU. Bản dưới đây làm cùng việc bằng collective của gloo:
+# forward all_reduce (sum, sum bình phương, số phần tử) theo kênh -> mean / var của cả batch toàn cục;
+# backward all_reduce (sum dy, sum dy * (x - mean)). Gradient weight / bias để cục bộ (DDP tự lấy trung bình).
+# Mọi process phải gọi CÙNG các lớp BN theo cùng thứ tự mỗi step (xem train.py: --sync-bn và task routing).
+
+class _SyncBatchNormFunction(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, input, weight, bias, running_mean, running_var, eps, momentum, group):
+        dims = [0] + list(range(2, input.dim()))
+        # fp16/bf16 (autocast) -> thống kê bằng fp32; fp64 giữ nguyên
+        dtype = torch.promote_types(input.dtype, torch.float32)
+        x = input.to(dtype)
+        local_count = torch.tensor([input.numel() / input.shape[1]], dtype=dtype)
+        stats = torch.cat([x.sum(dims), (x * x).sum(dims), local_count])
+        dist.all_reduce(stats, group=group)
+        channels = input.shape[1]
+        total_sum, total_sq, count = stats[:channels], stats[channels:2 * channels], stats[-1]
+        mean = total_sum / count
+        var = (total_sq / count - mean * mean).clamp_(min=0)
+        invstd = torch.rsqrt(var + eps)
+
+        if running_mean is not None:
+            with torch.no_grad():
+                running_mean.mul_(1 - momentum).add_(mean.to(running_mean.dtype), alpha=momentum)
+                unbiased = var * (count / (count - 1).clamp(min=1))
+                running_var.mul_(1 - momentum).add_(unbiased.to(running_var.dtype), alpha=momentum)
+
+        shape = [1, channels] + [1] * (input.dim() - 2)
+        x_hat = (x - mean.view(shape)) * invstd.view(shape)
+        ctx.save_for_backward(x_hat, weight, invstd, count)
+        ctx.group = group
+        ctx.input_dtype = input.dtype
+        out = x_hat
+        if weight is not None:
+            out = out * weight.to(dtype).view(shape) + bias.to(dtype).view(shape)
+        return out.to(input.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x_hat, weight, invstd, count = ctx.saved_tensors
+        dims = [0] + list(range(2, x_hat.dim()))
+        channels = x_hat.shape[1]
+        shape = [1, channels] + [1] * (x_hat.dim() - 2)
+        dy = grad_output.to(x_hat.dtype)
+        sum_dy = dy.sum(dims)
+        sum_dy_xhat = (dy * x_hat).sum(dims)
+        # weight / bias: gradient cục bộ (DDP all_reduce sau), input: cần tổng toàn cục
+        grad_weight = sum_dy_xhat.to(weight.dtype) if weight is not None else None
+        grad_bias = sum_dy.to(weight.dtype) if weight is not None else None
+        totals = torch.cat([sum_dy, sum_dy_xhat])
+        dist.all_reduce(totals, group=ctx.group)
+        mean_dy = (totals[:channels] / count).view(shape)
+        mean_dy_xhat = (totals[channels:] / count).view(shape)
+        scale = invstd if weight is None else invstd * weight.to(x_hat.dtype)
+        grad_input = (dy - mean_dy - x_hat * mean_dy_xhat) * scale.view(shape)
+        return grad_input.to(ctx.input_dtype), grad_weight, grad_bias, None, None, None, None, None
+
+
+class CPUSyncBatchNorm(nn.modules.batchnorm._BatchNorm):
+    """BatchNorm đồng bộ thống kê giữa các process khi train; eval / 1 process -> BatchNorm thường"""
+    def __init__(self, num_features, eps=1e-5, momentum=0.1, affine=True, track_running_stats=True, group=None):
+        super().__init__(num_features, eps, momentum, affine, track_running_stats)
+        self.group = group
+
+    def _check_input_dim(self, input):
+        if input.dim() < 2:
+            raise ValueError(f"expected at least 2D input (got {input.dim()}D input)")
+
+    def forward(self, input):
+        if not (self.training and is_distributed()):
+            return super().forward(input)
+        momentum = self.momentum
+        if self.track_running_stats:
+            self.num_batches_tracked.add_(1)
+            if self.momentum is None:  # Trung bình tích lũy như BatchNorm gốc
+                momentum = 1.0 / float(self.num_batches_tracked)
+        running_mean = self.running_mean if self.track_running_stats else None
+        running_var = self.running_var if self.track_running_stats else None
+        return _SyncBatchNormFunction.apply(input, self.weight, self.bias, running_mean, running_var,
+                                            self.eps, momentum, self.group)
+
+
+def convert_sync_batchnorm(module, device):
+    """
+    Thay mọi BatchNorm bằng bản đồng bộ: nn.SyncBatchNorm trên GPU, CPUSyncBatchNorm trên CPU
+    (dùng process group riêng để không xen với all_reduce gradient của DDP).
+    """
+    if torch.device(device).type == 'cuda':
+        return nn.SyncBatchNorm.convert_sync_batchnorm(module)
+    group = dist.new_group() if is_distributed() else None
+
+    def convert(child):
+        if isinstance(child, nn.modules.batchnorm._BatchNorm) and not isinstance(child, CPUSyncBatchNorm):
+            sync = CPUSyncBatchNorm(child.num_features, child.eps, child.momentum, child.affine,
+                                    child.track_running_stats, group)
+            # Dùng lại chính tham số / buffer cũ (giữ dtype, device; tên khóa state_dict không đổi)
+            if child.affine:
+                sync.weight, sync.bias = child.weight, child.bias
+            if child.track_running_stats:
+                sync.running_mean, sync.running_var = child.running_mean, child.running_var
+                sync.num_batches_tracked = child.num_batches_tracked
+            sync.train(child.training)
+            return sync
+        for name, grandchild in child.named_children():
+            child.add_module(name, convert(grandchild))
+        return child
+
+    return convert(module)
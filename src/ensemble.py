@@ -0,0 +1,275 @@
+import os
+import time
+import math
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+import config
+from runtime import create_runner, BACKENDS
+
+# Test-time augmentation (TTA) + ensemble nhiều checkpoint / encoder cho ca khó (VD: DME vs AMD sát nhau).
+# Mọi biến thể TTA của batch được xếp chồng thành MỘT batch [T*B, 1, H, W] -> mỗi model chỉ 1 lần forward;
+# seg logits được biến đổi ngược (lật lại...) rồi lấy trung bình xác suất trên device. Xác suất lớp được
+# hiệu chỉnh bằng temperature scaling (fit trên tập val) trước khi lấy trung bình; độ bất đồng giữa các
+# thành viên (model x biến thể) là điểm bất định. TTAEnsemble có cùng giao diện runner (runtime.py) nên
+# Predictor / TiledPredictor / VolumeInference dùng được như một model thường.
+#   python ensemble.py --checkpoints ../weights/best.pth --tta hflip bright dark --fit-temperature
+#   python ensemble.py --checkpoints b0.pth b3.pth --encoders efficientnet-b0 efficientnet-b3 --fit-temperature
+
+# tên: (biến đổi batch ảnh [N, 1, H, W] trong [0, 1], biến đổi ngược trên seg logits [N, 1, H, W]).
+# Không lật dọc: ảnh OCT có hướng cố định (thủy tinh thể ở trên, RPE ở dưới), model không thấy ảnh lộn ngược
+TTA_TRANSFORMS = {
+    'identity': (lambda x: x, lambda y: y),
+    'hflip': (lambda x: x.flip(-1), lambda y: y.flip(-1)),
+    'bright': (lambda x: (x + 0.05).clamp_(0, 1), lambda y: y),
+    'dark': (lambda x: (x - 0.05).clamp_(0, 1), lambda y: y),
+}
+
+
+def _repeat_flags(flags, times):
+    """Cờ segment / classify của batch gốc -> cờ cho batch T biến thể xếp chồng"""
+    if isinstance(flags, bool):
+        return flags
+    return torch.as_tensor(flags).reshape(-1).repeat(times)
+
+
+class TTAEnsemble:
+    """
+    Args:
+        runners: list runner (runtime.create_runner), VD: cùng kiến trúc khác checkpoint, hoặc b0 + b3
+        transforms: tên trong TTA_TRANSFORMS ('identity' luôn có, đứng đầu)
+        temperatures: nhiệt độ của từng runner cho cls logits (fit_temperature), None = 1
+        threshold: ngưỡng mask để tính độ bất đồng giữa các thành viên
+    """
+    def __init__(self, runners, transforms=('hflip',), temperatures=None, threshold=0.5):
+        unknown = [t for t in transforms if t not in TTA_TRANSFORMS]
+        if unknown:
+            raise ValueError(f"Biến đổi TTA không hợp lệ: {unknown} (chọn {list(TTA_TRANSFORMS)})")
+        self.runners = list(runners)
+        self.transforms = ['identity'] + [t for t in dict.fromkeys(transforms) if t != 'identity']
+        self.temperatures = [1.0] * len(self.runners) if temperatures is None else [float(t) for t in temperatures]
+        if len(self.temperatures) != len(self.runners):
+            raise ValueError(f"Cần {len(self.runners)} temperature (1 / runner), nhận {len(self.temperatures)}")
+        self.threshold = threshold
+        self.num_members = len(self.runners) * len(self.transforms)
+
+    def eval(self):
+        return self
+
+    def __call__(self, batch, segment=True, classify=True):
+        seg_logits, cls_logits, _ = self.predict(batch, segment, classify)
+        return seg_logits, cls_logits
+
+    @torch.inference_mode()
+    def predict(self, batch, segment=True, classify=True):
+        """
+        Returns:
+            seg_logits [B, 1, H, W]: logit của xác suất trung bình (ngưỡng logit như model thường) hoặc None
+            cls_logits [B, C]: log của xác suất (đã hiệu chỉnh) trung bình -> softmax ra đúng xác suất đó
+            uncertainty: dict tensor [B] (None nếu nhánh không chạy)
+                cls_disagreement: mutual information giữa các thành viên / log C, 0 = đồng thuận tuyệt đối
+                mask_disagreement: tỉ lệ pixel các thành viên bất đồng trong hợp các mask, 0 = mask trùng khớp
+        """
+        num_transforms, batch_size = len(self.transforms), batch.shape[0]
+        variants = torch.cat([TTA_TRANSFORMS[name][0](batch) for name in self.transforms])
+        segment_flags = _repeat_flags(segment, num_transforms)
+        classify_flags = _repeat_flags(classify, num_transforms)
+
+        seg_probs, cls_probs = [], []
+        for runner, temperature in zip(self.runners, self.temperatures):
+            seg_logits, cls_logits = runner(variants, segment=segment_flags, classify=classify_flags)
+            if seg_logits is not None:
+                seg_logits = seg_logits.float().view(num_transforms, batch_size, *seg_logits.shape[1:])
+                seg_probs += [torch.sigmoid(TTA_TRANSFORMS[name][1](seg_logits[t]))
+                              for t, name in enumerate(self.transforms)]
+            if cls_logits is not None:
+                probs = torch.softmax(cls_logits.float() / temperature, dim=1)
+                cls_probs.append(probs.view(num_transforms, batch_size, -1))
+
+        seg_out = cls_out = mask_disagreement = cls_disagreement = None
+        if seg_probs:
+            seg_probs = torch.stack(seg_probs)                       # [M, B, 1, H, W]
+            seg_out = torch.logit(seg_probs.mean(dim=0), eps=1e-6)
+            votes = (seg_probs > self.threshold).float().mean(dim=0)
+            union = (votes > 0).sum(dim=(1, 2, 3))
+            disagree = ((votes > 0) & (votes < 1)).sum(dim=(1, 2, 3))
+            mask_disagreement = disagree.float() / union.clamp(min=1).float()
+        if cls_probs:
+            cls_probs = torch.cat(cls_probs)                         # [M, B, C]
+            mean_probs = cls_probs.mean(dim=0)
+            cls_out = mean_probs.clamp(min=1e-12).log()
+            # Mutual information = H(trung bình) - trung bình H(từng thành viên)
+            entropy = -(mean_probs * cls_out).sum(dim=1)
+            member_entropy = -(cls_probs * cls_probs.clamp(min=1e-12).log()).sum(dim=2).mean(dim=0)
+            cls_disagreement = ((entropy - member_entropy) / math.log(mean_probs.shape[1])).clamp(min=0)
+        return seg_out, cls_out, {'cls_disagreement': cls_disagreement, 'mask_disagreement': mask_disagreement}
+
+
+def fit_temperature(logits, labels, max_iter=100, bounds=(0.05, 20.0)):
+    """
+    Temperature scaling: T > 0 cực tiểu NLL của softmax(logits / T) trên tập val (LBFGS trên log T).
+    T bị kẹp trong bounds: model sai gần hết tập val sẽ đẩy T -> vô cùng (xác suất đều, vô nghĩa).
+    """
+    # clone(): tensor tạo trong inference_mode (collect_logits) không dùng được cho autograd
+    logits, labels = logits.float().clone(), labels.clone()
+    log_t = torch.zeros(1, requires_grad=True)
+    optimizer = torch.optim.LBFGS([log_t], lr=0.1, max_iter=max_iter)
+    low, high = math.log(bounds[0]), math.log(bounds[1])
+
+    def closure():
+        optimizer.zero_grad()
+        loss = F.cross_entropy(logits / log_t.clamp(low, high).exp(), labels)
+        loss.backward()
+        return loss
+
+    with torch.enable_grad():
+        optimizer.step(closure)
+    return float(log_t.detach().clamp(low, high).exp())
+
+
+def expected_calibration_error(probs, labels, num_bins=15):
+    """ECE: |độ chính xác - độ tin cậy| trung bình theo các bin độ tin cậy, trọng số = số ảnh trong bin"""
+    confidence, pred = probs.max(dim=1)
+    correct = (pred == labels).float()
+    bins = (confidence * num_bins).long().clamp(max=num_bins - 1)
+    count = torch.bincount(bins, minlength=num_bins).float()
+    gap = torch.bincount(bins, weights=correct - confidence, minlength=num_bins).abs()
+    return float(gap.sum() / count.sum().clamp(min=1))
+
+
+@torch.inference_mode()
+def collect_logits(runner, loader, device):
+    """cls logits (1 lần forward, không TTA) + nhãn của các ảnh Srinivasan trong loader -> fit_temperature"""
+    from dataset import decode_batch  # Dữ liệu chỉ cần cho CLI, backend import TTAEnsemble không kéo theo
+    all_logits, all_labels = [], []
+    for images, masks, labels in loader:
+        images, _ = decode_batch(images.to(device), masks)
+        labeled = labels != -1
+        if labeled.any():
+            _, cls_logits = runner(images[labeled.to(device)], segment=False)
+            all_logits.append(cls_logits.float().cpu())
+            all_labels.append(labels[labeled])
+    return torch.cat(all_logits), torch.cat(all_labels)
+
+
+@torch.inference_mode()
+def evaluate_variant(fn, loader, device):
+    """
+    fn(images) -> (seg_logits, cls_logits, uncertainty | None). Dice gộp (Chiu), accuracy / NLL / ECE
+    (Srinivasan), độ bất định trung bình khi dự đoán đúng / sai và latency forward từng batch.
+    """
+    from dataset import decode_batch
+    from metrics import segmentation_stats
+    seg_totals = torch.zeros(3, dtype=torch.float64)
+    probs_all, labels_all, cls_unc, mask_unc, latencies = [], [], [], [], []
+    for images, masks, labels in loader:
+        images, masks = decode_batch(images.to(device), masks.to(device))
+        start = time.perf_counter()
+        seg_logits, cls_logits, uncertainty = fn(images)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        is_chiu = (labels == -1).to(device)
+        stats = torch.stack(segmentation_stats(seg_logits.float(), masks), dim=1)
+        seg_totals += stats[is_chiu].sum(dim=0).double().cpu()
+        labeled = ~is_chiu
+        probs_all.append(torch.softmax(cls_logits.float(), dim=1)[labeled].cpu())
+        labels_all.append(labels[labeled.cpu()])
+        if uncertainty is not None:
+            cls_unc.append(uncertainty['cls_disagreement'][labeled].cpu())
+            mask_unc.append(uncertainty['mask_disagreement'][is_chiu].cpu())
+
+    intersection, pred_sum, true_sum = seg_totals.tolist()
+    probs, labels = torch.cat(probs_all), torch.cat(labels_all)
+    correct = probs.argmax(dim=1) == labels
+    row = {
+        'dice_global': (2 * intersection + 1e-6) / (pred_sum + true_sum + 1e-6) if true_sum + pred_sum else None,
+        'accuracy': float(correct.float().mean()) if len(labels) else None,
+        'nll': float(F.nll_loss(probs.clamp(min=1e-12).log(), labels)) if len(labels) else None,
+        'ece': expected_calibration_error(probs, labels) if len(labels) else None,
+        'latency_ms_p50': float(np.median(latencies[1:] or latencies)),  # Bỏ batch đầu (warmup)
+    }
+    if cls_unc:
+        cls_unc, mask_unc = torch.cat(cls_unc), torch.cat(mask_unc)
+        row['cls_disagreement'] = float(cls_unc.mean()) if len(cls_unc) else None
+        # Độ bất định có ý nghĩa khi ca sai có disagreement cao hơn ca đúng
+        row['cls_disagreement_correct'] = float(cls_unc[correct].mean()) if correct.any() else None
+        row['cls_disagreement_wrong'] = float(cls_unc[~correct].mean()) if (~correct).any() else None
+        row['mask_disagreement'] = float(mask_unc.mean()) if len(mask_unc) else None
+    return row
+
+
+def main():
+    from torch.utils.data import DataLoader
+    from dataset import OCTDataset
+    from benchmark import environment_info, print_table, save_results
+
+    parser = argparse.ArgumentParser(description="TTA + ensemble: độ chính xác, hiệu chỉnh, độ bất định vs latency")
+    parser.add_argument('--checkpoints', nargs='+', default=[os.path.join(config.WEIGHTS_DIR, "last.pth")])
+    parser.add_argument('--encoders', nargs='+', default=["efficientnet-b0"],
+                        help="1 encoder cho mọi checkpoint hoặc 1 encoder / checkpoint")
+    parser.add_argument('--backend', default='eager', choices=BACKENDS)
+    parser.add_argument('--tta', nargs='*', default=['hflip', 'bright', 'dark'], choices=list(TTA_TRANSFORMS))
+    parser.add_argument('--fit-temperature', action='store_true', help="Fit temperature từng model trên tập val")
+    parser.add_argument('--eval-subset', default='test', choices=['val', 'test'])
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--output', default=os.path.join(config.BASE_DIR, 'reports', 'ensemble.json'))
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(config.DEVICE if torch.cuda.is_available() else "cpu")
+    encoders = args.encoders * len(args.checkpoints) if len(args.encoders) == 1 else args.encoders
+    if len(encoders) != len(args.checkpoints):
+        parser.error("--encoders: 1 giá trị hoặc đúng bằng số --checkpoints")
+    runners = [create_runner(args.backend, path, encoder, device) for path, encoder in zip(args.checkpoints, encoders)]
+    eval_dataset = OCTDataset(subset=args.eval_subset)
+    if len(eval_dataset) == 0:
+        parser.error(f"Chưa có dữ liệu {args.eval_subset} (chạy prepare_pipeline.py trước)")
+    eval_loader = DataLoader(eval_dataset, batch_size=args.batch_size, shuffle=False)
+    print(f"--> {len(runners)} model | TTA: {['identity'] + args.tta} | Đánh giá: {len(eval_dataset)} ảnh "
+          f"{args.eval_subset}")
+
+    temperatures = [1.0] * len(runners)
+    if args.fit_temperature:
+        val_loader = DataLoader(OCTDataset(subset='val'), batch_size=args.batch_size, shuffle=False)
+        temperatures = [fit_temperature(*collect_logits(runner, val_loader, device)) for runner in runners]
+        print(f"--> Temperature (val): {[round(t, 3) for t in temperatures]}")
+
+    def single(images):
+        seg_logits, cls_logits = runners[0](images)
+        return seg_logits, cls_logits, None
+
+    variants = {'single': single}
+    if args.fit_temperature:
+        variants['single+T'] = TTAEnsemble(runners[:1], (), temperatures[:1]).predict
+    if args.tta:
+        variants['tta'] = TTAEnsemble(runners[:1], args.tta, temperatures[:1]).predict
+    if len(runners) > 1:
+        variants['ensemble'] = TTAEnsemble(runners, (), temperatures).predict
+        if args.tta:
+            variants['tta+ensemble'] = TTAEnsemble(runners, args.tta, temperatures).predict
+
+    rows = []
+    for name, fn in variants.items():
+        members = fn.__self__.num_members if name != 'single' else 1
+        print(f"--> {name} ({members} thành viên)")
+        rows.append({'variant': name, 'members': members, **evaluate_variant(fn, eval_loader, device)})
+    columns = ['variant', 'members', 'dice_global', 'accuracy', 'nll', 'ece', 'cls_disagreement',
+               'mask_disagreement', 'latency_ms_p50', 'relative_latency']
+    for r in rows:
+        # Chi phí so với 1 lần forward của model đầu tiên
+        r['relative_latency'] = r['latency_ms_p50'] / rows[0]['latency_ms_p50']
+        for c in columns:
+            r.setdefault(c, None)
+    print_table(rows, [c for c in columns if any(r[c] is not None for r in rows)])
+    save_results({'benchmark': 'ensemble', 'environment': environment_info(device),
+                  'config': {**vars(args), 'encoders': encoders}, 'temperatures': temperatures, 'results': rows},
+                 args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,81 +1,247 @@
 import torch
-from torch.utils.data import DataLoader
 import numpy as np
 from tqdm import tqdm
 import os
+import json
+import time
+import argparse
 import config
-from dataset import OCTDataset
-from model import MultiTaskUNet
-from metrics import compute_dice_score, compute_accuracy
+from dataset import OCTDataset, decode_batch
+from model import load_model
+from metrics import segmentation_stats
+from utils import resolve_amp_dtype
+from tiling import TiledPredictor
+from data_pipeline import build_loader, DevicePrefetcher, parse_workers
+from instrument import span, timed_iter
 
-def evaluate():
-    device = torch.device(config.DEVICE if torch.cuda.is_available() else "cpu")
-    print(f"--> Đang kiểm tra trên thiết bị: {device}")
-
-    # 1. Load lại Model tốt nhất (hoặc last.pth)
-    model = MultiTaskUNet(encoder_name="efficientnet-b0", n_classes_seg=1, n_classes_cls=3).to(device)
-    
-    # Ưu tiên load best_model, nếu không có thì load last.pth
-    weights_path = os.path.join(config.WEIGHTS_DIR, "last.pth")
-    if os.path.exists(weights_path):
-        print(f"--> Đang load trọng số từ: {weights_path}")
-        model.load_state_dict(torch.load(weights_path))
-    else:
-        print("LỖI: Chưa có file weights nào!")
-        return
+CLASS_NAMES = ['AMD', 'DME', 'NORMAL']
 
+@torch.inference_mode()
+def run_evaluation(model, loader, device, amp_dtype=None, channels_last=False, smooth=1e-6, progress=True,
+                   tiler=None):
+    """
+    Chạy model trên cả loader theo batch lớn và trả về báo cáo (dict):
+      - Segmentation (ảnh Chiu, label == -1): Dice/IoU gộp + Dice/IoU từng ảnh
+      - Classification (ảnh Srinivasan): confusion matrix, accuracy, precision/recall/F1 từng lớp
+      - Hiệu năng: throughput, latency từng batch (p50/p90/p99)
+    Tách Chiu/Srinivasan bằng mask trên device -> không .item() trong vòng lặp.
+    tiler: TiledPredictor bọc model -> chấm ở độ phân giải gốc của dữ liệu bằng sliding-window.
+    Span (khi instrument bật): eval/data_wait, eval/h2d, eval/decode, eval/forward, eval/metrics.
+    """
     model.eval()
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    num_classes = len(CLASS_NAMES)
 
-    # 2. Load Dữ liệu Test
-    test_dataset = OCTDataset(subset='test') # Hoặc 'val'
-    test_loader = DataLoader(test_dataset, batch_size=1, shuffle=False)
-    
-    print(f"--> Tổng số ảnh kiểm tra: {len(test_dataset)}")
+    confusion = torch.zeros(num_classes * num_classes, dtype=torch.float64, device=device)
+    seg_stats, chiu_flags = [], []
+    batch_latencies, batch_sizes = [], []
+
+    start = time.perf_counter()
+    batches = tqdm(loader, desc="Đang chấm thi", disable=not progress)
+    for images, masks, labels in timed_iter(batches, 'eval/data_wait'):
+        with span('eval/h2d'):
+            images = images.to(device, non_blocking=True)
+            masks = masks.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+        with span('eval/decode'):
+            images, masks = decode_batch(images, masks)
+            images = images.contiguous(memory_format=memory_format)
 
-    # Biến lưu điểm
-    dice_scores_chiu = [] # Chỉ tính Dice cho ảnh Chiu
-    acc_scores_srinivasan = [] # Chỉ tính Acc cho ảnh Srinivasan
-    
-    with torch.no_grad():
-        for images, masks, labels in tqdm(test_loader, desc="Đang chấm thi"):
-            images = images.to(device)
-            masks = masks.to(device)
-            labels = labels.to(device)
-
-            # Forward
-            seg_pred, cls_pred = model(images)
-
-            # --- PHÂN LOẠI ĐỂ CHẤM ĐIỂM ---
-            label_val = labels.item()
-            
-            if label_val == -1: 
-                # ==> Đây là ảnh CHIU (Bài thi Segmentation)
-                dice = compute_dice_score(seg_pred, masks)
-                dice_scores_chiu.append(dice)
+        # Latency chỉ tính phần forward + metric (không tính thời gian đọc dữ liệu)
+        t0 = time.perf_counter()
+        with span('eval/forward'), \
+                torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            if tiler is not None:
+                seg_pred, cls_pred = tiler(images)
+                seg_pred = torch.stack(seg_pred)
             else:
-                # ==> Đây là ảnh SRINIVASAN (Bài thi Classification)
-                acc = compute_accuracy(cls_pred, labels)
-                acc_scores_srinivasan.append(acc)
+                seg_pred, cls_pred = model(images)
+
+        with span('eval/metrics'):
+            is_chiu = labels == -1
+            intersection, pred_sum, true_sum = segmentation_stats(seg_pred.float(), masks)
+            seg_stats.append(torch.stack([intersection, pred_sum, true_sum], dim=1))
+            chiu_flags.append(is_chiu)
+
+            # Confusion matrix: ảnh Chiu có trọng số 0 (label -1 kẹp về 0 cho hợp lệ chỉ số)
+            pred_labels = cls_pred.argmax(dim=1)
+            index = labels.clamp(min=0) * num_classes + pred_labels
+            confusion += torch.bincount(index, weights=(~is_chiu).double(), minlength=num_classes * num_classes)
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        batch_latencies.append(time.perf_counter() - t0)
+        batch_sizes.append(images.shape[0])
+    wall_seconds = time.perf_counter() - start
+
+    # --- Quy về CPU MỘT lần ---
+    num_images = int(sum(batch_sizes))
+    report = {'num_images': num_images}
+
+    if len(seg_stats) > 0:
+        seg_stats = torch.cat(seg_stats).double().cpu()
+        chiu_flags = torch.cat(chiu_flags).cpu()
+    else:
+        seg_stats = torch.zeros(0, 3, dtype=torch.float64)
+        chiu_flags = torch.zeros(0, dtype=torch.bool)
+
+    chiu_indices = torch.nonzero(chiu_flags).flatten()
+    chiu_stats = seg_stats[chiu_flags]
+    inter, pred_sum, true_sum = chiu_stats.unbind(dim=1)
+    dice = (2. * inter + smooth) / (pred_sum + true_sum + smooth)
+    iou = (inter + smooth) / (pred_sum + true_sum - inter + smooth)
+    names = getattr(loader.dataset, 'images', None)
+    report['segmentation'] = {
+        'num_images': int(chiu_flags.sum()),
+        'dice_global': float((2. * inter.sum() + smooth) / (pred_sum.sum() + true_sum.sum() + smooth)) if len(dice) else None,
+        'iou_global': float((inter.sum() + smooth) / (pred_sum.sum() + true_sum.sum() - inter.sum() + smooth)) if len(iou) else None,
+        'dice_mean': float(dice.mean()) if len(dice) else None,
+        'dice_std': float(dice.std()) if len(dice) > 1 else None,
+        'iou_mean': float(iou.mean()) if len(iou) else None,
+        # Tổng pixel (cộng được giữa các shard dữ liệu, VD: validation phân tán trong train.py)
+        'intersection_px': float(inter.sum()),
+        'pred_px': float(pred_sum.sum()),
+        'true_px': float(true_sum.sum()),
+        'per_image': [
+            {'index': int(i), 'name': names[i] if names else None, 'dice': float(d), 'iou': float(j)}
+            for i, d, j in zip(chiu_indices.tolist(), dice.tolist(), iou.tolist())
+        ],
+    }
+
+    confusion = confusion.view(num_classes, num_classes).cpu().numpy().astype(np.int64)
+    total = int(confusion.sum())
+    tp = np.diag(confusion)
+    precision = tp / np.maximum(confusion.sum(axis=0), 1)
+    recall = tp / np.maximum(confusion.sum(axis=1), 1)
+    f1 = 2 * precision * recall / np.maximum(precision + recall, 1e-12)
+    report['classification'] = {
+        'num_images': total,
+        'accuracy': float(tp.sum() / total) if total > 0 else None,
+        'class_names': CLASS_NAMES,
+        'confusion_matrix': confusion.tolist(),  # Hàng: nhãn thật, cột: dự đoán
+        'per_class': {
+            name: {'precision': float(precision[k]), 'recall': float(recall[k]),
+                   'f1': float(f1[k]), 'support': int(confusion[k].sum())}
+            for k, name in enumerate(CLASS_NAMES)
+        },
+    }
 
-    # 3. Báo cáo kết quả tách biệt
+    latencies_ms = np.asarray(batch_latencies) * 1000
+    per_image_ms = latencies_ms / np.maximum(np.asarray(batch_sizes), 1)
+    report['performance'] = {
+        'wall_seconds': wall_seconds,
+        'throughput_img_s': num_images / wall_seconds if wall_seconds > 0 else 0.0,
+        'batch_latency_ms': _percentiles(latencies_ms),
+        'per_image_latency_ms': _percentiles(per_image_ms),
+    }
+    return report
+
+def _percentiles(values):
+    if len(values) == 0:
+        return {'mean': None, 'p50': None, 'p90': None, 'p99': None}
+    return {
+        'mean': float(np.mean(values)),
+        'p50': float(np.percentile(values, 50)),
+        'p90': float(np.percentile(values, 90)),
+        'p99': float(np.percentile(values, 99)),
+    }
+
+def print_report(report):
+    # Báo cáo kết quả tách biệt
     print("\n" + "="*40)
     print("   BẢNG ĐIỂM CHI TIẾT (REPORT)")
     print("="*40)
-    
-    if len(dice_scores_chiu) > 0:
-        avg_dice = np.mean(dice_scores_chiu)
-        print(f"✅ SEGMENTATION (Tập Chiu - {len(dice_scores_chiu)} ảnh):")
-        print(f"   Mean Dice Score: {avg_dice:.4f} ")
+
+    seg = report['segmentation']
+    if seg['num_images'] > 0:
+        print(f"✅ SEGMENTATION (Tập Chiu - {seg['num_images']} ảnh):")
+        print(f"   Mean Dice Score: {seg['dice_mean']:.4f} | Global Dice: {seg['dice_global']:.4f}")
+        print(f"   Mean IoU: {seg['iou_mean']:.4f} | Global IoU: {seg['iou_global']:.4f}")
     else:
         print("⚠️ Không tìm thấy ảnh Chiu trong tập Test.")
 
-    if len(acc_scores_srinivasan) > 0:
-        avg_acc = np.mean(acc_scores_srinivasan)
-        print(f"✅ CLASSIFICATION (Tập Srinivasan - {len(acc_scores_srinivasan)} ảnh):")
-        print(f"   Accuracy: {avg_acc:.4f} ({avg_acc*100:.2f}%)")
+    cls = report['classification']
+    if cls['num_images'] > 0:
+        acc = cls['accuracy']
+        print(f"✅ CLASSIFICATION (Tập Srinivasan - {cls['num_images']} ảnh):")
+        print(f"   Accuracy: {acc:.4f} ({acc*100:.2f}%)")
+        print(f"   Confusion matrix (hàng: thật, cột: dự đoán) {cls['class_names']}:")
+        for name, row in zip(cls['class_names'], cls['confusion_matrix']):
+            print(f"     {name:<7}{row}")
     else:
         print("⚠️ Không tìm thấy ảnh Srinivasan trong tập Test.")
+
+    perf = report['performance']
+    if report['num_images'] > 0:
+        print(f"⏱️ Throughput: {perf['throughput_img_s']:.1f} ảnh/s | Batch latency "
+              f"p50={perf['batch_latency_ms']['p50']:.1f}ms p99={perf['batch_latency_ms']['p99']:.1f}ms")
     print("="*40)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Đánh giá Multi-Task U-Net theo batch")
+    parser.add_argument('--checkpoint', default=None,
+                        help="Mặc định: weights/best.pth (tốt nhất theo validation), chưa có thì last.pth")
+    parser.add_argument('--encoder', default="efficientnet-b0")
+    parser.add_argument('--subset', default='test', choices=['train', 'val', 'test'])
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--num-workers', type=parse_workers, default=config.NUM_WORKERS,
+                        help="Số worker DataLoader, 'auto' = đo thử và chọn số nhanh nhất")
+    parser.add_argument('--no-prefetch', dest='prefetch', action='store_false', default=config.PREFETCH_TO_DEVICE)
+    parser.add_argument('--amp', default='fp32', choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--tiled', action='store_true',
+                        help="Sliding-window theo tile IMG_SIZE (dữ liệu chuẩn bị ở độ phân giải gốc, "
+                             "VD: prepare_pipeline.py --img-size 768 496)")
+    parser.add_argument('--tile-overlap', type=float, default=0.25)
+    parser.add_argument('--tile-batch-size', type=int, default=16)
+    parser.add_argument('--report', default=None,
+                        help="File JSON kết quả (mặc định: reports/eval_<subset>.json)")
+    return parser.parse_args()
+
+def evaluate():
+    args = parse_args()
+    device = torch.device(config.DEVICE if torch.cuda.is_available() else "cpu")
+    print(f"--> Đang kiểm tra trên thiết bị: {device}")
+    if args.checkpoint is None:
+        best_path = os.path.join(config.WEIGHTS_DIR, "best.pth")
+        args.checkpoint = best_path if os.path.exists(best_path) else os.path.join(config.WEIGHTS_DIR, "last.pth")
+
+    # 1. Load Model từ checkpoint được chọn
+    if not os.path.exists(args.checkpoint):
+        print(f"LỖI: Không tìm thấy file weights: {args.checkpoint}")
+        return
+    print(f"--> Đang load trọng số từ: {args.checkpoint} ({args.encoder})")
+    model = load_model(args.checkpoint, args.encoder, device)
+
+    # 2. Load Dữ liệu
+    test_dataset = OCTDataset(subset=args.subset)
+    test_loader = build_loader(test_dataset, args.batch_size, False, device, args.num_workers,
+                               persistent_workers=False)
+    if args.prefetch:
+        test_loader = DevicePrefetcher(test_loader, device)
+    print(f"--> Tổng số ảnh kiểm tra: {len(test_dataset)}")
+
+    tiler = TiledPredictor(model, config.IMG_SIZE, args.tile_overlap, args.tile_batch_size,
+                           device=device) if args.tiled else None
+    report = run_evaluation(model, test_loader, device, resolve_amp_dtype(args.amp, device), tiler=tiler)
+    report['meta'] = {
+        'checkpoint': os.path.abspath(args.checkpoint),
+        'encoder': args.encoder,
+        'subset': args.subset,
+        'batch_size': args.batch_size,
+        'amp': args.amp,
+        'tiled': args.tiled,
+        'tile_overlap': args.tile_overlap if args.tiled else None,
+        'device': str(device),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    print_report(report)
+
+    # 3. Ghi báo cáo JSON
+    report_path = args.report or os.path.join(config.BASE_DIR, 'reports', f"eval_{args.subset}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"--> Đã ghi báo cáo: {report_path}")
+
 if __name__ == "__main__":
-    evaluate()
\ No newline at end of file
+    evaluate()
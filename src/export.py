@@ -0,0 +1,98 @@
+import os
+import sys
+import inspect
+import argparse
+import torch
+import config
+from model import load_model
+from runtime import TorchScriptRunner, OnnxRunner, ONNX_INPUT, ONNX_OUTPUTS
+
+# Xuất MultiTaskUNet (2 đầu ra) sang TorchScript / ONNX với batch động, rồi kiểm tra
+# sai số so với eager. Ví dụ:
+#   python export.py --checkpoint ../weights/last.pth --formats torchscript onnx
+EXPORT_DIR = os.path.join(config.WEIGHTS_DIR, 'export')
+
+
+def export_torchscript(model, path, example):
+    # Trace ở chế độ eval: Dropout của classification_head thành no-op trong graph
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), example)
+    traced.save(path)
+    return path
+
+
+def export_onnx(model, path, example, opset=17):
+    kwargs = {}
+    # torch >= 2.5 mặc định có thể dùng exporter dynamo; graph trace cũ ổn định hơn với smp
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    dynamic_axes = {name: {0: 'batch'} for name in [ONNX_INPUT] + ONNX_OUTPUTS}
+    torch.onnx.export(
+        model.eval(), (example,), path,
+        input_names=[ONNX_INPUT], output_names=ONNX_OUTPUTS,
+        dynamic_axes=dynamic_axes, opset_version=opset, **kwargs,
+    )
+    return path
+
+
+@torch.inference_mode()
+def check_parity(runner, model, img_size=config.IMG_SIZE, batch_sizes=(1, 3), atol=1e-4, seed=0):
+    """So sánh runner với model eager trên nhiều kích thước batch (kiểm tra luôn batch động)"""
+    generator = torch.Generator().manual_seed(seed)
+    width, height = img_size
+    results = []
+    for batch_size in batch_sizes:
+        batch = torch.rand(batch_size, 1, height, width, generator=generator)
+        ref_seg, ref_cls = model(batch)
+        seg, cls = runner(batch)
+        seg_diff = (seg.cpu() - ref_seg).abs().max().item()
+        cls_diff = (cls.cpu() - ref_cls).abs().max().item()
+        results.append({
+            'batch_size': batch_size,
+            'seg_max_abs_diff': seg_diff,
+            'cls_max_abs_diff': cls_diff,
+            'ok': seg_diff <= atol and cls_diff <= atol,
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Xuất MultiTaskUNet sang TorchScript / ONNX")
+    parser.add_argument('--checkpoint', default=os.path.join(config.WEIGHTS_DIR, "last.pth"))
+    parser.add_argument('--encoder', default="efficientnet-b0")
+    parser.add_argument('--formats', nargs='+', default=['torchscript', 'onnx'], choices=['torchscript', 'onnx'])
+    parser.add_argument('--out-dir', default=EXPORT_DIR)
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--atol', type=float, default=1e-4, help="Sai số tuyệt đối tối đa cho phép so với eager")
+    args = parser.parse_args()
+
+    # Xuất luôn trên CPU: artefact dùng cho máy chủ CPU và không dính device lúc trace
+    model = load_model(args.checkpoint, args.encoder, "cpu")
+    width, height = config.IMG_SIZE
+    example = torch.rand(2, 1, height, width)
+    os.makedirs(args.out_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(args.checkpoint))[0]
+
+    all_ok = True
+    for fmt in args.formats:
+        if fmt == 'torchscript':
+            path = export_torchscript(model, os.path.join(args.out_dir, f"{stem}_{args.encoder}.pt"), example)
+            runner = TorchScriptRunner(path)
+        else:
+            path = export_onnx(model, os.path.join(args.out_dir, f"{stem}_{args.encoder}.onnx"), example, args.opset)
+            runner = OnnxRunner(path)
+
+        print(f"--> Đã xuất {fmt}: {path} ({os.path.getsize(path) / 2**20:.1f}MB)")
+        for r in check_parity(runner, model, atol=args.atol):
+            status = "✅" if r['ok'] else "❌"
+            print(f"   {status} batch={r['batch_size']}: seg max|Δ|={r['seg_max_abs_diff']:.2e}, "
+                  f"cls max|Δ|={r['cls_max_abs_diff']:.2e}")
+            all_ok = all_ok and r['ok']
+
+    if not all_ok:
+        print(f"LỖI: Sai số vượt ngưỡng atol={args.atol}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import bisect
+import threading
+import torch
+
+# Đo thời gian theo "span" có tên quanh các đoạn nóng (chờ dữ liệu, copy H2D, encoder/decoder/head,
+# loss, backward, optimizer, metric...) dùng chung cho train / evaluate / backend.
+#   instrument.configure(enabled=True)         # bật (mặc định tắt)
+#   with instrument.span('forward'): ...
+#   instrument.summary()                       # count / mean / p50 / p95 / p99 / histogram theo tên
+# Khi TẮT: span() trả về một context rỗng dùng chung (1 phép so sánh + 1 lời gọi hàm), không cấp phát gì.
+# Khi BẬT và đang có torch.profiler chạy, mỗi span còn là record_function -> hiện tên trong trace.
+# CUDA chạy bất đồng bộ: không có sync_cuda thì thời gian GPU bị tính vào span đồng bộ kế tiếp
+# (thường là metrics / optimizer); sync_cuda=True chính xác hơn nhưng làm chậm vòng lặp.
+
+# Biên các bucket histogram (ms); bucket cuối là +inf
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Stat:
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count, self.total = 0, 0.0
+        self.min, self.max = float('inf'), 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, ms):
+        self.count += 1
+        self.total += ms
+        self.min = min(self.min, ms)
+        self.max = max(self.max, ms)
+        self.buckets[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+
+    def percentile(self, q):
+        """Ước lượng từ histogram: cận trên của bucket chứa phân vị q (kẹp trong [min, max])"""
+        target, cumulative = q * self.count, 0
+        for edge, count in zip(BUCKETS_MS + (float('inf'),), self.buckets):
+            cumulative += count
+            if cumulative >= target:
+                return min(max(edge, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total,
+            'mean_ms': self.total / self.count if self.count else 0.0,
+            'min_ms': self.min if self.count else 0.0,
+            'max_ms': self.max,
+            'p50_ms': self.percentile(0.50),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'histogram': {**{f"le_{edge:g}": count for edge, count in zip(BUCKETS_MS, self.buckets)},
+                          'le_inf': self.buckets[-1]},
+        }
+
+
+class Instrumentation:
+    """Bộ thu span (an toàn đa luồng: backend chạy forward trên thread riêng)"""
+    def __init__(self, sync_cuda=False):
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, ms):
+        with self._lock:
+            stat = self._stats.get(name)
+            if stat is None:
+                stat = self._stats[name] = _Stat()
+            stat.add(ms)
+
+    def summary(self):
+        with self._lock:
+            return {name: stat.to_dict() for name, stat in sorted(self._stats.items())}
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+class _Span:
+    __slots__ = ('collector', 'name', 'start', 'record_function')
+
+    def __init__(self, collector, name):
+        self.collector = collector
+        self.name = name
+        self.record_function = None
+
+    def __enter__(self):
+        if torch.autograd._profiler_enabled():
+            self.record_function = torch.profiler.record_function(self.name)
+            self.record_function.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.collector.sync_cuda:
+            torch.cuda.synchronize()
+        self.collector.record(self.name, (time.perf_counter() - self.start) * 1000)
+        if self.record_function is not None:
+            self.record_function.__exit__(*exc)
+        return False
+
+
+_active = None
+
+
+def configure(enabled=True, sync_cuda=False):
+    """Bật / tắt đo cho cả process (bật lại -> bắt đầu thống kê mới)"""
+    global _active
+    _active = Instrumentation(sync_cuda) if enabled else None
+    return _active
+
+
+def enabled():
+    return _active is not None
+
+
+def span(name):
+    if _active is None:
+        return _NULL_SPAN
+    return _Span(_active, name)
+
+
+def record(name, ms):
+    """Ghi một số đo có sẵn (VD: latency cả request đo bằng perf_counter ở nơi khác)"""
+    if _active is not None:
+        _active.record(name, ms)
+
+
+def timed_iter(iterable, name):
+    """Bọc iterator: thời gian chờ mỗi phần tử (VD: chờ DataLoader) được ghi vào span name"""
+    iterator = iter(iterable)
+    while True:
+        with span(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def summary():
+    return _active.summary() if _active is not None else {}
+
+
+def reset():
+    if _active is not None:
+        _active.reset()
+
+
+def format_summary(stats, total_ms=None):
+    """
+    Bảng span: tổng thời gian, % (so với total_ms), mean / p95 -> chuỗi để in.
+    Span lồng nhau (model/encoder nằm trong forward) được tính cả hai nơi nên tổng % có thể > 100.
+    """
+    if not stats:
+        return ""
+    total_ms = total_ms or sum(s['total_ms'] for s in stats.values())
+    lines = [f"   {'span':<22}{'count':>7}{'total_s':>10}{'%':>7}{'mean_ms':>10}{'p95_ms':>10}"]
+    for name, s in sorted(stats.items(), key=lambda item: -item[1]['total_ms']):
+        lines.append(f"   {name:<22}{s['count']:>7}{s['total_ms'] / 1000:>10.2f}"
+                     f"{100 * s['total_ms'] / total_ms:>7.1f}{s['mean_ms']:>10.2f}{s['p95_ms']:>10.2f}")
+    return "\n".join(lines)
+
+
+def append_jsonl(path, record):
+    """Ghi thêm 1 dòng JSON (file metric theo epoch: mỗi epoch 1 dòng, đọc bằng pandas.read_json(lines=True))"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+class StepProfiler:
+    """
+    torch.profiler cho một cửa sổ step: bỏ qua start_step step đầu, 1 step warmup, ghi num_steps step.
+    Xuất Chrome trace (mở bằng chrome://tracing hoặc Perfetto) vào output_dir.
+    """
+    def __init__(self, start_step, num_steps, output_dir, device):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.device(device).type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        os.makedirs(output_dir, exist_ok=True)
+        self.trace_path = os.path.join(output_dir, f"trace_{time.strftime('%Y%m%d_%H%M%S')}.json")
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(skip_first=start_step, wait=0, warmup=1, active=num_steps, repeat=1),
+            on_trace_ready=self._on_trace_ready,
+            record_shapes=True,
+            profile_memory=True,
+        )
+        self.done = False
+        self.profiler.start()
+
+    def _on_trace_ready(self, profiler):
+        profiler.export_chrome_trace(self.trace_path)
+        print(f"\n--> Đã ghi profiler trace: {self.trace_path}")
+        print(profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=15))
+        self.done = True
+
+    def step(self):
+        if not self.done:
+            self.profiler.step()
+
+    def close(self):
+        self.profiler.stop()
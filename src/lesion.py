@@ -0,0 +1,101 @@
+import struct
+import numpy as np
+import torch
+import config
+
+# Thống kê tổn thương + lưu mask gọn cho hồ sơ khám (medical_records) và biểu đồ tiến triển.
+#   lesion_stats(): diện tích, bounding box, độ dày theo từng cột (A-scan), mức độ (severity) của cả batch
+#       mask bằng vài phép reduce trên tensor -> tính ngay lúc suy luận, trên device, không giải mã lại ảnh.
+#   encode_mask() / decode_mask(): mask nhị phân <-> bytes (run-length hoặc bit-packed, chọn bản nhỏ hơn).
+#       Mask tổn thương thường thưa -> RLE chỉ vài chục byte thay vì PNG vài KB, mã hóa / giải mã bằng numpy.
+
+SEVERITY_LEVELS = ['None', 'Medium', 'High']  # Như enum severity của medical_records (project_spec)
+
+_MAGIC = b'OCM'
+_HEADER = struct.Struct('<3scII')  # magic, kiểu mã hóa, H, W
+_RLE16, _RLE32, _BITPACK = b'r', b'R', b'B'
+
+
+def lesion_stats(masks, severity_thresholds=config.SEVERITY_THRESHOLDS):
+    """
+    Args:
+        masks: tensor bool [B, H, W] (mask sau ngưỡng, để nguyên trên device)
+        severity_thresholds: (ngưỡng Medium, ngưỡng High) theo tỉ lệ diện tích tổn thương / diện tích ảnh
+    Returns:
+        dict tensor trên cùng device: area [B], bbox [B, 4] (y0, x0, y1, x1; -1 nếu không có tổn thương),
+        thickness [B, W] (số pixel tổn thương trên mỗi cột), thickness_max [B],
+        thickness_mean [B] (trung bình trên các cột có tổn thương), severity [B] (chỉ số trong SEVERITY_LEVELS)
+    """
+    _, height, width = masks.shape
+    thickness = masks.sum(dim=1)                      # [B, W]
+    area = thickness.sum(dim=1)
+    rows = masks.any(dim=2).to(torch.uint8)           # [B, H]
+    cols = (thickness > 0).to(torch.uint8)            # [B, W]
+    # argmax trả về vị trí lớn nhất ĐẦU TIÊN -> hàng / cột đầu tiên có tổn thương; lật để lấy vị trí cuối
+    bbox = torch.stack([rows.argmax(dim=1), cols.argmax(dim=1),
+                        height - 1 - rows.flip(1).argmax(dim=1), width - 1 - cols.flip(1).argmax(dim=1)], dim=1)
+    bbox = torch.where((area > 0)[:, None], bbox, torch.full_like(bbox, -1))
+    lesion_cols = cols.sum(dim=1)
+    thickness_mean = area.float() / lesion_cols.clamp(min=1).float()
+    boundaries = torch.tensor(severity_thresholds, dtype=torch.float32, device=masks.device)
+    severity = torch.bucketize(area.float() / (height * width), boundaries, right=True)
+    return {'area': area, 'bbox': bbox, 'thickness': thickness, 'thickness_max': thickness.max(dim=1).values,
+            'thickness_mean': thickness_mean, 'severity': severity}
+
+
+def stats_to_records(stats):
+    """Kết quả lesion_stats -> list dict Python (một lần chuyển về CPU cho cả batch)"""
+    scalars = torch.cat([stats['area'][:, None], stats['bbox'], stats['thickness_max'][:, None],
+                         stats['severity'][:, None]], dim=1).cpu().tolist()
+    thickness_mean = stats['thickness_mean'].cpu().tolist()
+    thickness = stats['thickness'].cpu().tolist()
+    records = []
+    for row, mean, profile in zip(scalars, thickness_mean, thickness):
+        area, y0, x0, y1, x1, thickness_max, severity = row
+        records.append({
+            'lesion_area_px': area,
+            'lesion_bbox': [y0, x0, y1, x1] if area > 0 else None,
+            'lesion_thickness_max_px': thickness_max,
+            'lesion_thickness_mean_px': mean,
+            'thickness_profile_px': profile,
+            'severity': SEVERITY_LEVELS[severity],
+        })
+    return records
+
+
+def encode_mask(mask):
+    """
+    Mask nhị phân [H, W] (bool hoặc uint8 0/255) -> bytes gọn: header 12 byte + độ dài các đoạn
+    (RLE, xen kẽ nền / tổn thương, bắt đầu bằng nền) hoặc 1 bit / pixel - lấy bản nào ngắn hơn.
+    """
+    mask = np.asarray(mask)
+    height, width = mask.shape
+    flat = mask.reshape(-1) != 0
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    runs = np.diff(np.concatenate(([0], change, [flat.size])))
+    if flat.size and flat[0]:
+        runs = np.concatenate(([0], runs))
+    kind, dtype = (_RLE16, '<u2') if runs.size == 0 or runs.max() <= 0xFFFF else (_RLE32, '<u4')
+    if runs.size * np.dtype(dtype).itemsize > (flat.size + 7) // 8:
+        return _HEADER.pack(_MAGIC, _BITPACK, height, width) + np.packbits(flat).tobytes()
+    return _HEADER.pack(_MAGIC, kind, height, width) + runs.astype(dtype).tobytes()
+
+
+def decode_mask(data):
+    """bytes của encode_mask -> mask uint8 0/255 [H, W]"""
+    magic, kind, height, width = _HEADER.unpack_from(data)
+    if magic != _MAGIC:
+        raise ValueError("Không phải mask đã mã hóa bằng lesion.encode_mask")
+    payload = memoryview(data)[_HEADER.size:]
+    if kind == _BITPACK:
+        if len(payload) != (height * width + 7) // 8:
+            raise ValueError(f"Mask hỏng: {len(payload)} byte không khớp {height}x{width}")
+        flat = np.unpackbits(np.frombuffer(payload, dtype=np.uint8), count=height * width)
+        return (flat * 255).reshape(height, width)
+    runs = np.frombuffer(payload, dtype='<u2' if kind == _RLE16 else '<u4')
+    values = np.zeros(runs.size, dtype=np.uint8)
+    values[1::2] = 255
+    flat = np.repeat(values, runs)
+    if flat.size != height * width:
+        raise ValueError(f"Mask hỏng: {flat.size} pixel != {height}x{width}")
+    return flat.reshape(height, width)
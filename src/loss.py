@@ -1,39 +1,133 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+# Loss đa nhiệm:
+#   - Segmentation: Dice + BCE gộp trong MỘT hàm (sigmoid tính một lần, dùng chung cho Dice và gradient),
+#     chỉ tính trên ảnh Chiu (label == -1) đã được gom ra trước -> ảnh Srinivasan không tốn phép tính nào.
+#     Backward viết tay (autograd.Function): gradient Dice + BCE gộp thành vài phép in-place,
+#     không giữ các tensor trung gian cỡ ảnh như khi để autograd tự ghi từng phép.
+#   - Trọng số tác vụ: cố định (weight_seg / weight_cls) hoặc học theo độ bất định (Kendall et al. 2018):
+#     L = sum_k exp(-s_k) * L_k + s_k, s_k = log(sigma_k^2) là tham số học được.
+
+
+class _FusedDiceBCE(torch.autograd.Function):
+    """Logits/target [N, C, H, W] (chỉ ảnh có mask) -> loss trung bình trên N ảnh"""
+
+    @staticmethod
+    def forward(ctx, logits, target, bce_weight, dice_weight, smooth):
+        # Tắt autocast: bmm nằm trong danh sách op hạ xuống fp16/bf16 -> giao (dùng lại ở backward) sẽ mất
+        # độ chính xác / tràn số dù p, t là fp32
+        with torch.autocast(logits.device.type, enabled=False):
+            return _FusedDiceBCE._forward(ctx, logits, target, bce_weight, dice_weight, smooth)
+
+    @staticmethod
+    def _forward(ctx, logits, target, bce_weight, dice_weight, smooth):
+        # fp16/bf16 (autocast) -> tính bằng fp32; làm việc trên view [N, M] (M = số pixel mỗi ảnh)
+        dtype = torch.promote_types(logits.dtype, torch.float32)
+        x, t = logits.to(dtype).flatten(1), target.to(dtype).flatten(1)
+        p = torch.sigmoid(x)
+        bce = F.binary_cross_entropy_with_logits(x, t, reduction='none').mean(1)
+        # Giao theo từng ảnh = tích vô hướng p . t -> bmm, không tạo tensor p * t
+        intersection = torch.bmm(p.unsqueeze(1), t.unsqueeze(2)).view(-1)
+        union = p.sum(1) + t.sum(1)
+        dice = (2 * intersection + smooth) / (union + smooth)
+        # Chỉ giữ p (thay vì sigmoid, BCE từng pixel, p * t... như autograd) + target + 2 số mỗi ảnh
+        ctx.save_for_backward(p, t, intersection, union)
+        ctx.input_dtype = logits.dtype
+        ctx.input_shape = logits.shape
+        ctx.weights = (bce_weight, dice_weight, smooth)
+        return (bce_weight * bce + dice_weight * (1 - dice)).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        p, t, intersection, union = ctx.saved_tensors
+        bce_weight, dice_weight, smooth = ctx.weights
+        num_images, num_pixels = p.shape
+        scale = grad_output / num_images
+        # d(BCE)/dx = (p - t) / M
+        # d(1 - dice)/dx = -(a * t - b) * p * (1 - p), a = 2 / (U + s), b = (2I + s) / (U + s)^2
+        a = (2 * dice_weight / (union + smooth) * scale).unsqueeze(1)
+        b = ((2 * intersection + smooth) / (union + smooth) ** 2 * dice_weight * scale).unsqueeze(1)
+        grad = torch.sub(p, t).mul_(bce_weight / num_pixels * scale)
+        grad.addcmul_(torch.addcmul(-b, t, a), torch.addcmul(p, p, p, value=-1), value=-1)
+        return grad.view(ctx.input_shape).to(ctx.input_dtype), None, None, None, None
+
+
+def masked_dice_bce(seg_pred, seg_target, sample_mask, bce_weight=1.0, dice_weight=1.0, smooth=1.0):
+    """
+    Dice + BCE chỉ trên các ảnh có sample_mask = True (gom sub-batch TRƯỚC khi tính).
+    smooth = 1: ảnh Chiu không có tổn thương (mask rỗng) mà dự đoán rỗng -> Dice ~ 1, không bị phạt.
+    Returns:
+        loss (scalar) hoặc None nếu không có ảnh nào
+    """
+    index = torch.nonzero(sample_mask).flatten()
+    if index.numel() == 0:
+        return None
+    if index.numel() < seg_pred.shape[0]:
+        seg_pred, seg_target = seg_pred.index_select(0, index), seg_target.index_select(0, index)
+    return _FusedDiceBCE.apply(seg_pred, seg_target, bce_weight, dice_weight, smooth)
+
 
 class MultiTaskLoss(nn.Module):
-    def __init__(self, weight_seg=0.5, weight_cls=0.5):
+    def __init__(self, weight_seg=0.5, weight_cls=0.5, uncertainty=False, bce_weight=1.0, dice_weight=1.0,
+                 smooth=1.0):
+        """
+        Args:
+            weight_seg / weight_cls: trọng số cố định (khi uncertainty=False)
+            uncertainty: học trọng số tác vụ (log_vars = [s_seg, s_cls], khởi tạo 0 -> trọng số 1)
+            bce_weight / dice_weight: tỉ lệ BCE : Dice trong loss segmentation
+        """
         super(MultiTaskLoss, self).__init__()
         self.weight_seg = weight_seg
         self.weight_cls = weight_cls
-        self.bce = nn.BCEWithLogitsLoss(reduction='none') # reduction='none' để tính lẻ từng ảnh
-        self.cls_criterion = nn.CrossEntropyLoss(ignore_index=-1) # Bỏ qua nhãn -1 (Chiu)
+        self.bce_weight = bce_weight
+        self.dice_weight = dice_weight
+        self.smooth = smooth
+        # Tham số của loss -> cần đưa vào optimizer (criterion.parameters())
+        self.log_vars = nn.Parameter(torch.zeros(2)) if uncertainty else None
+
+    def task_weights(self):
+        """Trọng số hiệu dụng hiện tại (seg, cls) - để log"""
+        if self.log_vars is None:
+            return self.weight_seg, self.weight_cls
+        weights = torch.exp(-self.log_vars.detach()).tolist()
+        return weights[0], weights[1]
 
-    def dice_loss(self, preds, targets):
-        preds = torch.sigmoid(preds)
-        intersection = (preds * targets).sum(dim=(1, 2, 3))
-        union = preds.sum(dim=(1, 2, 3)) + targets.sum(dim=(1, 2, 3))
-        dice = (2. * intersection + 1e-6) / (union + 1e-6)
-        return 1 - dice.mean()
+    def _weighted(self, loss, task):
+        if self.log_vars is None:
+            return (self.weight_seg, self.weight_cls)[task] * loss
+        log_var = self.log_vars[task]
+        return torch.exp(-log_var) * loss + log_var
 
     def forward(self, seg_pred, seg_target, cls_pred, cls_target):
-        # 1. Classification Loss (Tự động bỏ qua ảnh Chiu có label -1)
-        loss_cls = self.cls_criterion(cls_pred, cls_target)
-        
-        # 2. Segmentation Loss (Chỉ tính cho ảnh Chiu - Label == -1)
-        # Tìm những ảnh nào là Chiu (Label == -1)
-        is_chiu = (cls_target == -1).float() 
-        
-        # Nếu trong batch không có ảnh Chiu nào thì loss seg = 0
-        if is_chiu.sum() == 0:
-            loss_seg = torch.tensor(0.0, device=seg_pred.device, requires_grad=True)
-        else:
-            # Tính BCE cho từng ảnh
-            bce_per_image = self.bce(seg_pred, seg_target).mean(dim=(1, 2, 3))
-            # Chỉ lấy loss của ảnh Chiu
-            loss_seg = (bce_per_image * is_chiu).sum() / (is_chiu.sum() + 1e-6)
-            
-            # (Dice loss viết đơn giản thì khó mask, tạm thời dùng BCE chủ đạo cho Seg đoạn này)
-        
-        total_loss = self.weight_seg * loss_seg + self.weight_cls * loss_cls
-        return total_loss, loss_seg, loss_cls
\ No newline at end of file
+        """
+        seg_pred / cls_pred = None: forward đã bỏ qua nhánh đó (model.forward segment/classify).
+        Tác vụ không có ảnh nào trong batch -> không cộng vào loss (kể cả số hạng s_k của nó,
+        nếu không s_k bị kéo giảm ở mọi batch vắng tác vụ đó).
+        Returns:
+            total_loss, loss_seg, loss_cls (loss_seg / loss_cls = 0 khi vắng tác vụ)
+        """
+        zero = torch.zeros((), device=cls_target.device)
+        total_loss = None
+
+        # 1. Classification Loss (chỉ ảnh Srinivasan, label != -1)
+        has_cls = cls_target != -1
+        loss_cls = zero
+        if cls_pred is not None and bool(has_cls.any()):
+            loss_cls = F.cross_entropy(cls_pred.float(), cls_target, ignore_index=-1)
+            total_loss = self._weighted(loss_cls, 1)
+
+        # 2. Segmentation Loss (chỉ ảnh Chiu, label == -1)
+        loss_seg = zero
+        if seg_pred is not None:
+            seg = masked_dice_bce(seg_pred, seg_target, cls_target == -1, self.bce_weight, self.dice_weight,
+                                  self.smooth)
+            if seg is not None:
+                loss_seg = seg
+                weighted = self._weighted(loss_seg, 0)
+                total_loss = weighted if total_loss is None else total_loss + weighted
+
+        if total_loss is None:
+            total_loss = zero
+        return total_loss, loss_seg, loss_cls
@@ -1,4 +1,6 @@
+import math
 import torch
+import torch.distributed as dist
 
 def compute_iou(pred_mask, true_mask, threshold=0.5, smooth=1e-6):
     """Tính Intersection over Union (IoU) cho bài toán phân đoạn"""
@@ -32,4 +34,95 @@ def compute_accuracy(pred_cls, true_cls):
     correct = (predicted_labels == true_cls).sum().item()
     total = true_cls.size(0)
     
-    return correct / total
\ No newline at end of file
+    return correct / total
+
+# --- BẢN BATCH / STREAMING (không .item(), không đồng bộ host mỗi step) ---
+
+def _binarize_logits(pred_mask, threshold=0.5):
+    # sigmoid(x) > t  <=>  x > logit(t): khỏi phải tính sigmoid cả ảnh
+    if threshold == 0.5:
+        return pred_mask > 0
+    return pred_mask > math.log(threshold / (1 - threshold))
+
+def segmentation_stats(pred_mask, true_mask, threshold=0.5):
+    """Trả về (intersection, pred_sum, true_sum) cho từng ảnh, mỗi cái là tensor [B]"""
+    pred_bin = _binarize_logits(pred_mask, threshold).flatten(1)
+    true_bin = (true_mask > 0.5).flatten(1)
+    intersection = (pred_bin & true_bin).sum(dim=1, dtype=torch.float32)
+    pred_sum = pred_bin.sum(dim=1, dtype=torch.float32)
+    true_sum = true_bin.sum(dim=1, dtype=torch.float32)
+    return intersection, pred_sum, true_sum
+
+def dice_iou_per_sample(pred_mask, true_mask, threshold=0.5, smooth=1e-6):
+    """Dice và IoU của từng ảnh trong batch -> (dice [B], iou [B]) dạng tensor"""
+    intersection, pred_sum, true_sum = segmentation_stats(pred_mask, true_mask, threshold)
+    dice = (2. * intersection + smooth) / (pred_sum + true_sum + smooth)
+    iou = (intersection + smooth) / (pred_sum + true_sum - intersection + smooth)
+    return dice, iou
+
+class MetricAccumulator:
+    """
+    Cộng dồn metric ngay trên device, tách theo nguồn dữ liệu:
+      - Chiu (label == -1): intersection / pred / true (Dice, IoU gộp) + tổng Dice từng ảnh
+      - Srinivasan (label != -1): số dự đoán đúng / tổng số ảnh
+    update() không đồng bộ host; chỉ compute() mới chuyển về Python float (1 lần sync).
+    """
+    def __init__(self, device, smooth=1e-6):
+        self.device = device
+        self.smooth = smooth
+        self.reset()
+
+    def reset(self):
+        # 0: loss_sum, 1: batches, 2: inter, 3: pred_sum, 4: true_sum,
+        # 5: dice_sum (từng ảnh), 6: n_chiu, 7: correct, 8: n_srinivasan
+        self.sums = torch.zeros(9, dtype=torch.float64, device=self.device)
+
+    @torch.no_grad()
+    def update(self, seg_pred, masks, cls_pred, labels, loss=None):
+        # Trọng số 0/1 thay cho indexing boolean (indexing cần biết số phần tử -> sync)
+        is_chiu = (labels == -1).float()
+        is_sri = 1.0 - is_chiu
+
+        if seg_pred is None:
+            # Batch đã bỏ qua decoder (không có ảnh Chiu) -> đóng góp 0 cho metric segmentation
+            intersection = pred_sum = true_sum = torch.zeros(len(labels), device=labels.device)
+        else:
+            intersection, pred_sum, true_sum = segmentation_stats(seg_pred.detach(), masks)
+        dice = (2. * intersection + self.smooth) / (pred_sum + true_sum + self.smooth)
+        if cls_pred is None:
+            correct = torch.zeros(len(labels), device=labels.device)
+        else:
+            correct = (cls_pred.detach().argmax(dim=1) == labels).float()
+
+        batch = torch.stack([
+            loss.detach().float() if loss is not None else torch.zeros((), device=self.device),
+            torch.ones((), device=self.device),
+            (intersection * is_chiu).sum(),
+            (pred_sum * is_chiu).sum(),
+            (true_sum * is_chiu).sum(),
+            (dice * is_chiu).sum(),
+            is_chiu.sum(),
+            (correct * is_sri).sum(),
+            is_sri.sum(),
+        ])
+        self.sums += batch.to(self.sums.dtype)
+
+    def all_reduce(self):
+        """Huấn luyện phân tán: cộng sums của mọi process -> compute() cho metric trên dữ liệu của cả nhóm"""
+        if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            dist.all_reduce(self.sums)
+
+    def compute(self):
+        """Quy về dict Python float (đồng bộ host đúng 1 lần)"""
+        (loss_sum, batches, inter, pred_sum, true_sum,
+         dice_sum, n_chiu, correct, n_sri) = self.sums.tolist()
+        s = self.smooth
+        return {
+            'loss': loss_sum / batches if batches > 0 else 0.0,
+            'dice': (2. * inter + s) / (pred_sum + true_sum + s) if n_chiu > 0 else 0.0,
+            'iou': (inter + s) / (pred_sum + true_sum - inter + s) if n_chiu > 0 else 0.0,
+            'dice_per_image': dice_sum / n_chiu if n_chiu > 0 else 0.0,
+            'acc': correct / n_sri if n_sri > 0 else 0.0,
+            'n_chiu': int(n_chiu),
+            'n_srinivasan': int(n_sri),
+        }
@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-import segmentation_models_pytorch as smp
+from instrument import span
 
 class MultiTaskUNet(nn.Module):
     def __init__(self, encoder_name="efficientnet-b3", encoder_weights="imagenet", n_classes_seg=1, n_classes_cls=3):
@@ -11,6 +11,8 @@ class MultiTaskUNet(nn.Module):
             n_classes_cls: Số lớp phân loại bệnh (VD: Normal, AMD, DME)
         """
         super(MultiTaskUNet, self).__init__()
+        # Import lúc tạo model (~2-3 s, kéo theo timm/torchvision): runtime TorchScript/ONNX không cần smp
+        import segmentation_models_pytorch as smp
         
         # 1. SHARED ENCODER & SEGMENTATION DECODER
         # Chúng ta dùng thư viện SMP để tạo khung U-Net chuẩn
@@ -38,23 +40,89 @@ class MultiTaskUNet(nn.Module):
             nn.Linear(256, n_classes_cls)   # Output ra số lớp bệnh (logits)
         )
 
-    def forward(self, x):
+    def forward(self, x, segment=True, classify=True):
+        """
+        Args:
+            segment / classify: bool cho cả batch, hoặc tensor bool [B] (cờ theo từng ảnh).
+                Chỉ các ảnh có cờ mới đi qua decoder / classification_head; đầu ra vẫn đủ B hàng
+                (hàng bị bỏ qua = 0). Không ảnh nào cần -> đầu ra đó là None.
+                VD huấn luyện: segment = labels == -1 (Chiu), classify = labels != -1 (Srinivasan);
+                phục vụ: classify=True, segment=False cho đường triage chỉ phân loại.
+        """
         # --- Giai đoạn 1: Đi qua Encoder (Shared) ---
         # Hàm encoder của smp trả về một list các feature maps từ nông đến sâu
-        features = self.unet.encoder(x)
+        with span('model/encoder'):
+            features = self.unet.encoder(x)
+        batch_size = x.shape[0]
         
         # --- Giai đoạn 2: Task Segmentation ---
-        # Đưa các feature maps vào Decoder để tái tạo ảnh mask
-        decoder_output = self.unet.decoder(features)
-        seg_mask = self.unet.segmentation_head(decoder_output)
+        # Đưa các feature maps vào Decoder để tái tạo ảnh mask (chỉ sub-batch cần mask)
+        run_seg, seg_index = _route(segment, batch_size, x.device)
+        if run_seg:
+            with span('model/decoder'):
+                seg_features = features if seg_index is None else [f.index_select(0, seg_index) for f in features]
+                decoder_output = self.unet.decoder(seg_features)
+                seg_mask = _scatter(self.unet.segmentation_head(decoder_output), seg_index, batch_size)
+        else:
+            seg_mask = None
         
         # --- Giai đoạn 3: Task Classification ---
         # Lấy feature map sâu nhất (cái cuối cùng trong list features)
-        bottleneck = features[-1]
-        cls_logits = self.classification_head(bottleneck)
+        run_cls, cls_index = _route(classify, batch_size, x.device)
+        if run_cls:
+            with span('model/cls_head'):
+                bottleneck = features[-1] if cls_index is None else features[-1].index_select(0, cls_index)
+                cls_logits = _scatter(self.classification_head(bottleneck), cls_index, batch_size)
+        else:
+            cls_logits = None
         
         return seg_mask, cls_logits
 
+def _route(flags, batch_size, device):
+    """
+    Cờ tác vụ -> (có chạy nhánh không, chỉ số sub-batch hoặc None = cả batch).
+    Cờ dạng tensor cần biết số ảnh được chọn -> đồng bộ host 1 lần (nonzero).
+    """
+    if isinstance(flags, bool):
+        return flags, None
+    index = torch.nonzero(torch.as_tensor(flags).reshape(-1).bool()).flatten()
+    if index.numel() == batch_size:
+        return True, None
+    if index.numel() == 0:
+        return False, None
+    return True, index.to(device)
+
+def _scatter(sub_output, index, batch_size):
+    """Đặt kết quả của sub-batch về đúng hàng trong batch đầy đủ (hàng không chạy = 0)"""
+    if index is None:
+        return sub_output
+    full = sub_output.new_zeros((batch_size,) + tuple(sub_output.shape[1:]))
+    return full.index_copy(0, index, sub_output)
+
+def load_model(weights_path, encoder_name="efficientnet-b0", device="cpu", n_classes_seg=1, n_classes_cls=3):
+    """
+    Tạo MultiTaskUNet và nạp trọng số, trả về model ở chế độ eval.
+    weights_path: bản xuất chỉ trọng số (.pth, nạp qua mmap) hoặc checkpoint đầy đủ (.ckpt) của checkpoint.py.
+    weights_path=None -> giữ trọng số khởi tạo ngẫu nhiên (chỉ dùng để test/benchmark).
+    """
+    from checkpoint import load_weights
+    # Trọng số sẽ bị checkpoint ghi đè -> không tải ImageNet (máy offline vẫn chạy được)
+    kwargs = dict(encoder_name=encoder_name, encoder_weights=None, n_classes_seg=n_classes_seg,
+                  n_classes_cls=n_classes_cls)
+    if weights_path is None:
+        return MultiTaskUNet(**kwargs).to(device).eval()
+    state_dict = load_weights(weights_path)
+    try:
+        # Dựng model trên device 'meta' (không cấp phát, không khởi tạo ngẫu nhiên) rồi gắn thẳng tensor
+        # mmap của checkpoint vào (assign=True, torch >= 2.1): không copy trọng số lần nào trên CPU
+        with torch.device('meta'):
+            model = MultiTaskUNet(**kwargs)
+        model.load_state_dict(state_dict, assign=True)
+    except (TypeError, AttributeError):
+        model = MultiTaskUNet(**kwargs)
+        model.load_state_dict(state_dict)
+    return model.to(device).eval()
+
 # --- CODE TEST NHANH (Chạy để kiểm tra lỗi cú pháp) ---
 if __name__ == "__main__":
     # Giả lập một batch ảnh đầu vào: Batch_size=2, Channel=1, Size=256x256
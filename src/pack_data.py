@@ -0,0 +1,105 @@
+import os
+import json
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+import config
+from utils import save_npy_atomic, write_text_atomic
+
+# Định dạng đóng gói (packed): mỗi tập (train/val/test) là một thư mục gồm
+#   meta.json                 -> số ảnh, kích thước, danh sách shard
+#   images_XXX.npy            -> uint8 [N, H, W] (ảnh xám 0-255)
+#   masks_XXX.npy             -> uint8 [N, H, W] (0/1, đã threshold sẵn)
+#   labels.npy / sources.npy  -> chỉ mục nhãn và nguồn dữ liệu cho toàn tập
+#   names.txt                 -> tên file PNG gốc (để tra ngược)
+# Giải mã PNG chỉ làm MỘT lần lúc đóng gói, lúc train chỉ còn đọc memmap.
+PACKED_DIR = os.path.join(config.PROCESSED_DATA_DIR, 'packed')
+PACK_VERSION = 1
+SHARD_SIZE = 4096  # Số ảnh mỗi shard (~256MB ảnh 256x256)
+
+CLASS_MAP = {'AMD': 0, 'DME': 1, 'NORMAL': 2}
+
+# Mã nguồn dữ liệu
+SOURCE_CHIU = 0
+SOURCE_SRINIVASAN = 1
+
+
+def parse_sample_name(img_name):
+    """Trả về (source, label) từ tên file PNG đã chuẩn bị"""
+    # Mặc định là Chiu, label -1 (Ignore)
+    if "Srinivasan" not in img_name:
+        return SOURCE_CHIU, -1
+
+    # File tên dạng: Srinivasan_AMD_AMD1_01.png
+    for class_name, class_idx in CLASS_MAP.items():
+        if f"_{class_name}_" in img_name:
+            return SOURCE_SRINIVASAN, class_idx
+    return SOURCE_SRINIVASAN, -1
+
+
+def pack_subset(subset, shard_size=SHARD_SIZE, out_root=PACKED_DIR):
+    """Đóng gói toàn bộ PNG của một tập thành các shard .npy uint8"""
+    img_dir = os.path.join(config.PROCESSED_DATA_DIR, 'images', subset)
+    mask_dir = os.path.join(config.PROCESSED_DATA_DIR, 'masks', subset)
+    if not os.path.exists(img_dir):
+        print(f"Bỏ qua tập {subset}: chưa có ảnh PNG")
+        return 0
+
+    names = sorted([f for f in os.listdir(img_dir) if f.endswith('.png')])
+    if len(names) == 0:
+        print(f"Bỏ qua tập {subset}: thư mục rỗng")
+        return 0
+
+    out_dir = os.path.join(out_root, subset)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Kích thước lấy theo ảnh đầu tiên (pipeline có thể chạy với IMG_SIZE khác config)
+    height, width = np.asarray(Image.open(os.path.join(img_dir, names[0]))).shape[:2]
+    labels = np.empty(len(names), dtype=np.int64)
+    sources = np.empty(len(names), dtype=np.uint8)
+    shards = []
+
+    for shard_idx, start in enumerate(range(0, len(names), shard_size)):
+        shard_names = names[start:start + shard_size]
+        images = np.empty((len(shard_names), height, width), dtype=np.uint8)
+        masks = np.empty((len(shard_names), height, width), dtype=np.uint8)
+
+        for i, name in enumerate(tqdm(shard_names, desc=f"Đóng gói {subset} #{shard_idx}")):
+            image = np.asarray(Image.open(os.path.join(img_dir, name)).convert("L"))
+            mask = np.asarray(Image.open(os.path.join(mask_dir, name)).convert("L"))
+            if image.shape != (height, width) or mask.shape != (height, width):
+                raise ValueError(f"{name}: kích thước {image.shape} khác các ảnh còn lại {(height, width)}")
+
+            images[i] = image
+            masks[i] = mask > 127
+            sources[start + i], labels[start + i] = parse_sample_name(name)
+
+        image_file = f"images_{shard_idx:03d}.npy"
+        mask_file = f"masks_{shard_idx:03d}.npy"
+        save_npy_atomic(os.path.join(out_dir, image_file), images)
+        save_npy_atomic(os.path.join(out_dir, mask_file), masks)
+        shards.append({'images': image_file, 'masks': mask_file, 'count': len(shard_names)})
+
+    save_npy_atomic(os.path.join(out_dir, 'labels.npy'), labels)
+    save_npy_atomic(os.path.join(out_dir, 'sources.npy'), sources)
+    write_text_atomic(os.path.join(out_dir, 'names.txt'), "\n".join(names))
+
+    # meta.json ghi CUỐI CÙNG: có meta nghĩa là cả tập đã đóng gói xong
+    meta = {
+        'version': PACK_VERSION,
+        'num_samples': len(names),
+        'img_size': [height, width],
+        'shards': shards,
+    }
+    write_text_atomic(os.path.join(out_dir, 'meta.json'), json.dumps(meta, indent=2))
+    return len(names)
+
+
+def pack_all(subsets=('train', 'val', 'test')):
+    for subset in subsets:
+        count = pack_subset(subset)
+        print(f"   Tập {subset.upper()}: đã đóng gói {count} ảnh vào {os.path.join(PACKED_DIR, subset)}")
+
+
+if __name__ == "__main__":
+    pack_all()
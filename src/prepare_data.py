@@ -3,8 +3,9 @@ import scipy.io
 import numpy as np
 from PIL import Image
 from tqdm import tqdm
-import matplotlib.pyplot as plt
 import config
+from pack_data import pack_all
+from utils import save_png_atomic
 
 # Cấu hình chia tập dữ liệu
 SPLIT_CONFIG = {
@@ -16,73 +17,154 @@ SPLIT_CONFIG = {
     'test': ['Subject_10']
 }
 
+# Các dải (band) giữa 2 đường ranh giới trong manualLayers1 (8 đường: ILM ... BM),
+# ứng với các layer trong project_spec.json. 'fluid' không phải dải giữa 2 đường
+# ranh giới (bộ Chiu lưu riêng ở manualFluid1) nên không có ở đây.
+SPEC_BANDS = {
+    'lesion': (0, -1),  # ILM -> BM: toàn bộ võng mạc (mask hiện tại)
+    'rpe': (6, 7),      # OS/RPE -> BM
+}
+
+def create_masks_from_volume(layer_volume, img_shape, bands=None):
+    """
+    Tạo mask cho CẢ volume manualLayers1 bằng một phép so sánh broadcast với lưới chỉ số hàng.
+
+    Args:
+        layer_volume: [Num_Layers, Width, Depth] (chấp nhận cả [Width, Num_Layers, Depth])
+        img_shape: (H, W) của B-scan
+        bands: None -> 1 dải ILM -> BM (layer đầu -> layer cuối)
+               'adjacent' -> mỗi cặp layer kề nhau là 1 kênh (Num_Layers - 1 kênh)
+               list các cặp (layer_trên, layer_dưới), VD: list(SPEC_BANDS.values())
+    Returns:
+        masks: uint8 (0/255) [Depth, H, W], hoặc [Depth, C, H, W] nếu có bands
+        invalid: bool [Depth, W] (hoặc [Depth, C, W]) - cột NaN, đáy <= đỉnh, hoặc ngoài
+                 độ rộng dữ liệu layer. Các cột này để trống trong mask.
+    """
+    layer_volume = np.asarray(layer_volume, dtype=np.float32)
+    if layer_volume.ndim != 3:
+        raise ValueError(f"layer_volume phải có 3 chiều [Layers, W, Depth], nhận {layer_volume.shape}")
+    # Nếu shape là (Width, Num_Layers, Depth) thì đổi trục lại
+    if layer_volume.shape[0] > layer_volume.shape[1]:
+        layer_volume = layer_volume.transpose(1, 0, 2)
+
+    num_layers, layer_width, depth = layer_volume.shape
+    height, width = img_shape
+    if num_layers < 2:
+        raise ValueError(f"Cần ít nhất 2 đường ranh giới, nhận {num_layers}")
+
+    if bands is None:
+        pairs = [(0, num_layers - 1)]
+    elif bands == 'adjacent':
+        pairs = [(i, i + 1) for i in range(num_layers - 1)]
+    else:
+        pairs = [(top % num_layers, bottom % num_layers) for top, bottom in bands]
+    for top, bottom in pairs:
+        if not 0 <= top < bottom < num_layers:
+            raise ValueError(f"Dải ({top}, {bottom}) không hợp lệ với {num_layers} layer")
+
+    # Width dữ liệu layer có thể khác width ảnh -> chỉ tô phần chung
+    cols = min(width, layer_width)
+    tops = layer_volume[[p[0] for p in pairs], :cols, :].transpose(2, 0, 1)     # [Depth, C, cols]
+    bottoms = layer_volume[[p[1] for p in pairs], :cols, :].transpose(2, 0, 1)
+
+    nan_cols = np.isnan(tops) | np.isnan(bottoms)
+    tops = np.clip(np.nan_to_num(tops), 0, height).astype(np.int32)
+    bottoms = np.clip(np.nan_to_num(bottoms), 0, height).astype(np.int32)
+    bad_cols = nan_cols | (bottoms <= tops)
+    bottoms[bad_cols] = tops[bad_cols]  # Dải rỗng
+
+    rows = np.arange(height, dtype=np.int32)[None, None, :, None]            # [1, 1, H, 1]
+    inside = (rows >= tops[:, :, None, :]) & (rows < bottoms[:, :, None, :])  # [Depth, C, H, cols]
+
+    masks = np.zeros((depth, len(pairs), height, width), dtype=np.uint8)
+    masks[..., :cols] = inside.view(np.uint8) * np.uint8(255)
+    invalid = np.ones((depth, len(pairs), width), dtype=bool)
+    invalid[..., :cols] = bad_cols
+
+    if bands is None:
+        return masks[:, 0], invalid[:, 0]
+    return masks, invalid
+
 def create_mask_from_layers(layer_data, img_shape):
     """
     Hàm tạo mask từ dữ liệu manualLayers1.
     Shape của layer_data thường là: [Num_Layers, Width] (VD: [8, 768])
     Ta sẽ lấy Layer đầu (0) và Layer cuối (-1) để tô vùng ở giữa.
+    Bản cho 1 lát cắt của create_masks_from_volume; shape sai sẽ raise ValueError.
     """
-    mask = np.zeros(img_shape, dtype=np.uint8)
-    height, width = img_shape
-    
-    try:
-        # Kiểm tra shape. Nếu shape là (Width, Num_Layers) thì transpose lại
-        if layer_data.shape[0] > layer_data.shape[1]: 
-             layer_data = layer_data.T
-             
-        num_layers = layer_data.shape[0]
-        
-        # Chỉ xử lý nếu có ít nhất 2 đường ranh giới
-        if num_layers >= 2:
-            # Lấy đường trên cùng (ILM) và đường dưới cùng (RPE/BM)
-            top_layer = layer_data[0, :]
-            bottom_layer = layer_data[-1, :] 
-            
-            # Đôi khi dữ liệu bị NaN (Not a Number), thay bằng 0
-            top_layer = np.nan_to_num(top_layer).astype(int)
-            bottom_layer = np.nan_to_num(bottom_layer).astype(int)
-            
-            for col in range(width):
-                # Vì data gốc có thể width khác width ảnh resize, ta cần scale index
-                # Nhưng ở đây ta giả định cắt crop sau, nên tạm thời map 1-1 nếu width khớp
-                # Nếu width data khác width ảnh, ta phải min lại
-                if col >= layer_data.shape[1]: break
-                
-                y_top = top_layer[col]
-                y_bottom = bottom_layer[col]
-                
-                # Clip giá trị
-                y_top = max(0, min(y_top, height))
-                y_bottom = max(0, min(y_bottom, height))
-                
-                if y_bottom > y_top:
-                    mask[y_top:y_bottom, col] = 255
-    except Exception as e:
-        # print(f"Lỗi tạo mask chi tiết: {e}")
-        pass
-    return mask
-
-def save_slice(img, mask, save_img_dir, save_mask_dir, filename, slice_idx):
-    # Resize về 256x256
-    img_pil = Image.fromarray(img).resize(config.IMG_SIZE)
-    mask_pil = Image.fromarray(mask).resize(config.IMG_SIZE, resample=Image.NEAREST)
+    layer_data = np.asarray(layer_data)
+    if layer_data.ndim != 2:
+        raise ValueError(f"layer_data phải có 2 chiều [Layers, W], nhận {layer_data.shape}")
+    masks, _ = create_masks_from_volume(layer_data[..., None], img_shape)
+    return masks[0]
+
+def save_slice(img, mask, save_img_dir, save_mask_dir, filename, slice_idx, img_size=None):
+    # Resize về 256x256 (hoặc img_size truyền vào từ pipeline)
+    img_size = img_size or config.IMG_SIZE
+    img_pil = Image.fromarray(img).resize(img_size)
+    mask_pil = Image.fromarray(mask).resize(img_size, resample=Image.NEAREST)
     
     out_name = f"{filename.replace('.mat', '')}_slice_{slice_idx:03d}.png"
-    img_pil.save(os.path.join(save_img_dir, out_name))
-    mask_pil.save(os.path.join(save_mask_dir, out_name))
+    save_png_atomic(img_pil, os.path.join(save_img_dir, out_name))
+    save_png_atomic(mask_pil, os.path.join(save_mask_dir, out_name))
+    return out_name
+
+def process_subject(mat_path, subset_name, img_size=None):
+    """
+    Xử lý một file .mat (một subject) thành các cặp ảnh/mask PNG.
+    Trả về danh sách tên file đã lưu. Lỗi được raise ra ngoài để người gọi quyết định.
+    """
+    filename = os.path.basename(mat_path)
+    save_img_dir = os.path.join(config.PROCESSED_DATA_DIR, 'images', subset_name)
+    save_mask_dir = os.path.join(config.PROCESSED_DATA_DIR, 'masks', subset_name)
+    os.makedirs(save_img_dir, exist_ok=True)
+    os.makedirs(save_mask_dir, exist_ok=True)
+
+    mat = scipy.io.loadmat(mat_path)
+    images = mat['images']  # [H, W, Depth]
+    
+    # --- SỬA LỖI KEY Ở ĐÂY ---
+    # Ưu tiên lấy manualLayers1
+    if 'manualLayers1' in mat:
+        layers = mat['manualLayers1'] # [Layers, W, Depth]
+    elif 'layerMaps' in mat:
+        layers = mat['layerMaps']
+    else:
+        raise KeyError(f"{filename}: Không tìm thấy layer key")
+    
+    # Tạo Mask cho cả volume một lần (thay cho vòng lặp từng cột của từng lát)
+    masks, invalid = create_masks_from_volume(layers, images.shape[:2])
+    unlabeled = invalid.all(axis=1)
+    partial = invalid.any(axis=1) & ~unlabeled
+    if unlabeled.any() or partial.any():
+        print(f"   {filename}: {int(unlabeled.sum())} lát cắt không có nhãn layer, "
+              f"{int(partial.sum())} lát cắt có {int(invalid[partial].sum())} cột không hợp lệ (NaN / đáy <= đỉnh)")
+
+    saved = []
+    num_slices = images.shape[2]
+    
+    for i in range(num_slices):
+        img_raw = images[:, :, i]
+        mask_uint8 = masks[i]
+        
+        # 1. Chuẩn hóa
+        if np.max(img_raw) == np.min(img_raw): continue
+        img_norm = (img_raw - np.min(img_raw)) / (np.max(img_raw) - np.min(img_raw)) * 255.0
+        img_uint8 = img_norm.astype(np.uint8)
+        
+        # 3. Chỉ lưu nếu mask hợp lệ (có vùng trắng > 500 pixel)
+        if np.sum(mask_uint8 > 0) > 500:
+            saved.append(save_slice(img_uint8, mask_uint8, save_img_dir, save_mask_dir, filename, i, img_size))
+    return saved
 
 def process_dataset():
+    # Bản tuần tự (1 process). Bản song song + chạy tiếp: prepare_pipeline.py
     source_dir = os.path.join(config.RAW_DATA_DIR, '2015_BOE_Chiu')
     
     # Duyệt qua từng tập (Train/Val/Test)
     for subset_name, subject_list in SPLIT_CONFIG.items():
         print(f"\n--> Đang xử lý tập {subset_name.upper()}...")
         
-        save_img_dir = os.path.join(config.PROCESSED_DATA_DIR, 'images', subset_name)
-        save_mask_dir = os.path.join(config.PROCESSED_DATA_DIR, 'masks', subset_name)
-        os.makedirs(save_img_dir, exist_ok=True)
-        os.makedirs(save_mask_dir, exist_ok=True)
-        
         count_saved = 0
         
         for subject_name in tqdm(subject_list):
@@ -92,38 +174,7 @@ def process_dataset():
             if not os.path.exists(mat_path): continue
                 
             try:
-                mat = scipy.io.loadmat(mat_path)
-                images = mat['images']  # [H, W, Depth]
-                
-                # --- SỬA LỖI KEY Ở ĐÂY ---
-                # Ưu tiên lấy manualLayers1
-                if 'manualLayers1' in mat:
-                    layers = mat['manualLayers1'] # [Layers, W, Depth]
-                elif 'layerMaps' in mat:
-                    layers = mat['layerMaps']
-                else:
-                    print(f"Bỏ qua {filename}: Không tìm thấy layer key")
-                    continue
-                
-                num_slices = images.shape[2]
-                
-                for i in range(num_slices):
-                    img_raw = images[:, :, i]
-                    layer_raw = layers[:, :, i] # Lấy lớp tương ứng với lát cắt
-                    
-                    # 1. Chuẩn hóa
-                    if np.max(img_raw) == np.min(img_raw): continue
-                    img_norm = (img_raw - np.min(img_raw)) / (np.max(img_raw) - np.min(img_raw)) * 255.0
-                    img_uint8 = img_norm.astype(np.uint8)
-                    
-                    # 2. Tạo Mask
-                    mask_uint8 = create_mask_from_layers(layer_raw, img_raw.shape)
-                    
-                    # 3. Chỉ lưu nếu mask hợp lệ (có vùng trắng > 500 pixel)
-                    if np.sum(mask_uint8 > 0) > 500:
-                         save_slice(img_uint8, mask_uint8, save_img_dir, save_mask_dir, filename, i)
-                         count_saved += 1
-                         
+                count_saved += len(process_subject(mat_path, subset_name))
             except Exception as e:
                 print(f"Lỗi file {filename}: {e}")
                 
@@ -131,6 +182,7 @@ def process_dataset():
 
 # --- HÀM VISUALIZE ĐỂ CHECK KẾT QUẢ ---
 def visualize_check():
+    import matplotlib.pyplot as plt  # Chỉ cần khi xem thử (import ~0.5 s)
     train_dir = os.path.join(config.PROCESSED_DATA_DIR, 'images', 'train')
     if not os.path.exists(train_dir) or not os.listdir(train_dir):
         print("Chưa có dữ liệu output.")
@@ -150,4 +202,5 @@ def visualize_check():
 
 if __name__ == "__main__":
     process_dataset()
+    pack_all()
     visualize_check()
\ No newline at end of file
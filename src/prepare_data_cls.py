@@ -4,6 +4,8 @@ import numpy as np
 from PIL import Image
 from tqdm import tqdm
 import config
+from pack_data import pack_all
+from utils import save_png_atomic
 
 # Cấu hình đường dẫn gốc
 SRINIVASAN_ROOT = os.path.join(config.RAW_DATA_DIR, '2014_BOE_Srinivasan', 'Publication_Dataset')
@@ -18,7 +20,48 @@ SPLIT_IDS = {
 
 CLASSES = ['AMD', 'DME', 'NORMAL']
 
+def process_patient(img_folder, class_name, folder_name, subset_name, img_size=None):
+    """
+    Xử lý một thư mục bệnh nhân (VD: AMD1) thành ảnh PNG + mask rỗng.
+    Trả về (danh sách tên file đã lưu, danh sách lỗi từng file).
+    """
+    img_size = img_size or config.IMG_SIZE
+    save_img_dir = os.path.join(config.PROCESSED_DATA_DIR, 'images', subset_name)
+    save_mask_dir = os.path.join(config.PROCESSED_DATA_DIR, 'masks', subset_name)
+    os.makedirs(save_img_dir, exist_ok=True)
+    os.makedirs(save_mask_dir, exist_ok=True)
+
+    # 2. Tạo Mask Rỗng (Dummy Mask - Đen xì)
+    # Vì dataset này không có mask, ta tạo ảnh đen để model không bị lỗi code
+    mask = Image.new('L', img_size, 0)
+
+    saved, errors = [], []
+    # Lấy tất cả ảnh .tif
+    files = sorted([f for f in os.listdir(img_folder) if f.endswith('.tif')])
+    
+    for filename in files:
+        src_path = os.path.join(img_folder, filename)
+        
+        # 1. Đọc và Resize ảnh
+        try:
+            img = Image.open(src_path).convert('L') # Chuyển xám
+            img = img.resize(img_size)
+            
+            # 3. Đặt tên file chứa NHÃN (Quan trọng cho bước sau)
+            # Format: Srinivasan_{CLASS}_{FOLDER}_{FILENAME}.png
+            # Ví dụ: Srinivasan_AMD_AMD1_01.png
+            new_filename = f"Srinivasan_{class_name}_{folder_name}_{filename.replace('.tif', '.png')}"
+            
+            # 4. Lưu
+            save_png_atomic(img, os.path.join(save_img_dir, new_filename))
+            save_png_atomic(mask, os.path.join(save_mask_dir, new_filename))
+            saved.append(new_filename)
+        except Exception as e:
+            errors.append(f"{src_path}: {e}")
+    return saved, errors
+
 def process_srinivasan():
+    # Bản tuần tự (1 process). Bản song song + chạy tiếp: prepare_pipeline.py
     print(f"--> Đang đọc dữ liệu từ: {SRINIVASAN_ROOT}")
     
     if not os.path.exists(SRINIVASAN_ROOT):
@@ -31,11 +74,6 @@ def process_srinivasan():
     for subset_name, id_range in SPLIT_IDS.items():
         print(f"\n--> Đang xử lý tập {subset_name.upper()}...")
         
-        save_img_dir = os.path.join(config.PROCESSED_DATA_DIR, 'images', subset_name)
-        save_mask_dir = os.path.join(config.PROCESSED_DATA_DIR, 'masks', subset_name)
-        os.makedirs(save_img_dir, exist_ok=True)
-        os.makedirs(save_mask_dir, exist_ok=True)
-        
         # Duyệt qua từng lớp bệnh (AMD, DME, NORMAL)
         for class_name in CLASSES:
             # Duyệt qua các ID bệnh nhân (VD: AMD1, AMD2...)
@@ -49,35 +87,13 @@ def process_srinivasan():
                     # Thử trường hợp folder tên 'Normal' viết thường/hoa khác nhau
                     continue 
                 
-                # Lấy tất cả ảnh .tif
-                files = sorted([f for f in os.listdir(img_folder) if f.endswith('.tif')])
-                
-                for filename in files:
-                    src_path = os.path.join(img_folder, filename)
-                    
-                    # 1. Đọc và Resize ảnh
-                    try:
-                        img = Image.open(src_path).convert('L') # Chuyển xám
-                        img = img.resize(config.IMG_SIZE)
-                        
-                        # 2. Tạo Mask Rỗng (Dummy Mask - Đen xì)
-                        # Vì dataset này không có mask, ta tạo ảnh đen để model không bị lỗi code
-                        mask = Image.new('L', config.IMG_SIZE, 0)
-                        
-                        # 3. Đặt tên file chứa NHÃN (Quan trọng cho bước sau)
-                        # Format: Srinivasan_{CLASS}_{FOLDER}_{FILENAME}.png
-                        # Ví dụ: Srinivasan_AMD_AMD1_01.png
-                        new_filename = f"Srinivasan_{class_name}_{folder_name}_{filename.replace('.tif', '.png')}"
-                        
-                        # 4. Lưu
-                        img.save(os.path.join(save_img_dir, new_filename))
-                        mask.save(os.path.join(save_mask_dir, new_filename))
-                        
-                        total_count += 1
-                    except Exception as e:
-                        print(f"Lỗi file {src_path}: {e}")
+                saved, errors = process_patient(img_folder, class_name, folder_name, subset_name)
+                total_count += len(saved)
+                for err in errors:
+                    print(f"Lỗi file {err}")
 
     print(f"\n--> HOÀN TẤT! Đã thêm {total_count} ảnh Srinivasan vào kho dữ liệu.")
 
 if __name__ == "__main__":
-    process_srinivasan()
\ No newline at end of file
+    process_srinivasan()
+    pack_all()
\ No newline at end of file
@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+import config
+from prepare_data import SPLIT_CONFIG, process_subject
+from prepare_data_cls import SRINIVASAN_ROOT, SPLIT_IDS, CLASSES, process_patient
+from pack_data import PACKED_DIR, pack_subset
+from utils import write_text_atomic
+
+# Pipeline chuẩn bị dữ liệu song song + chạy tiếp (resumable) cho cả Chiu và Srinivasan.
+# Mỗi task = 1 subject (.mat) hoặc 1 thư mục bệnh nhân (TIFFs), chạy trên process pool.
+# manifest.json lưu hash nội dung đầu vào + tham số của từng task: lần chạy sau
+# task nào không đổi (và output còn đủ) thì bỏ qua.
+#
+# Ví dụ:
+#   python prepare_pipeline.py --workers 8
+#   python prepare_pipeline.py --datasets chiu --img-size 512 512 --force
+MANIFEST_PATH = os.path.join(config.PROCESSED_DATA_DIR, 'manifest.json')
+PIPELINE_VERSION = 1
+
+CHIU_DIR = os.path.join(config.RAW_DATA_DIR, '2015_BOE_Chiu')
+
+
+def hash_inputs(paths, params):
+    """Hash nội dung các file đầu vào + tham số xử lý (subset, img_size, version)"""
+    h = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+    for path in paths:
+        h.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def discover_tasks(datasets):
+    tasks = []
+    if 'chiu' in datasets:
+        for subset_name, subject_list in SPLIT_CONFIG.items():
+            for subject_name in subject_list:
+                mat_path = os.path.join(CHIU_DIR, f"{subject_name}.mat")
+                if not os.path.exists(mat_path):
+                    continue
+                tasks.append({
+                    'key': f"chiu/{subject_name}",
+                    'stage': 'chiu',
+                    'subset': subset_name,
+                    'inputs': [mat_path],
+                })
+
+    if 'srinivasan' in datasets:
+        for subset_name, id_range in SPLIT_IDS.items():
+            for class_name in CLASSES:
+                for patient_id in id_range:
+                    folder_name = f"{class_name}{patient_id}"
+                    img_folder = os.path.join(SRINIVASAN_ROOT, folder_name, 'TIFFs', '8bitTIFFs')
+                    if not os.path.exists(img_folder):
+                        continue
+                    files = sorted([f for f in os.listdir(img_folder) if f.endswith('.tif')])
+                    tasks.append({
+                        'key': f"srinivasan/{folder_name}",
+                        'stage': 'srinivasan',
+                        'subset': subset_name,
+                        'inputs': [os.path.join(img_folder, f) for f in files],
+                        'class_name': class_name,
+                        'folder_name': folder_name,
+                        'img_folder': img_folder,
+                    })
+    return tasks
+
+
+def _output_paths(subset_name, names):
+    # Đường dẫn tương đối so với PROCESSED_DATA_DIR (ảnh + mask cùng tên)
+    return [os.path.join(kind, subset_name, name) for name in names for kind in ('images', 'masks')]
+
+
+def remove_outputs(outputs):
+    for rel_path in outputs:
+        path = os.path.join(config.PROCESSED_DATA_DIR, rel_path)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def run_task(task, img_size, prev_entry, force):
+    """Chạy trong worker process. Không raise: lỗi được trả về để pipeline báo cáo."""
+    start = time.perf_counter()
+    result = {'key': task['key'], 'stage': task['stage'], 'subset': task['subset']}
+    try:
+        params = {'version': PIPELINE_VERSION, 'stage': task['stage'],
+                  'subset': task['subset'], 'img_size': list(img_size)}
+        digest = hash_inputs(task['inputs'], params)
+
+        prev_outputs = prev_entry.get('outputs', []) if prev_entry else []
+        outputs_ok = all(os.path.exists(os.path.join(config.PROCESSED_DATA_DIR, p)) for p in prev_outputs)
+        if not force and prev_entry and prev_entry.get('hash') == digest and outputs_ok:
+            result.update(status='skipped', hash=digest, outputs=prev_outputs,
+                          images=0, errors=[], seconds=time.perf_counter() - start)
+            return result
+
+        # Đầu vào/tham số đổi (VD: đổi split) -> xóa output cũ trước khi ghi lại
+        remove_outputs(prev_outputs)
+
+        if task['stage'] == 'chiu':
+            saved = process_subject(task['inputs'][0], task['subset'], img_size)
+            errors = []
+        else:
+            saved, errors = process_patient(task['img_folder'], task['class_name'],
+                                            task['folder_name'], task['subset'], img_size)
+
+        result.update(status='failed' if errors else 'done', hash=None if errors else digest,
+                      outputs=_output_paths(task['subset'], saved), images=len(saved), errors=errors)
+    except Exception:
+        result.update(status='failed', hash=None, outputs=[], images=0,
+                      errors=[traceback.format_exc()])
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return {'version': PIPELINE_VERSION, 'tasks': {}}
+    with open(MANIFEST_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest):
+    os.makedirs(config.PROCESSED_DATA_DIR, exist_ok=True)
+    write_text_atomic(MANIFEST_PATH, json.dumps(manifest, indent=2))
+
+
+def _new_stage_stats():
+    return {'tasks': 0, 'done': 0, 'skipped': 0, 'failed': 0, 'images': 0,
+            'wall_seconds': 0.0, 'worker_seconds': 0.0}
+
+
+def run_pipeline(datasets=('chiu', 'srinivasan'), workers=None, img_size=None, force=False, pack=True):
+    img_size = tuple(img_size or config.IMG_SIZE)
+    workers = workers or os.cpu_count()
+    manifest = load_manifest()
+    tasks = discover_tasks(datasets)
+
+    # Task có trong manifest nhưng không còn trong split hiện tại -> dọn output mồ côi
+    current_keys = {t['key'] for t in tasks}
+    for key in list(manifest['tasks']):
+        if key.split('/')[0] in datasets and key not in current_keys:
+            remove_outputs(manifest['tasks'][key].get('outputs', []))
+            del manifest['tasks'][key]
+
+    stats = {stage: _new_stage_stats() for stage in datasets}
+    failures = []
+    changed_subsets = set()
+    print(f"--> {len(tasks)} task, {workers} worker, IMG_SIZE={img_size}")
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_task, t, img_size, manifest['tasks'].get(t['key']), force) for t in tasks]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Chuẩn bị dữ liệu"):
+            result = future.result()
+            stage = stats[result['stage']]
+            stage['tasks'] += 1
+            stage[result['status']] += 1
+            stage['images'] += result['images']
+            stage['worker_seconds'] += result['seconds']
+            stage['wall_seconds'] = time.perf_counter() - start
+
+            if result['status'] != 'skipped':
+                # Cả tập cũ (nếu task vừa đổi split) lẫn tập mới đều phải đóng gói lại
+                changed_subsets.add(result['subset'])
+                prev_entry = manifest['tasks'].get(result['key'])
+                if prev_entry:
+                    changed_subsets.add(prev_entry['subset'])
+            if result['status'] == 'failed':
+                failures.append(result)
+
+            # Ghi manifest sau MỖI task: bị kill giữa chừng thì lần sau chạy tiếp từ đây
+            manifest['tasks'][result['key']] = {
+                'hash': result['hash'], 'subset': result['subset'], 'outputs': result['outputs'],
+            }
+            save_manifest(manifest)
+
+    if pack:
+        pack_stats = _new_stage_stats()
+        pack_start = time.perf_counter()
+        for subset in ('train', 'val', 'test'):
+            meta_path = os.path.join(PACKED_DIR, subset, 'meta.json')
+            if subset in changed_subsets or force or not os.path.exists(meta_path):
+                count = pack_subset(subset)
+                pack_stats['images'] += count
+                pack_stats['done' if count else 'skipped'] += 1
+            else:
+                pack_stats['skipped'] += 1
+            pack_stats['tasks'] += 1
+        pack_stats['wall_seconds'] = pack_stats['worker_seconds'] = time.perf_counter() - pack_start
+        stats['pack'] = pack_stats
+
+    report_stats(stats)
+    for failure in failures:
+        print(f"LỖI {failure['key']}:")
+        for err in failure['errors']:
+            print(f"   {err}")
+    return stats, failures
+
+
+def report_stats(stats):
+    print("\n" + "=" * 72)
+    print(f"{'Stage':<12}{'Task':>6}{'Done':>6}{'Skip':>6}{'Fail':>6}{'Ảnh':>8}{'Wall(s)':>10}{'ảnh/s':>10}")
+    print("-" * 72)
+    for name, s in stats.items():
+        throughput = s['images'] / s['wall_seconds'] if s['wall_seconds'] > 0 else 0.0
+        print(f"{name:<12}{s['tasks']:>6}{s['done']:>6}{s['skipped']:>6}{s['failed']:>6}"
+              f"{s['images']:>8}{s['wall_seconds']:>10.2f}{throughput:>10.1f}")
+    print("=" * 72)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chuẩn bị dữ liệu Chiu + Srinivasan (song song, chạy tiếp được)")
+    parser.add_argument('--datasets', nargs='+', default=['chiu', 'srinivasan'], choices=['chiu', 'srinivasan'])
+    parser.add_argument('--workers', type=int, default=None, help="Số process (mặc định: số CPU)")
+    parser.add_argument('--img-size', type=int, nargs=2, default=None, metavar=('W', 'H'),
+                        help="Ghi đè config.IMG_SIZE")
+    parser.add_argument('--force', action='store_true', help="Bỏ qua manifest, xử lý lại toàn bộ")
+    parser.add_argument('--no-pack', action='store_true', help="Không đóng gói shard .npy sau khi xong")
+    parser.add_argument('--clean', action='store_true', help="Xóa toàn bộ data/processed trước khi chạy")
+    args = parser.parse_args()
+
+    if args.clean:
+        shutil.rmtree(config.PROCESSED_DATA_DIR, ignore_errors=True)
+        os.makedirs(config.PROCESSED_DATA_DIR, exist_ok=True)
+
+    _, failures = run_pipeline(args.datasets, args.workers, args.img_size, args.force, not args.no_pack)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import os
+import io
+import copy
+import json
+import argparse
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+import config
+from dataset import OCTDataset, decode_batch
+from model import load_model
+from evaluate import run_evaluation
+
+# Lượng tử hóa int8 sau huấn luyện (PTQ) cho suy luận CPU:
+#   - dynamic: chỉ Linear của classification_head (trọng số int8, activation lượng tử lúc chạy)
+#   - static : encoder + decoder conv, hiệu chỉnh (calibration) trên một phần OCTDataset('val')
+#   - static+dynamic: kết hợp cả hai
+# Mỗi biến thể được chấm lại bằng run_evaluation (Dice trên Chiu, Accuracy trên Srinivasan)
+# để so sánh độ chính xác vs latency với fp32. Ví dụ:
+#   python quantize.py --checkpoint ../weights/last.pth --calib-batches 16 --save
+VARIANTS = ('fp32', 'dynamic', 'static', 'static+dynamic')
+
+
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2**20
+
+
+def quantize_dynamic_head(model):
+    """Lượng tử hóa động các nn.Linear (chỉ có ở classification_head)"""
+    return quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8)
+
+
+class _FullForward(nn.Module):
+    """
+    Bọc MultiTaskUNet cho FX: forward(x) gọi model(x) với các cờ điều hướng (segment=...) là hằng
+    Python, nên symbolic trace không gặp rẽ nhánh trên Proxy.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x)
+
+
+@torch.no_grad()
+def calibrate(prepared, loader, num_batches):
+    for i, (images, masks, _) in enumerate(loader):
+        if i >= num_batches:
+            break
+        images, _ = decode_batch(images, masks)
+        prepared(images)
+
+
+def quantize_static(model, calib_loader, num_batches, engine='x86', dynamic_head=False):
+    """
+    PTQ tĩnh bằng FX graph mode cho encoder + decoder.
+    dynamic_head=True: classification_head giữ fp32 lúc hiệu chỉnh rồi lượng tử hóa động riêng.
+    """
+    torch.backends.quantized.engine = engine
+    qconfig_mapping = get_default_qconfig_mapping(engine)
+    if dynamic_head:
+        qconfig_mapping = qconfig_mapping.set_module_name('model.classification_head', None)
+
+    width, height = config.IMG_SIZE
+    example = (torch.rand(1, 1, height, width),)
+    prepared = prepare_fx(_FullForward(copy.deepcopy(model)).eval(), qconfig_mapping, example)
+    calibrate(prepared, calib_loader, num_batches)
+    quantized = convert_fx(prepared)
+
+    if dynamic_head:
+        quantized = quantize_dynamic(quantized, {nn.Linear}, dtype=torch.qint8)
+    return quantized
+
+
+def build_variant(name, model, calib_loader, args):
+    if name == 'fp32':
+        return model
+    if name == 'dynamic':
+        return quantize_dynamic_head(model)
+    if name == 'static':
+        return quantize_static(model, calib_loader, args.calib_batches, args.engine)
+    if name == 'static+dynamic':
+        return quantize_static(model, calib_loader, args.calib_batches, args.engine, dynamic_head=True)
+    raise ValueError(f"Biến thể không hợp lệ: {name}")
+
+
+def summarize(name, report, size_mb):
+    seg, cls, perf = report['segmentation'], report['classification'], report['performance']
+    return {
+        'variant': name,
+        'size_mb': size_mb,
+        'dice_global': seg['dice_global'],
+        'dice_mean': seg['dice_mean'],
+        'accuracy': cls['accuracy'],
+        'throughput_img_s': perf['throughput_img_s'],
+        'batch_latency_ms_p50': perf['batch_latency_ms']['p50'],
+        'batch_latency_ms_p90': perf['batch_latency_ms']['p90'],
+    }
+
+
+def compare_to_reference(rows, max_dice_drop, max_acc_drop):
+    """Thêm độ sụt Dice/Acc và hệ số tăng tốc so với fp32 -> quyết định có ship bản int8"""
+    ref = next((r for r in rows if r['variant'] == 'fp32'), None)
+    if ref is None:
+        return
+    for r in rows:
+        r['dice_drop'] = ref['dice_global'] - r['dice_global'] if ref['dice_global'] is not None else None
+        r['acc_drop'] = ref['accuracy'] - r['accuracy'] if ref['accuracy'] is not None else None
+        r['speedup'] = r['throughput_img_s'] / ref['throughput_img_s'] if ref['throughput_img_s'] else None
+        r['shippable'] = (
+            r['variant'] != 'fp32'
+            and (r['dice_drop'] is None or r['dice_drop'] <= max_dice_drop)
+            and (r['acc_drop'] is None or r['acc_drop'] <= max_acc_drop)
+            and (r['speedup'] or 0.0) > 1.0
+        )
+
+
+def _fmt(value, spec):
+    return format(value, spec) if value is not None else '-'
+
+
+def print_comparison(rows):
+    print("\n" + "=" * 92)
+    print(f"{'Biến thể':<16}{'MB':>8}{'Dice':>9}{'ΔDice':>9}{'Acc':>9}{'ΔAcc':>9}{'ảnh/s':>10}{'p50 ms':>10}{'x fp32':>9}")
+    print("-" * 92)
+    for r in rows:
+        dice_delta = -r['dice_drop'] if r.get('dice_drop') is not None else None
+        acc_delta = -r['acc_drop'] if r.get('acc_drop') is not None else None
+        print(f"{r['variant']:<16}{r['size_mb']:>8.1f}{_fmt(r['dice_global'], '>9.4f')}{_fmt(dice_delta, '>+9.4f')}"
+              f"{_fmt(r['accuracy'], '>9.4f')}{_fmt(acc_delta, '>+9.4f')}{r['throughput_img_s']:>10.1f}"
+              f"{_fmt(r['batch_latency_ms_p50'], '>10.1f')}{_fmt(r.get('speedup'), '>9.2f')}")
+    print("=" * 92)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lượng tử hóa int8 (PTQ) + báo cáo độ chính xác vs latency")
+    parser.add_argument('--checkpoint', default=os.path.join(config.WEIGHTS_DIR, "last.pth"))
+    parser.add_argument('--encoder', default="efficientnet-b0")
+    parser.add_argument('--variants', nargs='+', default=list(VARIANTS), choices=VARIANTS)
+    parser.add_argument('--calib-batches', type=int, default=16, help="Số batch của tập val dùng để hiệu chỉnh")
+    parser.add_argument('--eval-subset', default='test', choices=['val', 'test'])
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--engine', default='x86', choices=['x86', 'fbgemm', 'qnnpack'],
+                        help="Backend lượng tử: x86/fbgemm (Intel/AMD), qnnpack (ARM)")
+    parser.add_argument('--max-dice-drop', type=float, default=0.01)
+    parser.add_argument('--max-acc-drop', type=float, default=0.01)
+    parser.add_argument('--save', action='store_true', help="Lưu các biến thể int8 dạng TorchScript vào weights/export")
+    parser.add_argument('--report', default=os.path.join(config.BASE_DIR, 'reports', 'quantization.json'))
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    # Lượng tử hóa int8 của PyTorch chỉ chạy trên CPU
+    device = torch.device("cpu")
+    model = load_model(args.checkpoint, args.encoder, device)
+
+    # Hiệu chỉnh: lấy mẫu ngẫu nhiên (cố định seed) trong tập val để phủ cả Chiu lẫn Srinivasan
+    calib_dataset = OCTDataset(subset='val')
+    calib_loader = DataLoader(calib_dataset, batch_size=args.batch_size, shuffle=True,
+                              generator=torch.Generator().manual_seed(0))
+    eval_dataset = OCTDataset(subset=args.eval_subset)
+    eval_loader = DataLoader(eval_dataset, batch_size=args.batch_size, shuffle=False)
+    print(f"--> Hiệu chỉnh: {min(args.calib_batches * args.batch_size, len(calib_dataset))} ảnh val | "
+          f"Đánh giá: {len(eval_dataset)} ảnh {args.eval_subset}")
+
+    rows, export_paths = [], {}
+    for name in args.variants:
+        print(f"\n--> Biến thể: {name}")
+        variant = build_variant(name, model, calib_loader, args)
+        width, height = config.IMG_SIZE
+        with torch.inference_mode():
+            # Warmup để lần gọi đầu (cấp phát, chọn kernel) không bị tính vào latency
+            variant(torch.rand(args.batch_size, 1, height, width))
+        report = run_evaluation(variant, eval_loader, device)
+        rows.append(summarize(name, report, model_size_mb(variant)))
+
+        if args.save and name != 'fp32':
+            out_dir = os.path.join(config.WEIGHTS_DIR, 'export')
+            os.makedirs(out_dir, exist_ok=True)
+            stem = os.path.splitext(os.path.basename(args.checkpoint))[0]
+            path = os.path.join(out_dir, f"{stem}_{args.encoder}_int8_{name.replace('+', '_')}.pt")
+            with torch.no_grad():
+                torch.jit.trace(variant, torch.rand(1, 1, height, width)).save(path)
+            export_paths[name] = path
+            print(f"   Đã lưu: {path}")
+
+    compare_to_reference(rows, args.max_dice_drop, args.max_acc_drop)
+    print_comparison(rows)
+    for r in rows:
+        if r['variant'] == 'fp32' or 'shippable' not in r:
+            continue
+        if r['shippable']:
+            print(f"✅ {r['variant']}: ΔDice <= {args.max_dice_drop}, ΔAcc <= {args.max_acc_drop} và nhanh hơn fp32")
+        else:
+            print(f"❌ {r['variant']}: không nên ship (sụt độ chính xác hoặc không nhanh hơn fp32 trên CPU này)")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.report)), exist_ok=True)
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump({
+            'checkpoint': os.path.abspath(args.checkpoint),
+            'encoder': args.encoder,
+            'engine': args.engine,
+            'threads': torch.get_num_threads(),
+            'calib_batches': args.calib_batches,
+            'eval_subset': args.eval_subset,
+            'thresholds': {'max_dice_drop': args.max_dice_drop, 'max_acc_drop': args.max_acc_drop},
+            'results': rows,
+            'exports': export_paths,
+        }, f, indent=2)
+    print(f"--> Đã ghi báo cáo: {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import torch
+from model import load_model
+
+# Các backend suy luận dùng chung một giao diện:
+#   runner(batch float32 [B, 1, H, W], segment=True, classify=True)
+#       -> (seg_logits [B, 1, H, W] hoặc None, cls_logits [B, 3] hoặc None)
+# segment/classify: bool hoặc cờ từng ảnh (MultiTaskUNet.forward). Chỉ eager thực sự bỏ qua nhánh
+# không cần; artefact TorchScript/ONNX là graph đầy đủ nên vẫn chạy cả 2 nhánh rồi bỏ đầu ra thừa.
+# Predictor (backend/) và benchmark chỉ làm việc với runner, không cần biết model nằm ở đâu.
+BACKENDS = ('eager', 'torchscript', 'onnx')
+
+ONNX_INPUT = 'image'
+ONNX_OUTPUTS = ['seg_logits', 'cls_logits']
+
+
+def _drop_outputs(seg_logits, cls_logits, segment, classify):
+    """Graph đầy đủ: trả None cho nhánh không được yêu cầu (cờ False cho cả batch)"""
+    if segment is False:
+        seg_logits = None
+    if classify is False:
+        cls_logits = None
+    return seg_logits, cls_logits
+
+
+class EagerRunner:
+    """PyTorch eager từ checkpoint .pth (state_dict) - hỗ trợ bỏ qua nhánh theo từng ảnh"""
+    name = 'eager'
+
+    def __init__(self, weights_path, encoder_name="efficientnet-b0", device="cpu"):
+        self.device = torch.device(device)
+        self.model = load_model(weights_path, encoder_name, self.device)
+
+    @torch.inference_mode()
+    def __call__(self, batch, segment=True, classify=True):
+        return self.model(batch.to(self.device), segment=segment, classify=classify)
+
+
+class TorchScriptRunner:
+    """
+    TorchScript đã trace (export.py). optimize_for_inference = freeze (hằng hóa trọng số,
+    bỏ nhánh training như Dropout) + gộp Conv-BN, Conv-Add-ReLU... cho CPU.
+    """
+    name = 'torchscript'
+
+    def __init__(self, path, device="cpu", optimize=True):
+        self.device = torch.device(device)
+        module = torch.jit.load(path, map_location=self.device).eval()
+        self.module = torch.jit.optimize_for_inference(module) if optimize else module
+
+    @torch.inference_mode()
+    def __call__(self, batch, segment=True, classify=True):
+        return _drop_outputs(*self.module(batch.to(self.device)), segment, classify)
+
+
+class OnnxRunner:
+    """ONNX Runtime với graph optimization đầy đủ (gộp node, hằng hóa, layout NCHWc...)"""
+    name = 'onnx'
+
+    def __init__(self, path, device="cpu", num_threads=None):
+        import onnxruntime as ort  # Phụ thuộc tùy chọn, chỉ cần khi dùng backend onnx
+
+        self.device = torch.device(device)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        providers = ['CPUExecutionProvider']
+        if self.device.type == 'cuda':
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = ort.InferenceSession(path, options, providers=providers)
+
+    def __call__(self, batch, segment=True, classify=True):
+        inputs = {ONNX_INPUT: batch.detach().float().cpu().numpy()}
+        seg_logits, cls_logits = self.session.run(ONNX_OUTPUTS, inputs)
+        return _drop_outputs(torch.from_numpy(seg_logits).to(self.device),
+                             torch.from_numpy(cls_logits).to(self.device), segment, classify)
+
+
+def create_runner(backend, path, encoder_name="efficientnet-b0", device="cpu"):
+    """
+    Args:
+        backend: 'eager' (path = checkpoint .pth) / 'torchscript' (.pt) / 'onnx' (.onnx)
+    """
+    if backend == 'eager':
+        return EagerRunner(path, encoder_name, device)
+    if backend == 'torchscript':
+        return TorchScriptRunner(path, device)
+    if backend == 'onnx':
+        return OnnxRunner(path, device)
+    raise ValueError(f"Backend không hợp lệ: {backend} (chọn {BACKENDS})")
@@ -0,0 +1,124 @@
+import math
+import numpy as np
+from torch.utils.data import Sampler
+from pack_data import SOURCE_CHIU, SOURCE_SRINIVASAN, CLASS_MAP
+
+# Bộ dữ liệu trộn: vài trăm lát Chiu (có mask) với hàng nghìn ảnh Srinivasan (chỉ có nhãn bệnh).
+# Shuffle ngẫu nhiên -> phần lớn batch không có ảnh Chiu nào, loss segmentation = 0 mà decoder vẫn
+# chạy forward/backward. BalancedBatchSampler dựng batch từ chỉ mục (sources, labels) của OCTDataset
+# theo tỉ lệ Chiu:Srinivasan cố định và cân bằng AMD/DME/NORMAL.
+
+
+class _Pool:
+    """Hoán vị ngẫu nhiên của một nhóm chỉ số; hết thì xáo lại (lấy mẫu không lặp trong mỗi vòng)"""
+    def __init__(self, indices, rng):
+        self.indices = np.asarray(indices)
+        self.rng = rng
+        self._order, self._pos = None, 0
+
+    def __len__(self):
+        return len(self.indices)
+
+    def take(self, count):
+        out = []
+        while count > 0:
+            if self._order is None or self._pos == len(self._order):
+                self._order, self._pos = self.rng.permutation(self.indices), 0
+            chunk = self._order[self._pos:self._pos + count]
+            self._pos += len(chunk)
+            count -= len(chunk)
+            out.extend(chunk.tolist())
+        return out
+
+
+class BalancedBatchSampler(Sampler):
+    """
+    batch_sampler cho DataLoader (trả về list chỉ số mỗi batch).
+
+    Args:
+        sources, labels: chỉ mục dựng sẵn của OCTDataset (dataset.sources / dataset.labels)
+        chiu_fraction: tỉ lệ ảnh Chiu (có mask) trên tổng số ảnh
+        mix_within_batch: True -> MỖI batch có đúng round(batch_size * chiu_fraction) ảnh Chiu;
+                          False -> mỗi batch chỉ một nguồn, tỉ lệ batch Chiu = chiu_fraction
+                          (batch thuần Srinivasan bỏ qua được decoder, xem train.py --task-routing)
+        class_balanced: ảnh Srinivasan chia đều theo lớp (AMD/DME/NORMAL) thay vì theo tần suất gốc
+        num_batches: số batch mỗi epoch (mặc định = ceil(len(dataset) / batch_size) như shuffle thường)
+        seed: cố định chuỗi batch; set_epoch(epoch) đổi hoán vị giữa các epoch mà vẫn tái lập được
+        num_replicas / rank: huấn luyện phân tán (như DistributedSampler). Mọi process sinh CÙNG chuỗi
+                 num_batches batch (cùng seed + epoch), process rank lấy batch rank, rank + num_replicas...
+                 -> các process không trùng ảnh trong một vòng, mỗi batch vẫn giữ tỉ lệ Chiu / lớp,
+                 số batch mỗi process = ceil(num_batches / num_replicas) (bằng nhau, DDP cần vậy)
+    """
+    def __init__(self, sources, labels, batch_size, chiu_fraction=0.25, mix_within_batch=True,
+                 class_balanced=True, num_batches=None, seed=0, num_replicas=1, rank=0):
+        if not 0.0 <= chiu_fraction <= 1.0:
+            raise ValueError(f"chiu_fraction phải trong [0, 1], nhận được {chiu_fraction}")
+        self.sources = np.asarray(sources)
+        self.labels = np.asarray(labels)
+        self.batch_size = batch_size
+        self.mix_within_batch = mix_within_batch
+        self.class_balanced = class_balanced
+        self.num_batches = num_batches or math.ceil(len(self.labels) / batch_size)
+        self.seed = seed
+        self.epoch = 0
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"rank phải trong [0, {num_replicas}), nhận được {rank}")
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+        self.chiu_indices = np.flatnonzero(self.sources == SOURCE_CHIU)
+        is_sri = self.sources == SOURCE_SRINIVASAN
+        self.class_indices = [np.flatnonzero(is_sri & (self.labels == k)) for k in sorted(CLASS_MAP.values())]
+        self.class_indices = [idx for idx in self.class_indices if len(idx) > 0]
+        self.sri_indices = np.flatnonzero(is_sri)
+        if not self.class_indices:
+            self.class_balanced = False
+
+        # Nguồn nào rỗng thì dồn hết sang nguồn còn lại
+        if len(self.chiu_indices) == 0:
+            chiu_fraction = 0.0
+        elif len(self.sri_indices) == 0:
+            chiu_fraction = 1.0
+        self.chiu_fraction = chiu_fraction
+        if len(self.chiu_indices) == 0 and len(self.sri_indices) == 0:
+            raise ValueError("Dataset rỗng: không có ảnh Chiu lẫn Srinivasan")
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return math.ceil(self.num_batches / self.num_replicas)
+
+    def _take_srinivasan(self, count, class_pools, sri_pool, rng):
+        if not self.class_balanced:
+            return sri_pool.take(count)
+        # Chia đều count cho các lớp, phần dư cho các lớp chọn ngẫu nhiên
+        per_class = np.full(len(class_pools), count // len(class_pools))
+        per_class[rng.choice(len(class_pools), count % len(class_pools), replace=False)] += 1
+        out = []
+        for pool, n in zip(class_pools, per_class):
+            out.extend(pool.take(int(n)))
+        return out
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        chiu_pool = _Pool(self.chiu_indices, rng)
+        sri_pool = _Pool(self.sri_indices, rng)
+        class_pools = [_Pool(idx, rng) for idx in self.class_indices]
+
+        # Làm tròn lên bội số của num_replicas: process nào cũng đủ len(self) batch
+        for step in range(len(self) * self.num_replicas):
+            if self.mix_within_batch:
+                n_chiu = int(round(self.batch_size * self.chiu_fraction))
+                # Còn ảnh Chiu và tỉ lệ > 0 thì mỗi batch có ít nhất 1 ảnh có mask
+                if self.chiu_fraction > 0 and n_chiu == 0:
+                    n_chiu = 1
+            else:
+                n_chiu = self.batch_size if rng.random() < self.chiu_fraction else 0
+            batch = chiu_pool.take(n_chiu) if n_chiu else []
+            if self.batch_size - n_chiu > 0:
+                batch += self._take_srinivasan(self.batch_size - n_chiu, class_pools, sri_pool, rng)
+            rng.shuffle(batch)
+            # Batch của process khác vẫn phải sinh ra (giữ rng đồng bộ giữa các process)
+            if step % self.num_replicas == self.rank:
+                yield batch
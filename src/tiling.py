@@ -0,0 +1,133 @@
+import math
+import torch
+import torch.nn.functional as F
+import config
+
+# Suy luận sliding-window ở độ phân giải gốc: cắt ảnh thành các tile chồng lấn kích thước
+# IMG_SIZE (đúng kích thước lúc train), gom tile của NHIỀU ảnh thành batch, rồi ghép
+# seg logits bằng cửa sổ Gaussian (tâm tile tin cậy hơn mép) để không lộ đường nối.
+# Class logits của các tile được lấy trung bình thành 1 chẩn đoán/ảnh.
+
+
+def gaussian_window(height, width, sigma_scale=0.125, min_weight=1e-3, device="cpu"):
+    """Cửa sổ Gaussian 2D [H, W], đỉnh = 1 ở tâm, sigma = sigma_scale * cạnh tile"""
+    def axis(n):
+        coords = torch.arange(n, dtype=torch.float32, device=device) - (n - 1) / 2
+        return torch.exp(-0.5 * (coords / (sigma_scale * n)) ** 2)
+    window = axis(height)[:, None] * axis(width)[None, :]
+    # Không để trọng số = 0 ở mép: điểm ảnh chỉ được 1 tile phủ vẫn có giá trị
+    return window.clamp(min=min_weight)
+
+
+def tile_starts(length, tile, overlap):
+    """Vị trí bắt đầu các tile phủ kín [0, length), tile cuối căn sát mép"""
+    if length <= tile:
+        return [0]
+    stride = max(1, int(round(tile * (1 - overlap))))
+    num_tiles = math.ceil((length - tile) / stride) + 1
+    starts = [i * stride for i in range(num_tiles - 1)]
+    starts.append(length - tile)
+    return starts
+
+
+class TiledPredictor:
+    """
+    Bọc một model/runner: fn(batch [B, 1, th, tw]) -> (seg_logits [B, 1, th, tw], cls_logits [B, C]).
+    Tile được sinh lười (generator) và chạy theo từng nhóm tile_batch_size -> bộ nhớ đỉnh cho phần
+    forward chỉ phụ thuộc tile_batch_size, không phụ thuộc số ảnh / kích thước ảnh.
+    """
+    def __init__(self, model, tile_size=config.IMG_SIZE, overlap=0.25, tile_batch_size=16,
+                 sigma_scale=0.125, device="cpu"):
+        """
+        Args:
+            tile_size: (W, H) giống config.IMG_SIZE
+            overlap: tỉ lệ chồng lấn giữa 2 tile liền kề (0 -> không chồng lấn)
+        """
+        if not 0 <= overlap < 1:
+            raise ValueError(f"overlap phải trong [0, 1), nhận được {overlap}")
+        self.model = model
+        self.tile_width, self.tile_height = tile_size
+        self.overlap = overlap
+        self.tile_batch_size = tile_batch_size
+        self.device = torch.device(device)
+        self.window = gaussian_window(self.tile_height, self.tile_width, sigma_scale, device=self.device)
+        self.num_tiles = 0  # Đếm tile đã chạy (benchmark tiles/s)
+
+    def _pad(self, image):
+        """Ảnh nhỏ hơn tile -> pad phản chiếu (replicate nếu quá nhỏ để reflect) cho đủ 1 tile"""
+        _, height, width = image.shape
+        pad_h, pad_w = max(0, self.tile_height - height), max(0, self.tile_width - width)
+        if pad_h == 0 and pad_w == 0:
+            return image
+        mode = 'reflect' if pad_h < height and pad_w < width else 'replicate'
+        return F.pad(image[None], (0, pad_w, 0, pad_h), mode=mode)[0]
+
+    def _tiles(self, images):
+        for index, image in enumerate(images):
+            _, height, width = image.shape
+            for y in tile_starts(height, self.tile_height, self.overlap):
+                for x in tile_starts(width, self.tile_width, self.overlap):
+                    yield index, y, x
+
+    @torch.inference_mode()
+    def __call__(self, images):
+        """
+        Args:
+            images: list tensor float [1, H, W] (mỗi ảnh có thể khác kích thước) hoặc tensor [N, 1, H, W]
+        Returns:
+            seg_logits: list tensor [1, H, W] theo kích thước gốc của từng ảnh
+            cls_logits: tensor [N, C]
+        """
+        sizes = [tuple(image.shape[-2:]) for image in images]
+        padded = [self._pad(image.to(self.device)) for image in images]
+        seg_sum = [torch.zeros(image.shape[-2:], device=self.device) for image in padded]
+        weight_sum = [torch.zeros(image.shape[-2:], device=self.device) for image in padded]
+        cls_sum, cls_count = None, torch.zeros(len(padded), device=self.device)
+
+        def flush(jobs):
+            batch = torch.stack([padded[i][:, y:y + self.tile_height, x:x + self.tile_width] for i, y, x in jobs])
+            seg_logits, cls_logits = self.model(batch)
+            seg_logits = seg_logits[:, 0].float() * self.window
+            nonlocal cls_sum
+            if cls_sum is None:
+                cls_sum = torch.zeros(len(padded), cls_logits.shape[1], device=self.device)
+            for k, (i, y, x) in enumerate(jobs):
+                seg_sum[i][y:y + self.tile_height, x:x + self.tile_width] += seg_logits[k]
+                weight_sum[i][y:y + self.tile_height, x:x + self.tile_width] += self.window
+            # Class logits: trung bình trên mọi tile của cùng một ảnh
+            index = torch.tensor([i for i, _, _ in jobs], device=self.device)
+            cls_sum.index_add_(0, index, cls_logits.float())
+            cls_count.index_add_(0, index, torch.ones(len(jobs), device=self.device))
+            self.num_tiles += len(jobs)
+
+        jobs = []
+        for job in self._tiles(padded):
+            jobs.append(job)
+            if len(jobs) == self.tile_batch_size:
+                flush(jobs)
+                jobs = []
+        if jobs:
+            flush(jobs)
+
+        seg_logits = [(s / w)[None, :height, :width] for s, w, (height, width) in zip(seg_sum, weight_sum, sizes)]
+        cls_logits = cls_sum / cls_count[:, None]
+        return seg_logits, cls_logits
+
+    def count_tiles(self, height, width):
+        height, width = max(height, self.tile_height), max(width, self.tile_width)
+        return (len(tile_starts(height, self.tile_height, self.overlap))
+                * len(tile_starts(width, self.tile_width, self.overlap)))
+
+
+def resize_predict(model, images, img_size=config.IMG_SIZE):
+    """
+    Đường cũ để so sánh: resize cả ảnh về IMG_SIZE -> forward -> nội suy seg logits về kích thước gốc.
+    Cùng giao diện với TiledPredictor.__call__.
+    """
+    width, height = img_size
+    batch = torch.stack([F.interpolate(image[None].float(), size=(height, width), mode='bilinear',
+                                       align_corners=False)[0] for image in images])
+    seg_logits, cls_logits = model(batch)
+    seg_logits = [F.interpolate(s[None].float(), size=image.shape[-2:], mode='bilinear', align_corners=False)[0]
+                  for s, image in zip(seg_logits, images)]
+    return seg_logits, cls_logits.float()
@@ -1,109 +1,399 @@
 import torch
 import torch.optim as optim
-from torch.utils.data import DataLoader
 from tqdm import tqdm
+import time
+import random
+import argparse
 import os
+import contextlib
 import numpy as np
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DistributedSampler, Subset
 
 # Import các module
 import config
-from dataset import OCTDataset
+from dataset import OCTDataset, decode_batch
 from model import MultiTaskUNet
 from loss import MultiTaskLoss
-from metrics import compute_dice_score, compute_accuracy
+from metrics import MetricAccumulator
+from utils import resolve_amp_dtype, reset_peak_memory, peak_memory_mb, summarize_step_times
+from data_pipeline import build_loader, DevicePrefetcher, parse_workers, autotune_workers
+from augment import BatchAugment
+from sampler import BalancedBatchSampler
+from evaluate import run_evaluation
+from checkpoint import CheckpointManager, rank_state
+import distributed
+import instrument
+from instrument import StepProfiler, span, timed_iter
 
-def train_one_epoch(model, loader, criterion, optimizer, device):
+def train_one_epoch(model, loader, criterion, optimizer, device,
+                    amp_dtype=None, scaler=None, accum_steps=1, channels_last=False,
+                    log_every=config.LOG_EVERY, augment=None, task_routing='off', profiler=None):
+    """
+    Args:
+        model: MultiTaskUNet hoặc DistributedDataParallel bọc nó (chạy bằng torchrun)
+        amp_dtype: None (fp32) / torch.bfloat16 / torch.float16 cho torch.autocast
+        scaler: GradScaler (chỉ cần với fp16)
+        accum_steps: Cộng dồn gradient qua N batch rồi mới optimizer.step()
+        channels_last: Đưa ảnh đầu vào về NHWC (model cũng phải ở channels_last)
+        log_every: Số step giữa 2 lần đồng bộ metric về CPU để hiển thị
+        augment: BatchAugment áp dụng lên cả batch (ảnh + mask) trên device, sau khi giải mã
+        task_routing: 'off' -> chạy đủ 2 nhánh cho mọi ảnh
+                      'batch' -> bỏ decoder khi batch không có ảnh Chiu (label == -1)
+                      'sample' -> decoder chỉ chạy trên sub-batch Chiu, classification_head chỉ trên
+                                  sub-batch Srinivasan (ảnh còn lại không đóng góp vào loss tương ứng)
+        profiler: instrument.StepProfiler (torch.profiler cho một cửa sổ step) hoặc None
+    Các span (instrument.configure bật): data_wait, h2d, decode (uint8 -> float), augment, forward
+    (model/encoder, model/decoder, model/cls_head), loss, backward, optimizer, metrics;
+    prefetch/h2d (DevicePrefetcher, chạy chồng lấp với các span trên)
+    """
     model.train()
-    epoch_loss = 0
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    optimizer.zero_grad(set_to_none=True)
+    reset_peak_memory(device)
+    step_times = []
     
-    # Tạo 2 list riêng để lưu điểm của từng bộ
-    epoch_dice_chiu = []      
-    epoch_acc_srinivasan = [] 
+    # Cộng dồn loss/Dice (Chiu)/Acc (Srinivasan) ngay trên device, không sync mỗi step
+    meter = MetricAccumulator(device)
     
-    # Thanh progress bar
-    loop = tqdm(loader, desc="Training")
+    # Thanh progress bar (chỉ rank 0 khi huấn luyện phân tán)
+    loop = tqdm(loader, desc="Training", disable=not distributed.is_main_process())
     
-    for images, masks, labels in loop:
-        images = images.to(device)
-        masks = masks.to(device)
-        labels = labels.to(device)
+    step_start = time.perf_counter()
+    for step, (images, masks, labels) in enumerate(timed_iter(loop, 'data_wait')):
+        # Đã ở trên device nếu loader được bọc DevicePrefetcher (khi đó .to() không làm gì; thời gian copy
+        # thật nằm ở span prefetch/h2d của thread / stream phụ)
+        with span('h2d'):
+            images = images.to(device, non_blocking=True)
+            masks = masks.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+        with span('decode'):
+            images, masks = decode_batch(images, masks)
+        if augment is not None:
+            with span('augment'):
+                images, masks = augment(images, masks)
+        images = images.contiguous(memory_format=memory_format)
+        # Cờ tác vụ theo nhãn (CPU: miễn phí; CUDA: đồng bộ host 1 lần/step để biết kích thước sub-batch)
+        segment, classify = True, True
+        if task_routing == 'batch':
+            segment = bool((labels == -1).any())
+        elif task_routing == 'sample':
+            segment, classify = labels == -1, labels != -1
         
-        # 1. Forward
-        seg_pred, cls_pred = model(images)
+        # DDP: các batch cộng dồn giữa chừng không all_reduce gradient (chỉ step cuối mới đồng bộ)
+        sync_step = (step + 1) % accum_steps == 0 or (step + 1) == len(loader)
+        no_sync = model.no_sync() if not sync_step and isinstance(model, DistributedDataParallel) \
+            else contextlib.nullcontext()
         
-        # 2. Loss
-        loss, l_seg, l_cls = criterion(seg_pred, masks, cls_pred, labels)
+        with no_sync:
+            # 1. Forward (autocast tắt khi amp_dtype=None)
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                with span('forward'):
+                    seg_pred, cls_pred = model(images, segment=segment, classify=classify)
+                
+                # 2. Loss
+                with span('loss'):
+                    loss, l_seg, l_cls = criterion(seg_pred, masks, cls_pred, labels)
+            
+            # 3. Backward (chia loss cho accum_steps để gradient cộng dồn = trung bình)
+            with span('backward'):
+                scaled_loss = loss / accum_steps
+                if scaler is not None:
+                    scaler.scale(scaled_loss).backward()
+                else:
+                    scaled_loss.backward()
         
-        # 3. Backward
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        if sync_step:
+            # log_vars của loss nằm ngoài DDP -> tự lấy trung bình gradient giữa các process
+            distributed.average_gradients(criterion.parameters())
+            with span('optimizer'):
+                if scaler is not None:
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
+                    optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
         
         # 4. TÍNH ĐIỂM THÔNG MINH (SMART METRICS)
+        # Dice chỉ cộng cho ảnh Chiu (Label = -1), Acc chỉ cộng cho ảnh Srinivasan
+        with span('metrics'):
+            meter.update(seg_pred, masks, cls_pred, labels, loss)
+        if profiler is not None:
+            profiler.step()
         
-        # --- Chỉ tính Dice cho ảnh Chiu (Label = -1) ---
-        chiu_indices = (labels == -1)
-        if chiu_indices.sum() > 0:
-            # Lọc lấy ảnh Chiu ra để tính
-            dice_val = compute_dice_score(seg_pred[chiu_indices], masks[chiu_indices])
-            epoch_dice_chiu.append(dice_val)
-            
-        # --- Chỉ tính Acc cho ảnh Srinivasan (Label != -1) ---
-        sri_indices = (labels != -1)
-        if sri_indices.sum() > 0:
-            # Lọc lấy ảnh Srinivasan ra để tính
-            acc_val = compute_accuracy(cls_pred[sri_indices], labels[sri_indices])
-            epoch_acc_srinivasan.append(acc_val)
-        
-        epoch_loss += loss.item()
+        step_end = time.perf_counter()
+        step_times.append(step_end - step_start)
+        step_start = step_end
         
-        # Tính trung bình tạm thời để hiển thị
-        curr_dice = np.mean(epoch_dice_chiu) if len(epoch_dice_chiu) > 0 else 0.0
-        curr_acc = np.mean(epoch_acc_srinivasan) if len(epoch_acc_srinivasan) > 0 else 0.0
+        # Chỉ quy đổi về CPU mỗi log_every step để cập nhật thanh hiển thị
+        if (step + 1) % log_every == 0:
+            stats = meter.compute()
+            loop.set_postfix(
+                loss=f"{stats['loss']:.4f}", 
+                Seg_Dice=f"{stats['dice']:.4f}", 
+                Cls_Acc=f"{stats['acc']:.4f}",
+                step_ms=f"{np.mean(step_times[-log_every:]) * 1000:.0f}"
+            )
         
-        # Cập nhật thanh hiển thị: Tách rõ Seg_Dice và Cls_Acc
-        loop.set_postfix(
-            loss=f"{loss.item():.4f}", 
-            Seg_Dice=f"{curr_dice:.4f}", 
-            Cls_Acc=f"{curr_acc:.4f}"
-        )
+    # Thời gian mỗi step + đỉnh bộ nhớ để so sánh các chế độ (fp32/bf16/fp16, channels_last...)
+    timing = summarize_step_times(step_times)
+    print(f"   Step: mean={timing['mean_ms']:.1f}ms p50={timing['p50_ms']:.1f}ms "
+          f"p95={timing['p95_ms']:.1f}ms | Peak mem={peak_memory_mb(device):.0f}MB")
         
-    # Trả về trung bình của cả epoch
-    avg_loss = epoch_loss / len(loader)
-    avg_dice = np.mean(epoch_dice_chiu) if len(epoch_dice_chiu) > 0 else 0.0
-    avg_acc = np.mean(epoch_acc_srinivasan) if len(epoch_acc_srinivasan) > 0 else 0.0
-    
-    return avg_loss, avg_dice, avg_acc
+    # Trả về trung bình của cả epoch (+ thời gian mỗi step cho file metric), cộng qua mọi process
+    meter.all_reduce()
+    stats = meter.compute()
+    return stats['loss'], stats['dice'], stats['acc'], timing
+
+def validate(model, loader, device, amp_dtype=None, channels_last=False):
+    """
+    Chấm val_loader bằng run_evaluation -> metric chọn checkpoint:
+    val_dice (Dice gộp, Chiu), val_acc (Srinivasan), val_score = trung bình các metric có mặt
+    Huấn luyện phân tán: mỗi process chấm một shard của tập val, tổng pixel / số ảnh đúng được all_reduce.
+    """
+    report = run_evaluation(model, loader, device, amp_dtype, channels_last, progress=False)
+    seg, cls = report['segmentation'], report['classification']
+    if distributed.is_distributed():
+        totals = torch.tensor([seg['intersection_px'], seg['pred_px'], seg['true_px'], seg['num_images'],
+                               np.trace(np.asarray(cls['confusion_matrix'])), cls['num_images']],
+                              dtype=torch.float64)
+        inter, pred_px, true_px, n_chiu, correct, n_sri = distributed.all_reduce_sum(totals).tolist()
+        smooth = 1e-6  # Như mặc định của run_evaluation
+        seg = {'dice_global': (2. * inter + smooth) / (pred_px + true_px + smooth) if n_chiu else None}
+        cls = {'accuracy': correct / n_sri if n_sri else None}
+    metrics = {'val_dice': seg['dice_global'], 'val_acc': cls['accuracy']}
+    present = [v for v in metrics.values() if v is not None]
+    metrics['val_score'] = float(np.mean(present)) if present else None
+    return metrics
+
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Huấn luyện Multi-Task U-Net")
+    parser.add_argument('--amp', default=config.AMP_DTYPE, choices=['fp32', 'bf16', 'fp16'],
+                        help="Mixed precision: bf16 (CPU/GPU Ampere+), fp16 (GPU, kèm GradScaler)")
+    parser.add_argument('--channels-last', action='store_true', default=config.CHANNELS_LAST)
+    parser.add_argument('--accum-steps', type=int, default=config.GRAD_ACCUM_STEPS,
+                        help="Số batch cộng dồn gradient trước mỗi optimizer.step()")
+    parser.add_argument('--batch-size', type=int, default=config.BATCH_SIZE)
+    parser.add_argument('--epochs', type=int, default=config.NUM_EPOCHS)
+    parser.add_argument('--num-workers', type=parse_workers, default=config.NUM_WORKERS,
+                        help="Số worker DataLoader, 'auto' = đo thử và chọn số nhanh nhất")
+    parser.add_argument('--no-augment', dest='augment', action='store_false', default=config.AUGMENT,
+                        help="Tắt tăng cường dữ liệu theo batch (augment.py)")
+    parser.add_argument('--augment-seed', type=int, default=config.AUGMENT_SEED)
+    parser.add_argument('--sampler', default='balanced' if config.BALANCED_SAMPLER else 'random',
+                        choices=['balanced', 'random'], help="balanced: BalancedBatchSampler (sampler.py)")
+    parser.add_argument('--chiu-fraction', type=float, default=config.CHIU_FRACTION)
+    parser.add_argument('--split-sources', dest='mix_within_batch', action='store_false',
+                        default=config.MIX_WITHIN_BATCH, help="Mỗi batch chỉ một nguồn (Chiu hoặc Srinivasan)")
+    parser.add_argument('--task-routing', default=config.TASK_ROUTING, choices=['off', 'batch', 'sample'],
+                        help="Chỉ chạy decoder / classification_head cho ảnh cần (xem train_one_epoch)")
+    parser.add_argument('--no-prefetch', dest='prefetch', action='store_false', default=config.PREFETCH_TO_DEVICE,
+                        help="Tắt DevicePrefetcher (copy host->device chồng lấp với compute)")
+    parser.add_argument('--resume', default=None, metavar='CKPT',
+                        help="Tiếp tục từ checkpoint đầy đủ (.ckpt); 'auto' = weights/checkpoints/last.ckpt")
+    parser.add_argument('--encoder-weights', default=config.ENCODER_WEIGHTS or 'none', choices=['imagenet', 'none'],
+                        help="Pretrained cho encoder khi train từ đầu ('none': máy offline); resume thì bỏ qua")
+    parser.add_argument('--top-k', type=int, default=config.CHECKPOINT_TOP_K,
+                        help="Số checkpoint tốt nhất (theo metric validation) được giữ lại")
+    parser.add_argument('--no-async-save', dest='async_save', action='store_false', default=config.ASYNC_CHECKPOINT,
+                        help="Ghi checkpoint ngay trong vòng train thay vì thread nền")
+    parser.add_argument('--lr-scheduler', default=config.LR_SCHEDULER, choices=['none', 'cosine'])
+    parser.add_argument('--seed', type=int, default=config.SEED)
+    parser.add_argument('--loss-weighting', default=config.LOSS_WEIGHTING, choices=['fixed', 'uncertainty'],
+                        help="uncertainty: học trọng số seg/cls theo độ bất định của từng tác vụ")
+    parser.add_argument('--instrument', action='store_true', default=config.INSTRUMENT,
+                        help="Đo thời gian từng đoạn (data_wait, h2d, forward, loss, backward...), in mỗi epoch")
+    parser.add_argument('--profile-sync', action='store_true', default=config.PROFILE_SYNC_CUDA,
+                        help="Đồng bộ CUDA cuối mỗi span: thời gian GPU đúng span nhưng chậm vòng lặp")
+    parser.add_argument('--profile-steps', type=int, nargs=2, default=None, metavar=('START', 'COUNT'),
+                        help="torch.profiler cho COUNT step sau START step đầu của epoch đầu -> Chrome trace")
+    parser.add_argument('--metrics-file', default=config.METRICS_FILE,
+                        help="File JSONL metric theo epoch ('' -> không ghi)")
+    parser.add_argument('--sync-bn', action='store_true', default=config.SYNC_BN,
+                        help="DDP: BatchNorm đồng bộ thống kê giữa các process (chạy bằng torchrun)")
+    parser.add_argument('--dist-backend', default=config.DIST_BACKEND, choices=['gloo', 'nccl'])
+    parser.add_argument('--threads-per-proc', default='auto',
+                        help="DDP: số thread intra-op mỗi process ('auto' = số nhân / số process, 0 = giữ nguyên)")
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
+    # torchrun -> DDP nhiều process (xem distributed.py); chạy thường -> rank 0 / world_size 1
+    rank, world_size = distributed.init_distributed(args.dist_backend, args.threads_per_proc)
+    is_main = rank == 0
+    distributed.silence_non_main(is_main)
+    if args.seed is not None:
+        # Khác nhau giữa các process (dropout...); trọng số ban đầu vẫn giống nhau vì DDP broadcast từ rank 0
+        seed_everything(args.seed + rank)
     device = torch.device(config.DEVICE if torch.cuda.is_available() else "cpu")
+    if device.type == 'cuda' and world_size > 1:
+        device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+        torch.cuda.set_device(device)
     print(f"--> Device: {device}")
+    if world_size > 1:
+        print(f"--> DDP: {world_size} process ({args.dist_backend}), {torch.get_num_threads()} thread/process")
+    amp_dtype = resolve_amp_dtype(args.amp, device)
+    if args.instrument:
+        instrument.configure(enabled=True, sync_cuda=args.profile_sync)
+    effective_batch = args.batch_size * args.accum_steps * world_size
+    print(f"--> AMP: {args.amp} | channels_last: {args.channels_last} | Batch hiệu dụng: "
+          f"{args.batch_size} x {args.accum_steps} x {world_size} process = {effective_batch}")
 
     # Load dữ liệu
     train_dataset = OCTDataset(subset='train')
     val_dataset = OCTDataset(subset='val')
 
-    train_loader = DataLoader(train_dataset, batch_size=config.BATCH_SIZE, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=1, shuffle=False)
+    num_workers = args.num_workers
+    if num_workers == 'auto':
+        print("--> Dò số worker DataLoader...")
+        num_workers = autotune_workers(train_dataset, args.batch_size, device)['best']
+    batch_sampler = train_sampler = None
+    if args.sampler == 'balanced':
+        # Nhiều process: mỗi process lấy một phần chuỗi batch chung (không trùng ảnh)
+        batch_sampler = BalancedBatchSampler(train_dataset.sources, train_dataset.labels, args.batch_size,
+                                             args.chiu_fraction, args.mix_within_batch,
+                                             num_replicas=world_size, rank=rank)
+        print(f"--> Sampler cân bằng: Chiu {args.chiu_fraction:.0%} "
+              f"({'trong mỗi batch' if args.mix_within_batch else 'số batch'}), "
+              f"{len(batch_sampler.chiu_indices)} Chiu / {len(batch_sampler.sri_indices)} Srinivasan")
+    elif world_size > 1:
+        train_sampler = DistributedSampler(train_dataset, world_size, rank, shuffle=True, seed=args.seed or 0)
+    train_loader = build_loader(train_dataset, args.batch_size, True, device, num_workers,
+                                batch_sampler=batch_sampler, sampler=train_sampler)
+    num_val = len(val_dataset)
+    if world_size > 1:
+        # Mỗi process chấm một shard val (không lặp ảnh), validate() cộng kết quả lại
+        val_dataset = Subset(val_dataset, range(rank, num_val, world_size))
+    val_loader = build_loader(val_dataset, args.batch_size, False, device, num_workers)
+    if args.prefetch:
+        train_loader = DevicePrefetcher(train_loader, device)
+        val_loader = DevicePrefetcher(val_loader, device)
+    print(f"--> DataLoader: num_workers={num_workers} | prefetch lên device: {args.prefetch}")
 
     print(f"--> Số lượng ảnh Train: {len(train_dataset)}")
-    print(f"--> Số lượng ảnh Val: {len(val_dataset)}")
+    print(f"--> Số lượng ảnh Val: {num_val}")
+
+    # Mọi process đọc được checkpoint (resume), chỉ rank 0 ghi
+    checkpoints = CheckpointManager(top_k=args.top_k, metric=config.CHECKPOINT_METRIC,
+                                    async_save=args.async_save and is_main)
+    resume_path = None
+    if args.resume is not None:
+        resume_path = checkpoints.latest() if args.resume == 'auto' else args.resume
+        if resume_path is None:
+            print("--> Chưa có checkpoint để resume, huấn luyện từ đầu")
 
-    model = MultiTaskUNet(encoder_name="efficientnet-b0").to(device)
-    criterion = MultiTaskLoss().to(device)
-    optimizer = optim.AdamW(model.parameters(), lr=config.LEARNING_RATE)
+    # Resume -> trọng số encoder sẽ bị checkpoint ghi đè, không tải pretrained
+    encoder_weights = None if resume_path is not None or args.encoder_weights == 'none' else args.encoder_weights
+    model = MultiTaskUNet(encoder_name="efficientnet-b0", encoder_weights=encoder_weights).to(device)
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if args.sync_bn and world_size > 1:
+        # Thống kê BN trên batch toàn cục (batch mỗi process nhỏ); tạo optimizer SAU khi đổi lớp BN
+        routing_safe = batch_sampler is not None and batch_sampler.mix_within_batch \
+            and batch_sampler.chiu_fraction > 0
+        if args.task_routing != 'off' and not routing_safe:
+            # BN của decoder là collective: process nào bỏ qua decoder thì các process khác chờ mãi
+            print(f"--> --sync-bn: batch có thể thiếu ảnh Chiu -> tắt task routing ({args.task_routing} -> off)")
+            args.task_routing = 'off'
+        model = distributed.convert_sync_batchnorm(model, device)
+        print("--> SyncBatchNorm: bật")
+    criterion = MultiTaskLoss(uncertainty=args.loss_weighting == 'uncertainty', bce_weight=config.SEG_BCE_WEIGHT,
+                              dice_weight=config.SEG_DICE_WEIGHT).to(device)
+    # log_vars của loss (uncertainty) được tối ưu cùng model
+    optimizer = optim.AdamW(list(model.parameters()) + list(criterion.parameters()), lr=config.LEARNING_RATE)
+    scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=args.epochs) \
+        if args.lr_scheduler == 'cosine' else None
+    # GradScaler chỉ cần cho fp16 (bf16 đủ dải số mũ, không lo underflow gradient).
+    # torch.amp.GradScaler chỉ có từ torch 2.3; bản cũ hơn chỉ có bản CUDA (trên CPU tự tắt)
+    scaler = None
+    if amp_dtype == torch.float16:
+        scaler = torch.amp.GradScaler(device.type) if hasattr(torch.amp, 'GradScaler') \
+            else torch.cuda.amp.GradScaler(enabled=device.type == 'cuda')
+    # Mỗi process một chuỗi tham số augmentation riêng (cùng seed -> mọi rank biến đổi y hệt nhau)
+    augment_seed = args.augment_seed + rank if args.augment_seed is not None else None
+    augment = BatchAugment(seed=augment_seed) if args.augment else None
+    print(f"--> Augmentation theo batch: {args.augment} (seed={args.augment_seed})")
+
+    start_epoch, history = 0, []
+    if resume_path is not None:
+        start_epoch, history = checkpoints.restore(resume_path, model, optimizer, criterion, scheduler,
+                                                   scaler, augment, rank, world_size, args.seed)
+        print(f"--> Resume từ {resume_path}: tiếp tục ở epoch {start_epoch + 1}")
+
+    train_model = model
+    if world_size > 1:
+        train_model = distributed.wrap_ddp(model, device, args.sync_bn)
+
+    profiler = None
+    if args.profile_steps is not None and is_main:
+        profiler = StepProfiler(*args.profile_steps, output_dir=config.PROFILE_DIR, device=device)
+        print(f"--> torch.profiler: bỏ qua {args.profile_steps[0]} step, ghi {args.profile_steps[1]} step")
 
     print("--> Bắt đầu huấn luyện Multi-Task (Chế độ hiển thị tách biệt)...")
-    for epoch in range(config.NUM_EPOCHS):
-        print(f"\nEpoch {epoch+1}/{config.NUM_EPOCHS}")
+    for epoch in range(start_epoch, args.epochs):
+        print(f"\nEpoch {epoch+1}/{args.epochs}")
+        if batch_sampler is not None:
+            batch_sampler.set_epoch(epoch)
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         
-        loss, dice, acc = train_one_epoch(model, train_loader, criterion, optimizer, device)
+        epoch_start = time.perf_counter()
+        loss, dice, acc, timing = train_one_epoch(train_model, train_loader, criterion, optimizer, device,
+                                                  amp_dtype, scaler, args.accum_steps, args.channels_last,
+                                                  augment=augment, task_routing=args.task_routing,
+                                                  profiler=profiler)
+        train_seconds = time.perf_counter() - epoch_start
+        if profiler is not None and profiler.done:
+            profiler.close()
+            profiler = None
         
         # In kết quả tổng kết Epoch
         print(f"KẾT QUẢ: Loss={loss:.4f} | Seg Dice={dice:.4f} (Chiu) | Cls Acc={acc:.4f} (Srinivasan)")
-        
-        # Lưu checkpoint
-        torch.save(model.state_dict(), os.path.join(config.WEIGHTS_DIR, "last.pth"))
+        weight_seg, weight_cls = criterion.task_weights()
+        print(f"   Trọng số loss ({args.loss_weighting}): seg={weight_seg:.3f} cls={weight_cls:.3f}")
+
+        # Validation -> metric xếp hạng checkpoint
+        metrics = validate(model, val_loader, device, amp_dtype, args.channels_last)
+        print("   VAL: " + " | ".join(f"{k}={v:.4f}" for k, v in metrics.items() if v is not None))
+        # Span của cả epoch (train + eval/*), % tính trên tổng thời gian epoch
+        epoch_seconds = time.perf_counter() - epoch_start
+        spans = instrument.summary()
+        instrument.reset()
+        if spans:
+            print(instrument.format_summary(spans, epoch_seconds * 1000))
+        if scheduler is not None:
+            scheduler.step()
+        history.append({'epoch': epoch, 'loss': loss, 'dice': dice, 'acc': acc, **metrics})
+        if args.metrics_file and is_main:
+            # Span chỉ gồm count / tổng / phân vị (bỏ histogram) cho file gọn
+            instrument.append_jsonl(args.metrics_file, {
+                **history[-1], 'time': time.time(), 'train_seconds': train_seconds, 'epoch_seconds': epoch_seconds,
+                'lr': optimizer.param_groups[0]['lr'], 'task_weights': list(criterion.task_weights()),
+                'step': timing, 'peak_memory_mb': peak_memory_mb(device),
+                'spans': {name: {k: v for k, v in s.items() if k != 'histogram'} for name, s in spans.items()},
+            })
+
+        # Lưu checkpoint (chụp trạng thái sang CPU rồi ghi trên thread nền); DDP: trọng số mọi process
+        # giống nhau -> chỉ rank 0 ghi (model gốc, không tiền tố 'module.'), kèm trạng thái RNG của mọi rank
+        rank_states = distributed.all_gather_object(rank_state(augment)) if world_size > 1 else None
+        if is_main:
+            state = checkpoints.capture(epoch, model, optimizer, criterion, scheduler, scaler, augment, history,
+                                        rank_states)
+            if checkpoints.save(state, metrics):
+                print(f"   ⭐ Best {config.CHECKPOINT_METRIC} mới -> weights/best.pth")
+
+    if profiler is not None:
+        profiler.close()
+    checkpoints.close()
+    best = checkpoints.best
+    if best is not None:
+        print(f"--> Best: epoch {best['epoch'] + 1} ({config.CHECKPOINT_METRIC}={best['value']:.4f})")
+    distributed.cleanup()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,85 @@
+import os
+import numpy as np
+
+# --- GHI FILE NGUYÊN TỬ (ATOMIC) ---
+# Ghi ra file tạm cùng thư mục rồi os.replace: process bị kill giữa chừng
+# cũng không để lại file hỏng, lần chạy sau chỉ việc ghi đè lại.
+
+def _tmp_path(path):
+    return f"{path}.tmp{os.getpid()}"
+
+def save_png_atomic(pil_img, path):
+    tmp_path = _tmp_path(path)
+    pil_img.save(tmp_path, format='PNG')
+    os.replace(tmp_path, path)
+
+def save_npy_atomic(path, array):
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+def write_text_atomic(path, text):
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def save_torch_atomic(obj, path):
+    """torch.save + fsync trước khi rename: máy bị preempt ngay sau đó vẫn không mất checkpoint"""
+    import torch
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# --- ĐO HIỆU NĂNG ---
+# torch import trong hàm: các script chuẩn bị dữ liệu dùng utils mà không cần torch
+
+AMP_DTYPES = {'fp32': None, 'bf16': 'bfloat16', 'fp16': 'float16'}
+
+def resolve_amp_dtype(name, device):
+    """'fp32' / 'bf16' / 'fp16' -> dtype cho torch.autocast (None = tắt autocast)"""
+    import torch
+    if name not in AMP_DTYPES:
+        raise ValueError(f"AMP dtype không hợp lệ: {name} (chọn {list(AMP_DTYPES)})")
+    if AMP_DTYPES[name] is None:
+        return None
+    dtype = getattr(torch, AMP_DTYPES[name])
+    if dtype == torch.bfloat16 and device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+        raise ValueError("GPU hiện tại không hỗ trợ bf16, hãy dùng fp16")
+    if dtype == torch.float16 and device.type == 'cpu':
+        print("CẢNH BÁO: fp16 trên CPU thường chậm hơn fp32 rất nhiều, nên dùng bf16")
+    return dtype
+
+def reset_peak_memory(device):
+    import torch
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+def peak_memory_mb(device):
+    """Đỉnh bộ nhớ: VRAM đã cấp phát trên CUDA, RSS của process trên CPU"""
+    import torch
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    try:
+        import resource
+    except ImportError:  # Windows không có module resource
+        return 0.0
+    # ru_maxrss trên Linux tính bằng KB (và không reset được -> đỉnh từ lúc chạy)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def summarize_step_times(step_times):
+    """Thống kê thời gian mỗi step (giây) -> dict ms"""
+    if len(step_times) == 0:
+        return {'mean_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0}
+    # Bỏ step đầu (warm-up, cấp phát bộ nhớ, chọn thuật toán cuDNN/oneDNN)
+    times = np.asarray(step_times[1:] if len(step_times) > 1 else step_times) * 1000
+    return {
+        'mean_ms': float(times.mean()),
+        'p50_ms': float(np.percentile(times, 50)),
+        'p95_ms': float(np.percentile(times, 95)),
+    }
\ No newline at end of file
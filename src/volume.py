@@ -0,0 +1,277 @@
+import os
+import json
+import queue
+import argparse
+import threading
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+import config
+from lesion import lesion_stats, SEVERITY_LEVELS
+
+# Suy luận cho CẢ volume (1 file .mat Chiu [H, W, Depth] hoặc 1 chuỗi TIFF Srinivasan của một bệnh nhân):
+# lát cắt được đọc lười, tiền xử lý trên 1 thread nền vào vòng buffer (pinned khi chạy CUDA) rồi đẩy qua
+# model theo batch. Bộ nhớ làm việc = num_buffers x batch_size lát, không phụ thuộc độ sâu volume.
+# Ví dụ:
+#   python volume.py ../data/raw/2015_BOE_Chiu/Subject_10.mat --masks-out subject10_masks.npy
+CLASS_NAMES = ['AMD', 'DME', 'NORMAL']
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+def normalize_slice(img_raw):
+    """Min-max về uint8 giống prepare_data.py (lát cắt hằng -> ảnh đen)"""
+    img_raw = np.asarray(img_raw, dtype=np.float32)
+    low, high = img_raw.min(), img_raw.max()
+    if high == low:
+        return np.zeros(img_raw.shape, dtype=np.uint8)
+    return ((img_raw - low) / (high - low) * 255.0).astype(np.uint8)
+
+
+class MatVolume:
+    """
+    Volume Chiu: key 'images' [H, W, Depth] trong file .mat.
+    scipy.io.loadmat (MAT v5) không đọc được từng phần nên chỉ nạp đúng biến 'images'
+    (dữ liệu đầu vào, không phải bộ nhớ suy luận); chuẩn hóa uint8 làm lười theo từng lát.
+    """
+    def __init__(self, path):
+        import scipy.io  # Chỉ cần khi đọc .mat
+        self.path = path
+        self.images = scipy.io.loadmat(path, variable_names=['images'])['images']
+        self.shape = self.images.shape[:2]
+
+    def __len__(self):
+        return self.images.shape[2]
+
+    def __getitem__(self, index):
+        return normalize_slice(self.images[:, :, index])
+
+
+class TiffSeries:
+    """Chuỗi TIFF của 1 bệnh nhân (thư mục các file .tif, sắp theo tên) - mỗi lát mở khi cần"""
+    def __init__(self, folder):
+        self.path = folder
+        self.files = sorted(os.path.join(folder, f) for f in os.listdir(folder)
+                            if f.lower().endswith(TIFF_EXTENSIONS))
+        if not self.files:
+            raise ValueError(f"Không có file TIFF trong {folder}")
+        self.shape = self[0].shape
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index):
+        with Image.open(self.files[index]) as img:
+            return np.asarray(img.convert('L'))
+
+
+class TiffStack:
+    """1 file TIFF nhiều trang (mỗi trang 1 lát) - đọc trang theo chỉ số, không nạp cả file"""
+    def __init__(self, path):
+        self.path = path
+        with Image.open(path) as img:
+            self.num_frames = getattr(img, 'n_frames', 1)
+            self.shape = (img.height, img.width)
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, index):
+        with Image.open(self.path) as img:
+            img.seek(index)
+            return np.asarray(img.convert('L'))
+
+
+def open_volume(path):
+    """Đường dẫn .mat / thư mục TIFF / file TIFF nhiều trang -> volume đọc lười theo lát"""
+    if os.path.isdir(path):
+        return TiffSeries(path)
+    if path.lower().endswith('.mat'):
+        return MatVolume(path)
+    if path.lower().endswith(TIFF_EXTENSIONS):
+        return TiffStack(path)
+    raise ValueError(f"Định dạng volume không hỗ trợ: {path} (.mat, thư mục TIFF, TIFF nhiều trang)")
+
+
+class VolumeInference:
+    """
+    Chạy runner (runtime.py: batch [B, 1, h, w] -> (seg_logits, cls_logits)) trên cả volume.
+    Thread nền: đọc lát -> resize về img_size (PIL, như lúc chuẩn bị dữ liệu) -> ghi vào 1 trong
+    num_buffers buffer [batch_size, 1, h, w]; thread chính: copy lên device (non_blocking từ pinned
+    memory) -> forward -> nội suy seg logits về kích thước gốc -> ngưỡng. Trong lúc model chạy batch k,
+    batch k+1 đã được chuẩn bị sẵn.
+    """
+    def __init__(self, model, img_size=config.IMG_SIZE, batch_size=16, threshold=0.5, device="cpu",
+                 num_buffers=2):
+        self.model = model
+        self.img_size = tuple(img_size)
+        self.batch_size = batch_size
+        self.threshold = threshold
+        self.device = torch.device(device)
+        width, height = self.img_size
+        pin = self.device.type == 'cuda'
+        self.buffers = [torch.empty(batch_size, 1, height, width, pin_memory=pin) for _ in range(num_buffers)]
+
+    def _produce(self, volume, free, ready, stop):
+        try:
+            for start in range(0, len(volume), self.batch_size):
+                index = free.get()
+                if stop.is_set():  # Bên tiêu thụ đã dừng (lỗi) -> thoát
+                    return
+                count = min(self.batch_size, len(volume) - start)
+                buffer = self.buffers[index]
+                for k in range(count):
+                    img = volume[start + k]
+                    if img.shape != tuple(volume.shape):
+                        raise ValueError(f"Lát {start + k} có kích thước {img.shape} != {tuple(volume.shape)}")
+                    img = Image.fromarray(img)
+                    if img.size != self.img_size:
+                        img = img.resize(self.img_size)
+                    buffer[k, 0] = torch.from_numpy(np.asarray(img, dtype=np.float32) / 255.0)
+                ready.put((index, start, count))
+            ready.put(None)
+        except Exception as e:
+            ready.put(e)
+
+    @torch.inference_mode()
+    def __call__(self, volume, masks_out=None, voxel_size_mm=None, progress=None):
+        """
+        Args:
+            volume: đối tượng từ open_volume() (len + [i] -> uint8 [H, W])
+            masks_out: đường dẫn .npy -> mask stack ghi thẳng ra memmap (RAM không tăng theo độ sâu);
+                       None -> mảng trong RAM
+            voxel_size_mm: (dz, dy, dx) -> thêm lesion_volume_mm3
+            progress: hàm progress(số lát đã xong, tổng số lát) gọi sau mỗi batch (VD: cập nhật job)
+        Returns:
+            dict: masks (uint8 0/255 [D, H, W]), slice_probabilities [D, C], slice_lesion_area_px [D],
+                  slice_thickness_max_px [D], slice_severity [D] (chỉ số SEVERITY_LEVELS),
+                  diagnosis, confidence, probabilities (trung bình các lát), lesion_voxels,
+                  severity (lát nặng nhất), max_slice_area_px (...)
+        """
+        depth, (height, width) = len(volume), tuple(volume.shape)
+        if depth == 0:
+            raise ValueError("Volume rỗng (0 lát)")
+        if masks_out is not None:
+            masks = np.lib.format.open_memmap(masks_out, mode='w+', dtype=np.uint8, shape=(depth, height, width))
+        else:
+            masks = np.zeros((depth, height, width), dtype=np.uint8)
+        slice_probs = np.zeros((depth, len(CLASS_NAMES)), dtype=np.float32)
+        slice_area = np.zeros(depth, dtype=np.int64)
+        slice_thickness = np.zeros(depth, dtype=np.int64)
+        slice_severity = np.zeros(depth, dtype=np.int64)
+        logit_threshold = float(np.log(self.threshold / (1 - self.threshold)))
+
+        free, ready, stop = queue.Queue(), queue.Queue(), threading.Event()
+        for index in range(len(self.buffers)):
+            free.put(index)
+        producer = threading.Thread(target=self._produce, args=(volume, free, ready, stop), daemon=True)
+        producer.start()
+        try:
+            for item in iter(ready.get, None):
+                if isinstance(item, Exception):
+                    raise item
+                index, start, count = item
+                batch = self.buffers[index][:count].to(self.device, non_blocking=True)
+                seg_logits, cls_logits = self.model(batch)
+                seg_logits = F.interpolate(seg_logits.float(), size=(height, width), mode='bilinear',
+                                           align_corners=False)[:, 0]
+                batch_masks = seg_logits > logit_threshold
+                stats = lesion_stats(batch_masks)
+                probs = torch.softmax(cls_logits.float(), dim=1)
+
+                # .cpu() đồng bộ -> copy non_blocking đã xong, trả buffer cho thread nền dùng lại
+                masks[start:start + count] = (batch_masks.to(torch.uint8) * 255).cpu().numpy()
+                slice_area[start:start + count] = stats['area'].cpu().numpy()
+                slice_thickness[start:start + count] = stats['thickness_max'].cpu().numpy()
+                slice_severity[start:start + count] = stats['severity'].cpu().numpy()
+                slice_probs[start:start + count] = probs.cpu().numpy()
+                free.put(index)
+                if progress is not None:
+                    progress(start + count, depth)
+        finally:
+            stop.set()
+            free.put(None)  # Đánh thức thread nền nếu đang chờ buffer
+            producer.join()
+
+        if isinstance(masks, np.memmap):
+            masks.flush()
+
+        # Chẩn đoán mức bệnh nhân: trung bình xác suất các lát (+ số lát "bỏ phiếu" cho từng lớp)
+        patient_probs = slice_probs.mean(axis=0)
+        votes = np.bincount(slice_probs.argmax(axis=1), minlength=len(CLASS_NAMES))
+        pred = int(patient_probs.argmax())
+        result = {
+            'masks': masks,
+            'slice_probabilities': slice_probs,
+            'slice_lesion_area_px': slice_area,
+            'slice_thickness_max_px': slice_thickness,
+            'slice_severity': slice_severity,
+            'num_slices': depth,
+            'slice_shape': [height, width],
+            'probabilities': dict(zip(CLASS_NAMES, patient_probs.tolist())),
+            'slice_votes': dict(zip(CLASS_NAMES, votes.tolist())),
+            'diagnosis': CLASS_NAMES[pred],
+            'confidence': float(patient_probs[pred]),
+            'lesion_voxels': int(slice_area.sum()),
+            'max_slice_area_px': int(slice_area.max()),
+            'max_thickness_px': int(slice_thickness.max()),
+            'severity': SEVERITY_LEVELS[int(slice_severity.max())],
+        }
+        if voxel_size_mm is not None:
+            dz, dy, dx = voxel_size_mm
+            result['lesion_volume_mm3'] = result['lesion_voxels'] * dz * dy * dx
+        return result
+
+
+def summarize(result):
+    """Bỏ mask stack + mảng numpy -> dict ghi được JSON"""
+    arrays = ('masks', 'slice_probabilities', 'slice_lesion_area_px', 'slice_thickness_max_px', 'slice_severity')
+    summary = {k: v for k, v in result.items() if k not in arrays}
+    summary['slices'] = [
+        {'index': i, 'probabilities': dict(zip(CLASS_NAMES, probs)), 'lesion_area_px': area,
+         'lesion_thickness_max_px': thickness, 'severity': SEVERITY_LEVELS[severity]}
+        for i, (probs, area, thickness, severity) in enumerate(zip(
+            result['slice_probabilities'].tolist(), result['slice_lesion_area_px'].tolist(),
+            result['slice_thickness_max_px'].tolist(), result['slice_severity'].tolist()))
+    ]
+    return summary
+
+
+def main():
+    from runtime import create_runner, BACKENDS
+
+    parser = argparse.ArgumentParser(description="Suy luận cả volume (.mat / chuỗi TIFF)")
+    parser.add_argument('volume', help="File .mat, thư mục TIFF hoặc file TIFF nhiều trang")
+    parser.add_argument('--checkpoint', default=os.path.join(config.WEIGHTS_DIR, "last.pth"))
+    parser.add_argument('--backend', default='eager', choices=BACKENDS)
+    parser.add_argument('--encoder', default="efficientnet-b0")
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--voxel-size', type=float, nargs=3, default=None, metavar=('DZ', 'DY', 'DX'),
+                        help="Kích thước voxel (mm) để tính thể tích tổn thương")
+    parser.add_argument('--masks-out', default=None, help="Ghi mask stack ra file .npy (memmap)")
+    parser.add_argument('--report', default=None, help="File JSON kết quả")
+    args = parser.parse_args()
+
+    device = torch.device(config.DEVICE if torch.cuda.is_available() else "cpu")
+    runner = create_runner(args.backend, args.checkpoint, args.encoder, device)
+    volume = open_volume(args.volume)
+    print(f"--> Volume: {args.volume} ({len(volume)} lát {volume.shape[0]}x{volume.shape[1]})")
+
+    inference = VolumeInference(runner, batch_size=args.batch_size, threshold=args.threshold, device=device)
+    result = inference(volume, args.masks_out, args.voxel_size)
+
+    print(f"--> Chẩn đoán: {result['diagnosis']} ({result['confidence']:.2%}) | Phiếu: {result['slice_votes']}")
+    print(f"--> Tổn thương: {result['lesion_voxels']} voxel"
+          + (f" = {result['lesion_volume_mm3']:.3f} mm³" if 'lesion_volume_mm3' in result else "")
+          + f" | Mức độ: {result['severity']}")
+    if args.masks_out:
+        print(f"--> Đã ghi mask stack: {args.masks_out}")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(summarize(result), f, indent=2)
+        print(f"--> Đã ghi báo cáo: {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Test chạy từ gốc repo: module huấn luyện (src/) và backend import theo tên phẳng như khi chạy script
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ('src', 'backend'):
+    path = os.path.join(ROOT, folder)
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,104 @@
+import io
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip('httpx')
+from fastapi.testclient import TestClient
+import config
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    # app.py đọc cấu hình từ biến môi trường lúc import
+    tmp_dir = tmp_path_factory.mktemp('api')
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv('OCT_ALLOW_RANDOM_WEIGHTS', '1')
+        mp.setenv('OCT_DEVICE', 'cpu')
+        mp.setenv('OCT_MAX_WAIT_MS', '200')  # Cửa sổ gom rộng: các request đồng thời chắc chắn chung batch
+        mp.setenv('OCT_JOB_DB', str(tmp_dir / 'jobs.db'))
+        mp.setenv('OCT_STORAGE_DIR', str(tmp_dir / 'storage'))
+        mp.delenv('OCT_WEIGHTS', raising=False)
+        mp.delenv('OCT_CACHE_DIR', raising=False)
+        app_module = importlib.reload(importlib.import_module('app'))
+        with TestClient(app_module.app) as test_client:
+            yield test_client
+
+
+def _png(seed, size=(160, 200)):
+    image = np.random.default_rng(seed).integers(0, 256, size, dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def _analyze(client, seed, mode):
+    return client.post(f'/api/v1/exam/analyze?mode={mode}', files={'file': (f'scan_{seed}.png', _png(seed))})
+
+
+def test_health(client):
+    response = client.get('/api/v1/health')
+    assert response.status_code == 200
+    assert 'batcher' in response.json()
+
+
+def test_concurrent_analyze_is_micro_batched(client):
+    before = client.get('/api/v1/health').json()['batcher']
+    modes = ['full', 'classify'] * 4
+    with ThreadPoolExecutor(len(modes)) as pool:
+        responses = list(pool.map(lambda args: _analyze(client, *args), enumerate(modes)))
+
+    for response, mode in zip(responses, modes):
+        assert response.status_code == 200, response.text
+        body = response.json()
+        assert body['mode'] == mode
+        assert body['diagnosis'] in ('AMD', 'DME', 'NORMAL')
+        assert abs(sum(body['probabilities'].values()) - 1) < 1e-4
+        assert 0 <= body['confidence_score'] <= 1
+        assert body['original_size'] == [160, 200]  # [H, W] của ảnh upload
+        if mode == 'full':
+            assert body['mask_size'] == [config.IMG_SIZE[1], config.IMG_SIZE[0]]  # IMG_SIZE = (W, H)
+            assert body['mask_png_base64']
+            assert body['severity'] in ('None', 'Medium', 'High')
+            assert body['lesion_area_px'] >= 0
+        else:
+            assert 'mask_png_base64' not in body
+
+    after = client.get('/api/v1/health').json()['batcher']
+    batches, items = after['batches'] - before['batches'], after['items'] - before['items']
+    assert items == len(modes)
+    # Request full và classify được gom chung -> ít lần forward hơn số request
+    assert items / batches > 1
+    assert after['avg_batch_size'] > 1
+
+
+def test_repeated_image_is_cached(client):
+    first = _analyze(client, 100, 'full').json()
+    second = _analyze(client, 100, 'full').json()
+    assert not first['cached'] and second['cached']
+    assert second['diagnosis'] == first['diagnosis']
+
+
+def test_invalid_requests(client):
+    assert _analyze(client, 0, 'segment').status_code == 400
+    response = client.post('/api/v1/exam/analyze', files={'file': ('x.png', b'not an image')})
+    assert response.status_code == 400
+
+
+def test_upload_streams_files_to_storage(client):
+    scans = [_png(200), _png(201)]
+    response = client.post('/api/v1/exam/upload', files=[('files', (f'scan_{i}.png', data))
+                                                         for i, data in enumerate(scans)])
+    assert response.status_code == 202, response.text
+    job_id, storage = response.json()['job_id'], client.app.state.storage
+    assert storage.get('scans', f'{job_id}/00000_scan_0.png') == scans[0]
+    assert storage.get('scans', f'{job_id}/00001_scan_1.png') == scans[1]
+
+    empty = client.post('/api/v1/exam/upload', files=[('files', ('a.png', _png(1))), ('files', ('b.png', b''))])
+    assert empty.status_code == 400 and 'rỗng' in empty.json()['detail']
+    # 'a b.tif' và 'a_b.tif' trùng sau safe_name -> volume giữ tên file nên phải từ chối
+    duplicate = client.post('/api/v1/exam/upload-volume', files=[('files', ('a b.tif', b'1')),
+                                                                 ('files', ('a_b.tif', b'2'))])
+    assert duplicate.status_code == 400 and 'Trùng' in duplicate.json()['detail']
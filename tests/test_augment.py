@@ -0,0 +1,53 @@
+import torch
+from augment import BatchAugment
+
+
+def _masks(batch_size=4, height=64, width=96):
+    """Mask nhị phân có các khối lệch tâm -> lật / xoay / tịnh tiến đều làm đổi vị trí điểm ảnh"""
+    masks = torch.zeros(batch_size, 1, height, width)
+    for i in range(batch_size):
+        masks[i, 0, 8 + 2 * i:30 + 2 * i, 10 + 5 * i:40 + 3 * i] = 1
+        masks[i, 0, 40:56, 60 + i:90] = 1
+    return masks
+
+
+def test_flip_applies_same_transform_to_image_and_mask():
+    augment = BatchAugment(hflip_p=0.5, vflip_p=0.5, affine_p=0, intensity_p=0, speckle_p=0, seed=0)
+    masks = _masks(16)
+    images, out_masks = augment(masks.clone(), masks.clone())
+    # Ảnh chính là mask -> mọi biến đổi hình học phải cho ra đúng mask đã biến đổi
+    assert torch.equal(images, out_masks)
+    assert not torch.equal(out_masks, masks)
+
+
+def test_affine_keeps_image_and_mask_aligned():
+    augment = BatchAugment(hflip_p=0.5, affine_p=1.0, max_rotate_deg=10, intensity_p=0, speckle_p=0, seed=1)
+    masks = _masks()
+    images, out_masks = augment(masks.clone(), masks.clone())
+    assert set(out_masks.unique().tolist()) <= {0.0, 1.0}  # nearest -> mask vẫn nhị phân
+    assert not torch.equal(out_masks, masks)
+    # Ảnh nội suy bilinear chỉ lệch mask ở viền khối
+    agreement = ((images > 0.5).float() == out_masks).float().mean()
+    assert agreement > 0.98
+
+
+def test_same_seed_same_output():
+    images, masks = torch.rand(4, 1, 32, 48), _masks(4, 32, 48)
+    first = BatchAugment(seed=7)(images, masks)
+    second = BatchAugment(seed=7)(images, masks)
+    other = BatchAugment(seed=8)(images, masks)
+    assert all(torch.equal(a, b) for a, b in zip(first, second))
+    assert not torch.equal(first[0], other[0])
+
+
+def test_state_dict_round_trip():
+    images, masks = torch.rand(4, 1, 32, 48), _masks(4, 32, 48)
+    augment = BatchAugment(seed=3)
+    augment(images, masks)
+    state = augment.state_dict()
+    expected = augment(images, masks)
+
+    restored = BatchAugment(seed=99)
+    restored.load_state_dict(state)
+    assert restored.seed == 3
+    assert all(torch.equal(a, b) for a, b in zip(restored(images, masks), expected))
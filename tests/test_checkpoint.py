@@ -0,0 +1,51 @@
+import pickle
+import random
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+from augment import BatchAugment
+from checkpoint import CheckpointManager, load_weights
+
+
+def _draws():
+    return random.random(), float(np.random.rand()), float(torch.rand(1))
+
+
+def _setup():
+    model = nn.Sequential(nn.Conv2d(1, 2, 3), nn.BatchNorm2d(2))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    model(torch.rand(2, 1, 8, 8)).sum().backward()
+    optimizer.step()
+    return model, optimizer
+
+
+def test_full_checkpoint_loads_with_weights_only(tmp_path):
+    manager = CheckpointManager(tmp_path / 'ckpt', export_dir=None, async_save=False)
+    model, optimizer = _setup()
+    augment = BatchAugment(seed=5)
+    manager.save(manager.capture(0, model, optimizer, augment=augment, history=[{'epoch': 0, 'loss': 1.0}]))
+    state = torch.load(manager.latest(), weights_only=True)  # Không cần pickle đầy đủ
+    assert state['epoch'] == 0
+    assert set(load_weights(manager.latest())) == set(model.state_dict())
+
+
+def test_restore_rng_state(tmp_path):
+    manager = CheckpointManager(tmp_path / 'ckpt', export_dir=None, async_save=False)
+    model, optimizer = _setup()
+    state = manager.capture(3, model, optimizer)
+    manager.save(state)
+    expected = _draws()
+
+    _draws()  # Đổi trạng thái RNG trước khi resume
+    next_epoch, _ = manager.restore(manager.latest(), *_setup())
+    assert next_epoch == 4
+    assert _draws() == expected
+
+
+def test_untrusted_pickle_is_rejected(tmp_path):
+    path = tmp_path / 'evil.pth'
+    torch.save({'model': {}, 'payload': np.zeros(3)}, path)  # ndarray -> cần pickle đầy đủ
+    with pytest.raises(pickle.UnpicklingError):
+        load_weights(path)
+    assert load_weights(path, trusted=True) == {}
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import torch
+from lesion import encode_mask, decode_mask, lesion_stats, stats_to_records, _HEADER, _RLE16, _RLE32, _BITPACK
+
+
+def _kind(data):
+    return _HEADER.unpack_from(data)[1]
+
+
+def _round_trip(mask):
+    data = encode_mask(mask)
+    decoded = decode_mask(data)
+    assert decoded.dtype == np.uint8 and decoded.shape == mask.shape
+    np.testing.assert_array_equal(decoded, np.where(mask != 0, 255, 0).astype(np.uint8))
+    return data
+
+
+def test_empty_mask():
+    data = _round_trip(np.zeros((64, 80), dtype=np.uint8))
+    assert _kind(data) == _RLE16 and len(data) == _HEADER.size + 2  # Một đoạn nền duy nhất
+
+
+def test_full_mask():
+    data = _round_trip(np.full((64, 80), 255, dtype=np.uint8))
+    assert _kind(data) == _RLE16
+
+
+def test_first_pixel_set():
+    mask = np.zeros((32, 32), dtype=bool)
+    mask[0, 0] = True
+    mask[5, 3:9] = True
+    assert _kind(_round_trip(mask)) == _RLE16
+
+
+def test_long_runs_use_rle32():
+    mask = np.zeros((400, 400), dtype=np.uint8)  # 2 đoạn 80000 pixel > 0xFFFF
+    mask[200:, :] = 255
+    data = _round_trip(mask)
+    assert _kind(data) == _RLE32
+    assert len(data) == _HEADER.size + 2 * 4
+
+
+def test_noisy_mask_falls_back_to_bitpack():
+    mask = np.random.default_rng(0).random((61, 77)) > 0.5  # Số pixel không chia hết cho 8
+    data = _round_trip(mask)
+    assert _kind(data) == _BITPACK
+    assert len(data) == _HEADER.size + (61 * 77 + 7) // 8
+
+
+def test_decode_rejects_bad_data():
+    with pytest.raises(ValueError):
+        decode_mask(b'PNG' + encode_mask(np.zeros((4, 4)))[3:])
+    for mask in (np.pad(np.ones((4, 4), dtype=bool), 6), np.random.default_rng(1).random((16, 16)) > 0.5):
+        with pytest.raises(ValueError):
+            decode_mask(encode_mask(mask)[:-2])  # Thiếu byte cuối (RLE / bit-packed)
+
+
+def test_lesion_stats():
+    masks = torch.zeros(2, 20, 30, dtype=torch.bool)
+    masks[0, 4:10, 5:15] = True   # 6 x 10 = 60 pixel
+    masks[0, 12, 20] = True
+    stats = stats_to_records(lesion_stats(masks, severity_thresholds=(0.01, 0.2)))
+    assert stats[0]['lesion_area_px'] == 61
+    assert stats[0]['lesion_bbox'] == [4, 5, 12, 20]
+    assert stats[0]['lesion_thickness_max_px'] == 6
+    assert stats[0]['lesion_thickness_mean_px'] == pytest.approx(61 / 11)
+    assert stats[0]['severity'] == 'Medium'  # 61 / 600 pixel ~ 10% diện tích
+    assert stats[1] == {'lesion_area_px': 0, 'lesion_bbox': None, 'lesion_thickness_max_px': 0,
+                        'lesion_thickness_mean_px': 0.0, 'thickness_profile_px': [0] * 30, 'severity': 'None'}
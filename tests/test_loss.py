@@ -0,0 +1,88 @@
+import torch
+import torch.nn.functional as F
+from loss import _FusedDiceBCE, masked_dice_bce, MultiTaskLoss
+
+
+def _reference(logits, target, bce_weight, dice_weight, smooth):
+    """BCE + (1 - Dice) không gộp, autograd tự tính gradient"""
+    x, t = logits.flatten(1), target.flatten(1)
+    p = torch.sigmoid(x)
+    bce = F.binary_cross_entropy_with_logits(x, t, reduction='none').mean(1)
+    dice = (2 * (p * t).sum(1) + smooth) / (p.sum(1) + t.sum(1) + smooth)
+    return (bce_weight * bce + dice_weight * (1 - dice)).mean()
+
+
+def _inputs(seed=0, shape=(3, 1, 5, 6)):
+    generator = torch.Generator().manual_seed(seed)
+    logits = torch.randn(shape, generator=generator, dtype=torch.float64, requires_grad=True)
+    target = (torch.rand(shape, generator=generator) > 0.6).double()
+    target[0].zero_()  # Ảnh không có tổn thương (mask rỗng)
+    return logits, target
+
+
+def test_fused_backward_gradcheck():
+    logits, target = _inputs()
+    for weights in ((1.0, 1.0, 1.0), (0.3, 2.0, 0.5)):
+        assert torch.autograd.gradcheck(lambda x: _FusedDiceBCE.apply(x, target, *weights), (logits,))
+
+
+def test_fused_matches_unfused_reference():
+    logits, target = _inputs(1, (4, 1, 8, 8))
+    for weights in ((1.0, 1.0, 1.0), (0.5, 2.0, 1e-3)):
+        fused = _FusedDiceBCE.apply(logits, target, *weights)
+        grad_fused, = torch.autograd.grad(fused, logits)
+        reference = _reference(logits, target, *weights)
+        grad_reference, = torch.autograd.grad(reference, logits)
+        torch.testing.assert_close(fused, reference)
+        torch.testing.assert_close(grad_fused, grad_reference)
+
+
+def test_fused_under_low_precision_input():
+    logits, target = _inputs(2)
+    fused = _FusedDiceBCE.apply(logits.detach().bfloat16().requires_grad_(), target, 1.0, 1.0, 1.0)
+    assert fused.dtype == torch.float32
+    torch.testing.assert_close(fused.double(), _reference(logits.detach().bfloat16().double(), target,
+                                                          1.0, 1.0, 1.0), rtol=1e-5, atol=1e-5)
+
+
+def test_multitask_loss_under_autocast_matches_fp32():
+    generator = torch.Generator().manual_seed(5)
+    seg_pred = (torch.randn(3, 1, 32, 32, generator=generator) * 3).requires_grad_()
+    seg_target = (torch.rand(3, 1, 32, 32, generator=generator) > 0.3).float()
+    cls_pred = torch.randn(3, 3, generator=generator, requires_grad=True)
+    labels = torch.tensor([-1, -1, 1])  # 2 ảnh Chiu (seg) + 1 ảnh Srinivasan (cls)
+    criterion = MultiTaskLoss()
+
+    def loss_and_grad(autocast):
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled=autocast):
+            _, loss_seg, _ = criterion(seg_pred, seg_target, cls_pred, labels)
+        grad, = torch.autograd.grad(loss_seg, seg_pred)
+        return loss_seg, grad
+
+    loss_amp, grad_amp = loss_and_grad(True)
+    loss_fp32, grad_fp32 = loss_and_grad(False)
+    assert loss_amp.dtype == torch.float32
+    # Đầu vào giống hệt (fp32), chỉ khác autocast -> phải khớp fp32 (bmm bf16 lệch ~1e-3)
+    torch.testing.assert_close(loss_amp, loss_fp32)
+    torch.testing.assert_close(grad_amp, grad_fp32)
+
+
+def test_masked_dice_bce_only_selected_images_get_gradient():
+    logits, target = _inputs(3, (4, 1, 6, 6))
+    sample_mask = torch.tensor([True, False, True, False])
+    loss = masked_dice_bce(logits, target, sample_mask)
+    loss.backward()
+    assert logits.grad[~sample_mask].abs().sum() == 0
+    torch.testing.assert_close(loss, _reference(logits[sample_mask], target[sample_mask], 1.0, 1.0, 1.0))
+    assert masked_dice_bce(logits, target, torch.zeros(4, dtype=torch.bool)) is None
+
+
+def test_multitask_loss_skips_absent_task():
+    criterion = MultiTaskLoss(uncertainty=True)
+    seg_pred, seg_target = _inputs(4, (2, 1, 6, 6))
+    cls_pred = torch.randn(2, 3, requires_grad=True)
+    # Cả batch là ảnh Srinivasan -> không có loss segmentation, s_seg không nhận gradient
+    total, loss_seg, loss_cls = criterion(seg_pred, seg_target, cls_pred, torch.tensor([0, 2]))
+    total.backward()
+    assert loss_seg == 0 and loss_cls > 0
+    assert criterion.log_vars.grad[0] == 0 and criterion.log_vars.grad[1] != 0
@@ -0,0 +1,71 @@
+import os
+import pytest
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from distributed import CPUSyncBatchNorm, convert_sync_batchnorm
+
+WORLD_SIZE = 2
+CHANNELS = 3
+
+
+def _global_batch():
+    """Batch toàn cục [4, C, 5, 6] + hệ số loss cố định; mỗi process lấy 2 ảnh (batch nhỏ, lệch nhau)"""
+    generator = torch.Generator().manual_seed(0)
+    inputs = torch.randn(4, CHANNELS, 5, 6, generator=generator, dtype=torch.float64) * 2 + 1
+    inputs[2:] += 3  # Thống kê 2 shard khác hẳn nhau -> BN cục bộ sẽ cho kết quả sai
+    loss_weights = torch.randn(inputs.shape, generator=generator, dtype=torch.float64)
+    return inputs, loss_weights
+
+
+def _reference_bn():
+    bn = nn.BatchNorm2d(CHANNELS, momentum=0.3).double()
+    with torch.no_grad():
+        bn.weight.copy_(torch.tensor([0.5, 1.5, -1.0]))
+        bn.bias.copy_(torch.tensor([0.1, -0.2, 0.3]))
+    return bn
+
+
+def _worker(rank, store_path, result_dir):
+    dist.init_process_group('gloo', init_method=f"file://{store_path}", rank=rank, world_size=WORLD_SIZE)
+    try:
+        model = convert_sync_batchnorm(nn.Sequential(_reference_bn()), 'cpu')
+        bn = model[0]
+        assert isinstance(bn, CPUSyncBatchNorm)
+        inputs, loss_weights = _global_batch()
+        shard = slice(2 * rank, 2 * rank + 2)
+        x = inputs[shard].clone().requires_grad_()
+        # 2 step: step 2 dùng running stats đã cập nhật ở step 1 như BatchNorm thường
+        for _ in range(2):
+            out = model(x)
+            (out * loss_weights[shard]).sum().backward()
+        torch.save({'out': out.detach(), 'grad_input': x.grad, 'grad_weight': bn.weight.grad,
+                    'grad_bias': bn.bias.grad, 'running_mean': bn.running_mean, 'running_var': bn.running_var,
+                    'num_batches_tracked': bn.num_batches_tracked},
+                   os.path.join(result_dir, f"rank{rank}.pt"))
+    finally:
+        dist.destroy_process_group()
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="torch.distributed không có")
+def test_cpu_sync_batchnorm_matches_full_batch(tmp_path):
+    mp.spawn(_worker, args=(str(tmp_path / 'store'), str(tmp_path)), nprocs=WORLD_SIZE, join=True)
+    results = [torch.load(tmp_path / f"rank{rank}.pt") for rank in range(WORLD_SIZE)]
+
+    bn = _reference_bn()
+    inputs, loss_weights = _global_batch()
+    x = inputs.clone().requires_grad_()
+    for _ in range(2):
+        out = bn(x)
+        (out * loss_weights).sum().backward()
+
+    torch.testing.assert_close(torch.cat([r['out'] for r in results]), out.detach())
+    torch.testing.assert_close(torch.cat([r['grad_input'] for r in results]), x.grad)
+    # Gradient weight / bias để cục bộ (DDP cộng / lấy trung bình sau) -> tổng các process = full batch
+    torch.testing.assert_close(sum(r['grad_weight'] for r in results), bn.weight.grad)
+    torch.testing.assert_close(sum(r['grad_bias'] for r in results), bn.bias.grad)
+    for r in results:
+        torch.testing.assert_close(r['running_mean'], bn.running_mean)
+        torch.testing.assert_close(r['running_var'], bn.running_var)
+        assert r['num_batches_tracked'] == bn.num_batches_tracked